@@ -0,0 +1,152 @@
+#
+# This file is part of NNTSC.
+#
+# Copyright (C) 2013-2017 The University of Waikato, Hamilton, New Zealand.
+#
+# Authors: Shane Alcock
+#          Brendon Jones
+#
+# All rights reserved.
+#
+# This code has been developed by the WAND Network Research Group at the
+# University of Waikato. For further information please see
+# http://www.wand.net.nz/
+#
+# NNTSC is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# NNTSC is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with NNTSC; if not, write to the Free Software Foundation, Inc.
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+#
+# Please report any bugs, questions or comments to contact@wand.net.nz
+#
+
+
+""" An in-process index of stream activity for DBSelector.
+
+    Before querying a data table, DBSelector works out which of the
+    requested streams could possibly have data in the requested time
+    period. This needs the first and last timestamps for each stream and
+    whether the stream has a data table at all. Asking the database and
+    the stream cache about each stream individually gets very slow for
+    large labels, so the answers are kept here and refreshed in bulk.
+
+    The index is shared by every DBSelector in the process (i.e. all of
+    the exporter's DBWorkers), as each DBSelector only lasts for a single
+    request.
+"""
+
+import time
+import threading
+
+# How long (in seconds) the details for a stream are trusted before they
+# are refreshed
+ACTIVITY_REFRESH_FREQ = 60
+
+# Streams that have reported data within this many seconds are assumed to
+# still be active, even if their last timestamp is before the start of
+# the requested period
+ACTIVITY_GRACE = 600
+
+class StreamActivity(object):
+    """ What we know about a single stream """
+
+    __slots__ = ["exists", "first", "last", "updated"]
+
+    def __init__(self, exists, first, last, updated):
+        self.exists = exists
+        self.first = first
+        self.last = last
+        self.updated = updated
+
+class StreamActivityIndex(object):
+    def __init__(self, refresh=ACTIVITY_REFRESH_FREQ):
+        self.refresh = refresh
+        self.tables = {}
+        self.lock = threading.Lock()
+
+    def stale(self, table, streams, now=None):
+        """ Returns the streams from the given list that are either not in
+            the index or have not been refreshed recently.
+        """
+        if now is None:
+            now = time.time()
+        limit = now - self.refresh
+
+        stale = []
+        with self.lock:
+            known = self.tables.get(table, {})
+            for sid in streams:
+                entry = known.get(sid)
+                if entry is None or entry.updated < limit:
+                    stale.append(sid)
+        return stale
+
+    def update(self, table, sid, exists, first, last, now=None):
+        """ Records the latest details for a stream """
+        if now is None:
+            now = time.time()
+        with self.lock:
+            if table not in self.tables:
+                self.tables[table] = {}
+            self.tables[table][sid] = StreamActivity(exists, first, last,
+                    now)
+
+    def was_active(self, table, sid, start, end, now=None):
+        """ Returns True if the stream may have data between start and end.
+            Streams that are not in the index are assumed to be inactive.
+        """
+        with self.lock:
+            entry = self.tables.get(table, {}).get(sid)
+        if entry is None or not entry.exists:
+            return False
+        if entry.first is None or entry.last is None:
+            return False
+
+        if now is None:
+            now = time.time()
+
+        if entry.first > end:
+            return False
+        if entry.last < start and entry.last < now - ACTIVITY_GRACE:
+            return False
+        return True
+
+    def active_streams(self, table, streams, start, end, now=None):
+        """ Returns the streams from the given list that may have data
+            between start and end.
+        """
+        if now is None:
+            now = time.time()
+        return [s for s in streams if self.was_active(table, s, start, end,
+                now)]
+
+    def forget(self, table=None):
+        """ Empties the index, or just the part for a given table """
+        with self.lock:
+            if table is None:
+                self.tables = {}
+            elif table in self.tables:
+                del self.tables[table]
+
+_activityindex = None
+_activityindex_lock = threading.Lock()
+
+def stream_activity_index():
+    """ Returns the stream activity index for this process, creating it
+        the first time this is called.
+    """
+    global _activityindex
+    with _activityindex_lock:
+        if _activityindex is None:
+            _activityindex = StreamActivityIndex()
+        return _activityindex
+
+# vim: set sw=4 tabstop=4 softtabstop=4 expandtab :
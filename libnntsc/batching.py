@@ -0,0 +1,141 @@
+#
+# This file is part of NNTSC.
+#
+# Copyright (C) 2013-2017 The University of Waikato, Hamilton, New Zealand.
+#
+# Authors: Shane Alcock
+#          Brendon Jones
+#
+# All rights reserved.
+#
+# This code has been developed by the WAND Network Research Group at the
+# University of Waikato. For further information please see
+# http://www.wand.net.nz/
+#
+# NNTSC is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# NNTSC is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with NNTSC; if not, write to the Free Software Foundation, Inc.
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+#
+# Please report any bugs, questions or comments to contact@wand.net.nz
+#
+
+
+
+# Flush reasons
+BATCH_FLUSH_SIZE = "size"
+BATCH_FLUSH_AGE = "age"
+BATCH_FLUSH_IDLE = "idle"
+
+# Weight given to the newest sample when updating the moving averages
+BATCH_EWMA_WEIGHT = 0.2
+
+class BatchController(object):
+    """ Decides how many messages should be processed before committing.
+
+        The batch size is adjusted after every commit, growing additively
+        while commits are finishing well within the target latency and
+        there is enough data to fill each batch, and halving whenever a
+        commit takes longer than the target. A batch is also flushed once
+        its oldest message reaches a maximum age, so that data does not sit
+        uncommitted for long periods when traffic is light.
+    """
+
+    def __init__(self, initial, minsize, maxsize, maxdelay, targetlatency):
+        self.minsize = max(1, minsize)
+        self.maxsize = max(self.minsize, maxsize)
+        self.maxdelay = maxdelay
+        self.targetlatency = targetlatency
+
+        self.batchsize = min(max(initial, self.minsize), self.maxsize)
+
+        self.commits = 0
+        self.messages = 0
+        self.reasons = {BATCH_FLUSH_SIZE: 0, BATCH_FLUSH_AGE: 0,
+                BATCH_FLUSH_IDLE: 0}
+        self.lastlatency = 0.0
+        self.avglatency = 0.0
+        self.avgrate = 0.0
+
+    def should_flush(self, pending, age):
+        """ Checks whether a batch should be committed now.
+
+            Parameters:
+              pending -- the number of messages in the current batch.
+              age -- the number of seconds since the oldest message in the
+                     batch was received.
+
+            Returns:
+              the reason for flushing the batch, or None if the batch
+              should be left to grow.
+        """
+        if pending >= self.batchsize:
+            return BATCH_FLUSH_SIZE
+        if pending > 0 and age >= self.maxdelay:
+            return BATCH_FLUSH_AGE
+        return None
+
+    def record_commit(self, count, latency, reason):
+        """ Updates the batch size based on how long the most recent commit
+            took.
+
+            Parameters:
+              count -- the number of messages in the committed batch.
+              latency -- the number of seconds taken to process and commit
+                         the batch.
+              reason -- the reason the batch was flushed.
+        """
+        self.commits += 1
+        self.messages += count
+        if reason in self.reasons:
+            self.reasons[reason] += 1
+        else:
+            self.reasons[reason] = 1
+
+        self.lastlatency = latency
+        if self.commits == 1:
+            self.avglatency = latency
+        else:
+            self.avglatency += BATCH_EWMA_WEIGHT * (latency - self.avglatency)
+
+        if latency > 0:
+            rate = count / latency
+            if self.commits == 1:
+                self.avgrate = rate
+            else:
+                self.avgrate += BATCH_EWMA_WEIGHT * (rate - self.avgrate)
+
+        if latency > self.targetlatency:
+            self.batchsize = max(self.minsize, self.batchsize // 2)
+        elif reason == BATCH_FLUSH_SIZE and \
+                latency < self.targetlatency / 2.0:
+            # Only grow if we are filling batches, otherwise a bigger
+            # batch just means waiting longer for the age limit
+            step = max(1, self.batchsize // 10)
+            self.batchsize = min(self.maxsize, self.batchsize + step)
+
+    def stats(self):
+        """ Returns a dictionary describing the current state of the
+            controller.
+        """
+        return {"batchsize": self.batchsize, "commits": self.commits,
+                "messages": self.messages, "reasons": dict(self.reasons),
+                "lastlatency": self.lastlatency,
+                "avglatency": self.avglatency, "avgrate": self.avgrate}
+
+    def describe(self):
+        reasons = " ".join(["%s=%d" % (k, v) for k, v in \
+                sorted(self.reasons.iteritems())])
+        return "batchsize=%d commits=%d messages=%d flushes(%s) latency=%.3fs rate=%.1f/s" % (
+                self.batchsize, self.commits, self.messages, reasons,
+                self.avglatency, self.avgrate)
+
+# vim: set sw=4 tabstop=4 softtabstop=4 expandtab :
@@ -0,0 +1,304 @@
+#
+# This file is part of NNTSC.
+#
+# Copyright (C) 2013-2017 The University of Waikato, Hamilton, New Zealand.
+#
+# Authors: Shane Alcock
+#          Brendon Jones
+#
+# All rights reserved.
+#
+# This code has been developed by the WAND Network Research Group at the
+# University of Waikato. For further information please see
+# http://www.wand.net.nz/
+#
+# NNTSC is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# NNTSC is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with NNTSC; if not, write to the Free Software Foundation, Inc.
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+#
+# Please report any bugs, questions or comments to contact@wand.net.nz
+#
+
+import os
+import time
+import mmap
+import fcntl
+import struct
+import hashlib
+import threading
+
+from libnntscclient.logger import *
+
+try:
+    import pylibmc
+except ImportError:
+    pylibmc = None
+
+# Default number of slots in the shared memory cache (see the
+# streamcacheslots option). Each slot is 24 bytes, so the default table
+# takes up 24MB
+SHARED_CACHE_SLOTS = 1 << 20
+
+# Number of neighbouring slots to search for a key before giving up
+SHARED_CACHE_PROBES = 8
+
+# Number of times a reader will retry a slot that is being written to
+# before treating it as a miss
+SHARED_CACHE_READ_RETRIES = 100
+
+SHARED_CACHE_MAGIC = "NNTSCTS1"
+
+# Header: magic, number of slots
+SHARED_HEADER = struct.Struct("<8sI")
+
+# Slot: sequence number, key hash, value, expiry time (0 = never)
+SHARED_SLOT = struct.Struct("<IQqI")
+SHARED_SEQ = struct.Struct("<I")
+SHARED_BODY = struct.Struct("<QqI")
+
+class MemcacheBackend(object):
+    """ Stores cached values in a memcached instance running on the local
+        machine.
+    """
+    name = "memcache"
+
+    # Every lookup is a network round trip, so it is worth keeping recent
+    # values in-process as well
+    uselocal = True
+
+    def __init__(self):
+        self.memcache = pylibmc.Client(
+            ["127.0.0.1"],
+            behaviors={
+                "tcp_nodelay": True,
+                "no_block": True,
+            })
+        self.mcpool = pylibmc.ThreadMappedPool(self.memcache)
+
+    def __del__(self):
+        self.mcpool.relinquish()
+
+    def get_multi(self, keys):
+        with self.mcpool.reserve() as mc:
+            try:
+                return mc.get_multi(keys)
+            except pylibmc.SomeErrors as e:
+                log("Warning: pylibmc error while fetching cached values")
+                log(e)
+                return {}
+
+    def set_multi(self, values, ttl):
+        with self.mcpool.reserve() as mc:
+            try:
+                failed = mc.set_multi(values, ttl)
+            except pylibmc.SomeErrors as e:
+                log("Warning: pylibmc error while storing cached values")
+                log(e)
+                return False
+        return len(failed) == 0
+
+class NullBackend(object):
+    """ Doesn't store anything, so every lookup is a miss. """
+    name = "none"
+    uselocal = True
+
+    def get_multi(self, keys):
+        return {}
+
+    def set_multi(self, values, ttl):
+        return True
+
+class SharedMemoryBackend(object):
+    """ Stores cached integer values in a fixed-size hash table in a
+        memory-mapped file, so that the values written by one process
+        (e.g. the AMP ingest processes) can be read by any other process
+        on the same machine (e.g. the exporter) without a round trip to
+        another server.
+
+        Keys are hashed to 64 bits and placed using linear probing. Once
+        all of the slots that a key can go in are in use, the new key
+        replaces the one in its first slot -- this is a cache, so losing
+        the odd entry is fine.
+
+        Each slot has its own sequence number that is incremented before
+        and after it is written to, so readers never need to take a lock:
+        they just check that the sequence number was even and unchanged
+        while they read the slot and try again otherwise. Writers are
+        serialised using a lock on the file.
+
+        Only one instance should be created per file in each process, as
+        closing a file releases every lock the process holds on it. Use
+        shared_memory_backend() rather than creating these directly.
+
+        Every process using the file must agree on the number of slots.
+        Opening the file with a different number starts again with an
+        empty table.
+    """
+    name = "sharedmem"
+
+    # Reading a slot is as cheap as reading from an in-process cache
+    uselocal = False
+
+    def __init__(self, path, slots=SHARED_CACHE_SLOTS):
+        self.path = path
+        self.slots = slots
+        self.lock = threading.Lock()
+
+        size = SHARED_HEADER.size + slots * SHARED_SLOT.size
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0660)
+        try:
+            fcntl.lockf(self.fd, fcntl.LOCK_EX)
+            try:
+                self._prepare_file(size)
+            finally:
+                fcntl.lockf(self.fd, fcntl.LOCK_UN)
+            self.map = mmap.mmap(self.fd, size)
+        except:
+            os.close(self.fd)
+            raise
+
+    def _prepare_file(self, size):
+        # Start again with an empty table if the file is new, or was
+        # created with a different layout
+        if os.fstat(self.fd).st_size == size:
+            header = os.read(self.fd, SHARED_HEADER.size)
+            if header == SHARED_HEADER.pack(SHARED_CACHE_MAGIC, self.slots):
+                return
+
+        os.ftruncate(self.fd, 0)
+        os.ftruncate(self.fd, size)
+        os.lseek(self.fd, 0, os.SEEK_SET)
+        os.write(self.fd, SHARED_HEADER.pack(SHARED_CACHE_MAGIC, self.slots))
+
+    def _hash(self, key):
+        h = struct.unpack("<Q", hashlib.md5(key).digest()[:8])[0]
+
+        # Zero marks an empty slot
+        if h == 0:
+            h = 1
+        return h
+
+    def _offsets(self, h):
+        first = h % self.slots
+        for i in xrange(SHARED_CACHE_PROBES):
+            yield SHARED_HEADER.size + \
+                    ((first + i) % self.slots) * SHARED_SLOT.size
+
+    def _read_slot(self, offset):
+        for i in xrange(SHARED_CACHE_READ_RETRIES):
+            before = SHARED_SEQ.unpack_from(self.map, offset)[0]
+            if before & 1:
+                continue
+            slot = SHARED_SLOT.unpack_from(self.map, offset)
+            if SHARED_SEQ.unpack_from(self.map, offset)[0] == before:
+                return slot[1:]
+        return None
+
+    def get_multi(self, keys):
+        found = {}
+        now = time.time()
+        for k in keys:
+            h = self._hash(k)
+            for offset in self._offsets(h):
+                slot = self._read_slot(offset)
+                if slot is None:
+                    continue
+                keyhash, value, expires = slot
+                if keyhash == h:
+                    if expires == 0 or expires > now:
+                        found[k] = value
+                    break
+                if keyhash == 0:
+                    break
+        return found
+
+    def set_multi(self, values, ttl):
+        if ttl:
+            expires = int(time.time()) + ttl
+        else:
+            expires = 0
+
+        with self.lock:
+            fcntl.lockf(self.fd, fcntl.LOCK_EX)
+            try:
+                now = time.time()
+                for k, v in values.iteritems():
+                    self._write(self._hash(k), v, expires, now)
+            finally:
+                fcntl.lockf(self.fd, fcntl.LOCK_UN)
+        return True
+
+    def _write(self, h, value, expires, now):
+        # Prefer the slot that already has this key, then an empty or
+        # expired slot, and finally the first slot the key can go in
+        target = None
+        for offset in self._offsets(h):
+            keyhash, expiry = struct.unpack_from("<Q8xI", self.map,
+                    offset + SHARED_SEQ.size)
+            if keyhash == h:
+                target = offset
+                break
+            if target is None and (keyhash == 0 or \
+                    (expiry != 0 and expiry <= now)):
+                target = offset
+            if keyhash == 0:
+                break
+
+        if target is None:
+            target = SHARED_HEADER.size + (h % self.slots) * SHARED_SLOT.size
+
+        seq = SHARED_SEQ.unpack_from(self.map, target)[0]
+        SHARED_SEQ.pack_into(self.map, target, (seq + 1) & 0xffffffff)
+        SHARED_BODY.pack_into(self.map, target + SHARED_SEQ.size, h, value,
+                expires)
+        SHARED_SEQ.pack_into(self.map, target, (seq + 2) & 0xffffffff)
+
+_sharedbackends = {}
+_sharedbackends_lock = threading.Lock()
+
+def shared_memory_backend(path, slots=None):
+    """ Returns the shared memory backend for the given file, opening it
+        the first time this is called by each process.
+    """
+    if slots is None:
+        slots = SHARED_CACHE_SLOTS
+
+    key = (os.getpid(), path)
+    with _sharedbackends_lock:
+        if key not in _sharedbackends:
+            _sharedbackends[key] = SharedMemoryBackend(path, slots)
+        return _sharedbackends[key]
+
+def create_cache_backend(backend, path, slots=None):
+    """ Returns a cache backend of the given type ('memcache', 'sharedmem'
+        or 'none'). If the backend can't be used, a warning is logged and
+        nothing will be cached.
+
+        slots is the size of the 'sharedmem' table, if None then
+        SHARED_CACHE_SLOTS is used.
+    """
+    if backend == "sharedmem":
+        try:
+            return shared_memory_backend(path, slots)
+        except (IOError, OSError, mmap.error) as e:
+            log("Warning: unable to open shared memory cache %s" % (path))
+            log(e)
+            return NullBackend()
+
+    if backend == "memcache":
+        if pylibmc is not None:
+            return MemcacheBackend()
+        log("Warning: pylibmc is not installed, stream timestamps will not be cached")
+
+    return NullBackend()
+
+# vim: set smartindent shiftwidth=4 tabstop=4 softtabstop=4 expandtab :
@@ -165,12 +165,56 @@ def get_nntsc_db_config(nntsc_config):
     cachetime = get_nntsc_config(nntsc_config, 'database', 'streamcachetime')
     if cachetime == "NNTSCConfigMissing":
         cachetime = 0
-
-    if "NNTSCConfigError" in [dbhost, dbname, dbuser, dbpass]:
+    insertmode = get_nntsc_config(nntsc_config, 'database', 'insertmode')
+    if insertmode == "NNTSCConfigMissing":
+        insertmode = "insert"
+    elif insertmode not in ["insert", "copy"]:
+        logger.log("Invalid insertmode in database config: %s" % (insertmode))
+        logger.log("Suitable values are 'insert' or 'copy'")
+        insertmode = "NNTSCConfigError"
+    pathstorage = get_nntsc_config(nntsc_config, 'database', 'pathstorage')
+    if pathstorage == "NNTSCConfigMissing":
+        pathstorage = "stream"
+    elif pathstorage not in ["stream", "global"]:
+        logger.log("Invalid pathstorage in database config: %s" % (pathstorage))
+        logger.log("Suitable values are 'stream' or 'global'")
+        pathstorage = "NNTSCConfigError"
+    datalayout = get_nntsc_config(nntsc_config, 'database', 'datalayout')
+    if datalayout == "NNTSCConfigMissing":
+        datalayout = "stream"
+    elif datalayout not in ["stream", "partitioned"]:
+        logger.log("Invalid datalayout in database config: %s" % (datalayout))
+        logger.log("Suitable values are 'stream' or 'partitioned'")
+        datalayout = "NNTSCConfigError"
+    cachebackend = get_nntsc_config(nntsc_config, 'database',
+            'streamcachebackend')
+    if cachebackend == "NNTSCConfigMissing":
+        cachebackend = "memcache"
+    elif cachebackend not in ["memcache", "sharedmem", "none"]:
+        logger.log("Invalid streamcachebackend in database config: %s" % (cachebackend))
+        logger.log("Suitable values are 'memcache', 'sharedmem' or 'none'")
+        cachebackend = "NNTSCConfigError"
+    cachepath = get_nntsc_config(nntsc_config, 'database', 'streamcachepath')
+    if cachepath == "NNTSCConfigMissing" or cachepath == "":
+        cachepath = None
+    cacheslots = get_nntsc_config_integer(nntsc_config, 'database',
+            'streamcacheslots')
+    if cacheslots == "NNTSCConfigMissing":
+        cacheslots = None
+    elif cacheslots != "NNTSCConfigError" and cacheslots <= 0:
+        logger.log("Invalid streamcacheslots in database config: %d" % (cacheslots))
+        logger.log("streamcacheslots must be greater than zero")
+        cacheslots = "NNTSCConfigError"
+
+    if "NNTSCConfigError" in [dbhost, dbname, dbuser, dbpass, insertmode,
+            pathstorage, datalayout, cachebackend, cachepath, cacheslots]:
         return {}
 
     return {"host":dbhost, "name":dbname, "user":dbuser, "pass":dbpass,
-            "cachetime":int(cachetime)}
+            "cachetime":int(cachetime), "insertmode":insertmode,
+            "pathstorage":pathstorage, "datalayout":datalayout,
+            "cachebackend":cachebackend, "cachepath":cachepath,
+            "cacheslots":cacheslots}
 
 
 def get_nntsc_net_config(nntsc_config):
@@ -30,12 +30,144 @@
 #
 
 
+import re
 import time
+import math
+import operator
+import itertools
 import psycopg2
 import psycopg2.extras
+from cStringIO import StringIO
 from libnntscclient.logger import *
 from libnntsc.dberrorcodes import *
 from libnntsc.streamcache import StreamCache
+from libnntsc.metadatacache import COLLECTION_CHANNEL
+
+# Postgres types that will reject a float in COPY text format, even though
+# an INSERT would quietly round it for us
+COPY_INTEGER_TYPES = ['int2', 'int4', 'int8']
+
+# Savepoint names used to isolate the rows belonging to a single message,
+# a single COPY and a single new stream respectively
+MESSAGE_SAVEPOINT = "nntsc_message"
+COPY_SAVEPOINT = "nntsc_copy"
+STREAM_SAVEPOINT = "nntsc_stream"
+
+# Splits the output of pg_get_indexdef() into the bits before and after the
+# index name and table
+INDEXDEF_REGEX = re.compile(r'CREATE (UNIQUE )?INDEX (\S+) ON \S+ (.*)$')
+
+# With the partitioned data layout, each data table is split into
+# partitions that cover this many seconds each
+DATA_PARTITION_PERIOD = 7 * 24 * 60 * 60
+
+# Number of partitions to create ahead of the current time, so that new
+# data never has to wait for a partition to be created
+DATA_PARTITION_PREMAKE = 2
+
+# How often (in seconds) long-running modules should call
+# maintain_partitions()
+DATA_PARTITION_CHECK_FREQ = 60 * 60
+
+# Matches the names of the time range partitions of a data table
+PARTITION_REGEX = re.compile(r'^(.*)_p(\d+)$')
+
+def _copy_scalar(value, integer):
+    if value is None:
+        return None
+    if isinstance(value, bool):
+        if value:
+            return 't'
+        return 'f'
+    if isinstance(value, float):
+        if math.isnan(value):
+            return 'NaN'
+        if math.isinf(value):
+            if value > 0:
+                return 'Infinity'
+            return '-Infinity'
+        if integer:
+            return str(int(round(value)))
+        return repr(value)
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+def _copy_array(values, integer):
+    # Format a python list as a postgres array literal, e.g. {1,NULL,3}
+    elements = []
+    for v in values:
+        if isinstance(v, (list, tuple)):
+            elements.append(_copy_array(v, integer))
+            continue
+
+        v = _copy_scalar(v, integer)
+        if v is None:
+            elements.append('NULL')
+        elif v == "" or v.upper() == "NULL" or \
+                any(c in v for c in ' {},"\\\t\n\r'):
+            elements.append('"' + v.replace('\\', '\\\\').replace('"',
+                    '\\"') + '"')
+        else:
+            elements.append(v)
+    return '{' + ','.join(elements) + '}'
+
+def _copy_escape(value):
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace(
+            '\r', '\\r').replace('\t', '\\t')
+
+def copy_format_value(value, udt=None):
+    """ Converts a python value into the representation expected for
+        a column in a COPY text format data stream.
+
+        Parameters:
+          value -- the value to be converted
+          udt -- the postgres udt_name of the destination column, if known.
+
+        Returns:
+          the escaped string to write for this column, with \\N
+          representing NULL.
+    """
+    if value is None:
+        return '\\N'
+
+    if isinstance(value, (list, tuple)):
+        integer = udt is not None and udt[1:] in COPY_INTEGER_TYPES
+        return _copy_escape(_copy_array(value, integer))
+
+    integer = udt in COPY_INTEGER_TYPES
+    return _copy_escape(_copy_scalar(value, integer))
+
+def row_getter(columns):
+    """ Compiles a function that extracts the values for a set of columns
+        from a result dictionary, returning them as a tuple in the same
+        order as the columns.
+    """
+    if len(columns) == 0:
+        return lambda result: ()
+    if len(columns) == 1:
+        col = columns[0]
+        return lambda result: (result[col],)
+    return operator.itemgetter(*columns)
+
+class RowFormat(object):
+    """ Everything needed to write rows with a fixed set of columns into
+        a data table, see DBInsert.row_format().
+    """
+
+    __slots__ = ["table", "columns", "insert", "copy"]
+
+    def __init__(self, table, columns, insert):
+        self.table = table
+        self.columns = columns
+
+        # The column list and value placeholders for an INSERT
+        self.insert = insert
+
+        # The COPY column list and destination column types, which need
+        # to be looked up in the database so are only filled in the first
+        # time that a row is written using COPY
+        self.copy = None
 
 class NNTSCCursor(object):
     def __init__(self, connstr, autocommit=False, name=None):
@@ -46,7 +178,11 @@ class NNTSCCursor(object):
         self.conn = None
         self.cursor = None
 
+        # Names of the savepoints in the current transaction, innermost last
+        self.savepoints = []
+
     def destroy(self):
+        self.savepoints = []
         if self.cursor is not None:
             #self.cursor.close()
             self.cursor = None
@@ -111,7 +247,7 @@ class NNTSCCursor(object):
                 self.cursor.execute(query)
 
         except psycopg2.extensions.QueryCanceledError:
-            self.conn.rollback()
+            self._abort()
             raise DBQueryException(DB_QUERY_TIMEOUT)
         except psycopg2.OperationalError:
             log("Database appears to have disappeared -- reconnecting")
@@ -119,17 +255,17 @@ class NNTSCCursor(object):
             raise DBQueryException(DB_OPERATIONAL_ERROR)
         except psycopg2.ProgrammingError as e:
             log(e)
-            self.conn.rollback()
+            self._abort()
             raise DBQueryException(DB_CODING_ERROR)
         except psycopg2.IntegrityError as e:
-            self.conn.rollback()
+            self._abort()
             if "duplicate key " in str(e):
                 raise DBQueryException(DB_DUPLICATE_KEY)
             log(e)
             raise DBQueryException(DB_DATA_ERROR)
         except psycopg2.DataError as e:
             log(e)
-            self.conn.rollback()
+            self._abort()
             raise DBQueryException(DB_DATA_ERROR)
         except KeyboardInterrupt:
             raise DBQueryException(DB_INTERRUPTED)
@@ -142,11 +278,135 @@ class NNTSCCursor(object):
 
             log(e.pgerror)
             try:
-                self.conn.rollback()
+                self._abort()
             except InterfaceError as e:
                 log(e)
             raise DBQueryException(DB_GENERIC_ERROR)
 
+    def copydata(self, table, columns, datafile):
+        if self.cursor is None:
+            self.createcursor()
+
+        query = "COPY %s (%s) FROM STDIN" % (table, ", ".join(columns))
+
+        try:
+            self.cursor.copy_expert(query, datafile)
+        except psycopg2.extensions.QueryCanceledError:
+            self._abort()
+            raise DBQueryException(DB_QUERY_TIMEOUT)
+        except psycopg2.OperationalError:
+            log("Database appears to have disappeared during COPY -- reconnecting")
+            self.reconnect()
+            raise DBQueryException(DB_OPERATIONAL_ERROR)
+        except psycopg2.ProgrammingError as e:
+            log(e)
+            self._abort()
+            raise DBQueryException(DB_CODING_ERROR)
+        except psycopg2.IntegrityError as e:
+            self._abort()
+            if "duplicate key " in str(e):
+                raise DBQueryException(DB_DUPLICATE_KEY)
+            log(e)
+            raise DBQueryException(DB_DATA_ERROR)
+        except psycopg2.DataError as e:
+            log(e)
+            self._abort()
+            raise DBQueryException(DB_DATA_ERROR)
+        except KeyboardInterrupt:
+            raise DBQueryException(DB_INTERRUPTED)
+        except psycopg2.Error as e:
+            if "server closed the connection unexpectedly" in str(e):
+                log("Database appears to have disappeared, fell through to catch-all error case -- reconnecting")
+                self.reconnect()
+                raise DBQueryException(DB_OPERATIONAL_ERROR)
+
+            log(e.pgerror)
+            try:
+                self._abort()
+            except psycopg2.InterfaceError as e:
+                log(e)
+            raise DBQueryException(DB_GENERIC_ERROR)
+
+    def _abort(self):
+        # A query has failed, so the transaction can't be used again until
+        # it has been rolled back. If there is a savepoint, we only need to
+        # undo as far as that.
+        if len(self.savepoints) > 0:
+            try:
+                self.cursor.execute("ROLLBACK TO SAVEPOINT %s" % \
+                        (self.savepoints[-1]))
+                return
+            except psycopg2.Error as e:
+                log(e)
+
+        self.savepoints = []
+        self.conn.rollback()
+
+    def savepoint(self, name):
+        """ Creates a savepoint that the current transaction can be rolled
+            back to using rollback_savepoint().
+
+            If the innermost savepoint already has this name, it is
+            replaced with a new one rather than nesting them.
+        """
+        if len(self.savepoints) > 0 and self.savepoints[-1] == name:
+            self.executequery("RELEASE SAVEPOINT %s; SAVEPOINT %s" % \
+                    (name, name), None)
+            return
+
+        self.executequery("SAVEPOINT %s" % (name), None)
+        self.savepoints.append(name)
+
+    def release_savepoint(self, name):
+        if name not in self.savepoints:
+            return
+
+        while self.savepoints[-1] != name:
+            self.savepoints.pop()
+        self.executequery("RELEASE SAVEPOINT %s" % (name), None)
+        self.savepoints.pop()
+
+    def rollback_savepoint(self, name):
+        """ Undoes everything since the given savepoint was created.
+
+            Returns False if the savepoint no longer exists, in which case
+            the entire transaction has been rolled back instead.
+        """
+        if name not in self.savepoints:
+            self.rollback()
+            return False
+
+        while self.savepoints[-1] != name:
+            self.savepoints.pop()
+
+        if self.cursor is None:
+            self.createcursor()
+
+        try:
+            self.cursor.execute("ROLLBACK TO SAVEPOINT %s; RELEASE SAVEPOINT %s" % (name, name))
+        except psycopg2.Error as e:
+            log(e)
+            self.rollback()
+            return False
+
+        self.savepoints.pop()
+        return True
+
+    def rollback(self):
+        self.savepoints = []
+        if self.conn is None:
+            return
+
+        try:
+            self.conn.rollback()
+        except psycopg2.OperationalError:
+            log("Database appears to have disappeared during rollback -- reconnecting")
+            self.reconnect()
+        except psycopg2.Error as e:
+            log(e)
+
+        self.cursor = None
+
     def closecursor(self):
         if self.cursor is None:
             return
@@ -197,6 +457,7 @@ class NNTSCCursor(object):
             raise DBQueryException(DB_NO_CURSOR)
 
         err = DB_NO_ERROR
+        self.savepoints = []
         try:
             self.conn.commit()
         except psycopg2.extensions.QueryCanceledError:
@@ -233,7 +494,8 @@ class NNTSCCursor(object):
 
 class DatabaseCore(object):
     def __init__(self, dbname, dbuser=None, dbpass=None, dbhost=None,
-            timeout=0, cachetime=0):
+            timeout=0, cachetime=0, datalayout="stream",
+            cachebackend="memcache", cachepath=None, cacheslots=None):
 
         #no host means use the unix socket
         if dbhost == "":
@@ -261,7 +523,13 @@ class DatabaseCore(object):
 
         self.basic = NNTSCCursor(self.connstr, False, None)
 
-        self.streamcache = StreamCache(dbname, cachetime)
+        self.streamcache = StreamCache(dbname, cachetime, cachebackend,
+                cachepath, cacheslots)
+
+        # Either "stream" if each stream has its own data table, or
+        # "partitioned" if each collection has a single data table that
+        # is partitioned by time
+        self.datalayout = datalayout
 
     def connect_db(self, retrywait):
         return self.basic.connect(retrywait)
@@ -293,6 +561,46 @@ class DatabaseCore(object):
     def _releasebasic(self):
         self.basic.closecursor()
 
+    def streams_with_tables(self, table, streams):
+        """ Returns the ids of the streams that have their own data table.
+            With the partitioned data layout, these are the streams that
+            haven't been moved into the partitioned data table yet.
+        """
+        if len(streams) == 0:
+            return []
+
+        names = ["%s_%s" % (table, s) for s in streams]
+        self._basicquery("""SELECT relname FROM pg_class WHERE
+                relkind = 'r' AND relname IN %s""", (tuple(names),))
+        found = set([r[0] for r in self.basic.cursor.fetchall()])
+        self._releasebasic()
+
+        return [s for s, n in zip(streams, names) if n in found]
+
+    def stream_data_sql(self, table, streams):
+        """ Forms a query that selects all of the rows in a data table
+            that belong to any of the given streams.
+
+            Returns a tuple containing the SQL and its parameters.
+        """
+        if self.datalayout != "partitioned":
+            sql = " UNION ALL ".join(["SELECT * FROM %s_%%s" % (table)] * \
+                    len(streams))
+            return sql, list(streams)
+
+        sql = "SELECT * FROM %s WHERE stream_id IN (%s)" % (table,
+                ", ".join(["%s"] * len(streams)))
+        params = list(streams)
+
+        # Any streams that haven't been migrated yet still have some (or
+        # all) of their data in their old table
+        for sid in self.streams_with_tables(table, streams):
+            sql += " UNION ALL SELECT * FROM %s_" % (table)
+            sql += "%s"     # stream id will go here
+            params.append(sid)
+
+        return sql, params
+
     def list_collections(self):
         collections = []
 
@@ -309,13 +617,38 @@ class DatabaseCore(object):
         self._releasebasic()
         return collections
 
-    def select_streams_by_module(self, mod):
+    def get_stream_highwater(self):
+        """ Returns the largest stream id that has been handed out so far,
+            or zero if there are no streams yet.
+        """
+        self._basicquery("""SELECT CASE WHEN is_called THEN last_value
+                ELSE 0 END FROM streams_id_seq""")
+        row = self.basic.cursor.fetchone()
+        self._releasebasic()
+        return row[0]
+
+    def get_database_identity(self):
+        """ Returns a number that identifies this particular instance of
+            the database. It changes whenever the database is wiped (e.g.
+            by build_nntsc_db -F) or restored, as these recreate the stream
+            id sequence.
+        """
+        self._basicquery("""SELECT d.oid, 'streams_id_seq'::regclass::oid
+                FROM pg_database d WHERE d.datname = current_database()""")
+        row = self.basic.cursor.fetchone()
+        self._releasebasic()
+        return (int(row[0]) << 32) | int(row[1])
+
+    def select_streams_by_module(self, mod, newerthan=None):
         """ Fetches all streams that belong to collections that have a common
             parent module, e.g. amp or rrd.
 
             For example, passing "amp" into this function would give you
             all amp-icmp and amp-traceroute streams.
 
+            If newerthan is given, only streams with a larger stream id
+            are fetched.
+
             Note that if you want the streams for a single collection, you
             should use select_streams_by_collection.
 
@@ -347,7 +680,11 @@ class DatabaseCore(object):
         for cid, (tname, sub) in streamtables.iteritems():
             sql = """ SELECT * FROM %s """ % (tname)
 
-            self._basicquery(sql, (cid,))
+            if newerthan is not None:
+                sql += """ WHERE stream_id > %s """
+                self._basicquery(sql, (newerthan,))
+            else:
+                self._basicquery(sql, (cid,))
 
             while True:
                 row = self.basic.cursor.fetchone()
@@ -368,10 +705,77 @@ class DatabaseCore(object):
 
 class DBInsert(DatabaseCore):
     def __init__(self, dbname, dbuser=None, dbpass=None, dbhost=None,
-            cachetime=0):
+            cachetime=0, insertmode="insert", pathstorage="stream",
+            datalayout="stream", cachebackend="memcache", cachepath=None,
+            cacheslots=None):
 
         super(DBInsert, self).__init__(dbname, dbuser, dbpass, dbhost,
-                cachetime=cachetime)
+                cachetime=cachetime, datalayout=datalayout,
+                cachebackend=cachebackend, cachepath=cachepath,
+                cacheslots=cacheslots)
+
+        # In "copy" mode, data rows are buffered per table until
+        # commit_data() is called and then written using a single COPY
+        # per table rather than an INSERT per row
+        self.insertmode = insertmode
+        self.copybuffers = {}
+        self.copycoltypes = {}
+
+        # Row formats compiled for insert_data(), so that the SQL and
+        # column lists for a given table and set of columns are only
+        # built once rather than for every row that is inserted
+        self.rowformats = {}
+
+        # If set, custom inserts (e.g. traceroute paths) go via the streams
+        # connection so that the data connection can be left to a separate
+        # commit thread
+        self.pipelined = False
+
+        # State for the message currently being processed, see
+        # begin_message()
+        self.inmessage = False
+        self.messageid = None
+        self.messagesaved = False
+        self.copyjournal = []
+
+        # Rows waiting to be inserted at the end of a batch, see
+        # begin_batch()
+        self.batchrows = None
+
+        # If set, new data tables are created without indexes and
+        # build_deferred_indexes() must be called to add them, e.g. once
+        # a bulk import has finished
+        self.deferindexes = False
+        self.deferredindexes = []
+
+        # Number of data rows written so far
+        self.rowswritten = 0
+
+        # Stream ids fetched by reserve_stream_ids() that haven't been
+        # given to a new stream yet
+        self.reservedids = []
+
+        # Either "stream" if each traceroute stream has its own paths
+        # tables, or "global" if all streams share the same path
+        # dictionaries
+        self.pathstorage = pathstorage
+
+        # The start times of the partitions that are known to exist for
+        # each partitioned data table, see create_partitions()
+        self.partitions = {}
+
+    def set_pipelined(self):
+        """ Prepares this inserter for data to be parsed and committed in
+            separate threads.
+
+            Data rows are buffered (i.e. the insert mode is forced to
+            "copy") and handed over using take_pending() and
+            commit_pending(). Custom inserts are made using the streams
+            connection, so the parsing thread must call commit_streams()
+            once it has finished with each batch.
+        """
+        self.insertmode = "copy"
+        self.pipelined = True
 
     def connect_db(self, retrywait):
         self.streams = NNTSCCursor(self.connstr, False, None)
@@ -394,13 +798,268 @@ class DBInsert(DatabaseCore):
     def _dataquery(self, query, params=None):
         self.data.executequery(query, params)
 
+    def _messagecursor(self):
+        # The connection that any queries made while processing a message
+        # are going to use
+        if self.pipelined:
+            return self.streams
+        return self.data
+
+    def _messagequery(self, query, params=None):
+        cursor = self._messagecursor()
+
+        # Only create the savepoint once we know that this message is going
+        # to touch the database -- in copy mode, most don't
+        if self.inmessage and not self.messagesaved:
+            cursor.savepoint(MESSAGE_SAVEPOINT)
+            self.messagesaved = True
+
+        cursor.executequery(query, params)
+
+    def begin_message(self, messageid=None):
+        """ Starts processing a new message. If anything goes wrong
+            before end_message() is called, abort_message() can be used to
+            undo everything that the message has inserted without losing
+            the rest of the current transaction.
+
+            The message id is attached to any rows that are buffered for
+            COPY, so that commit_pending() can tell which message was
+            responsible for a row that it fails to write.
+        """
+        self.inmessage = True
+        self.messageid = messageid
+        self.messagesaved = False
+        self.copyjournal = []
+
+    def end_message(self):
+        # The savepoint is left in place to be replaced by the next message
+        # (or released by the commit), saving a round trip per message
+        self.inmessage = False
+        self.messageid = None
+        self.copyjournal = []
+
+    def tag_message(self, messageid):
+        """ Changes the message id that is attached to buffered rows,
+            without starting a new savepoint.
+        """
+        self.messageid = messageid
+
+    def begin_batch(self):
+        """ Starts saving up rows so that they can be inserted using one
+            INSERT per table when end_batch() is called. Has no effect in
+            copy mode, where rows are buffered until the commit anyway.
+        """
+        if self.insertmode == "insert":
+            self.batchrows = {}
+
+    def end_batch(self):
+        rows = self.batchrows
+        self.batchrows = None
+        if rows is None:
+            return
+
+        for (fmt, stream), values in rows.iteritems():
+            self._insert_rows(fmt, stream, values)
+
+    def discard_batch(self):
+        self.batchrows = None
+
+    def abort_message(self):
+        """ Undoes everything inserted since begin_message() was called.
+
+            Raises a DBQueryException if this could not be done without
+            rolling back the entire transaction.
+        """
+        rows = self.copyjournal
+        while len(rows) > 0:
+            self.copybuffers[rows.pop()].pop()
+
+        saved = self.messagesaved
+        self.end_message()
+
+        if saved and not self._messagecursor().rollback_savepoint(
+                MESSAGE_SAVEPOINT):
+            log("Lost the rest of the transaction while aborting a message")
+            raise DBQueryException(DB_OPERATIONAL_ERROR)
+
+    def quarantine_message(self, module, subtype, source, body, error):
+        """ Saves a message that could not be processed into the dead
+            letter table, as part of the current transaction.
+        """
+        self._insert_dead_letter(self._messagecursor(),
+                (module, subtype, source, body), error)
+
+    def _insert_dead_letter(self, cursor, letter, error):
+        module, subtype, source, body = letter
+
+        query = """INSERT INTO dead_letters (received, module, modsubtype,
+                source, error, body) VALUES (%s, %s, %s, %s, %s, %s)"""
+        params = (int(time.time()), module, subtype, source, str(error),
+                psycopg2.Binary(body))
+
+        # Failing to save the message shouldn't cost us the rest of the
+        # batch as well
+        cursor.savepoint(MESSAGE_SAVEPOINT)
+        try:
+            cursor.executequery(query, params)
+        except DBQueryException as e:
+            log("Failed to save %s %s message from %s to dead letter table" \
+                    % (module, subtype, source))
+            log("Error was: %s" % (str(e)))
+            if not cursor.rollback_savepoint(MESSAGE_SAVEPOINT):
+                raise
+            return
+        cursor.release_savepoint(MESSAGE_SAVEPOINT)
+
     def commit_streams(self):
         self.streams.commit()
         self.streams.closecursor()
 
+        # Anything the current message did is now committed, so can't be
+        # undone any more
+        if self.pipelined:
+            self.messagesaved = False
+
     def commit_data(self):
-        self.data.commit()
+        self.commit_pending(self.take_pending())
+
+    def take_pending(self):
+        """ Returns all of the data rows that are waiting to be written
+            via COPY, removing them from this inserter.
+        """
+        buffers = self.copybuffers
+        self.copybuffers = {}
+        return buffers
+
+    def commit_pending(self, buffers, deadletter=None):
+        """ Writes a set of buffered data rows, as returned by
+            take_pending(), and commits them along with anything else done
+            using the data connection.
+
+            If deadletter is given and some of the rows are rejected by the
+            database, the rows are retried one message at a time so that
+            only the messages containing bad rows are left out.
+            deadletter(messageid) must return a (module, subtype, source,
+            body) tuple describing the message to be saved in the dead
+            letter table.
+
+            Returns a list of the ids of any rejected messages.
+        """
+        rejected = []
+        try:
+            if deadletter is None:
+                self._flush_copy_buffers(buffers)
+            else:
+                rejected = self._flush_copy_isolated(buffers, deadletter)
+            self.data.commit()
+        except DBQueryException:
+            self.data.rollback()
+            raise
         self.data.closecursor()
+        return rejected
+
+    def discard_pending(self):
+        self.copybuffers = {}
+        self.end_message()
+
+    def rollback_data(self):
+        """ Discards any data that has been inserted since the last
+            successful commit_data(), including rows that are still
+            waiting to be written via COPY.
+        """
+        self.discard_pending()
+        self.data.rollback()
+
+    def rollback_streams(self):
+        self.streams.rollback()
+
+    def reserve_stream_ids(self, count):
+        """ Fetches enough ids for the next count new streams from the
+            stream id sequence in a single query, rather than one at a
+            time as each stream is inserted.
+        """
+        count -= len(self.reservedids)
+        if count <= 0:
+            return
+
+        self._streamsquery(
+                "SELECT nextval('streams_id_seq') FROM generate_series(1, %s)",
+                (count,))
+        self.reservedids += [row[0] for row in self.streams.cursor.fetchall()]
+
+    def _flush_copy_buffers(self, buffers):
+        for (table, columns), rows in buffers.iteritems():
+            if len(rows) == 0:
+                continue
+            lines = [r[1] for r in rows]
+            lines.append("")
+            datafile = StringIO("\n".join(lines))
+            self.data.copydata(table, columns, datafile)
+            self.rowswritten += len(rows)
+
+    def _flush_copy_isolated(self, buffers, deadletter):
+        if len(buffers) == 0:
+            return []
+
+        self.data.savepoint(COPY_SAVEPOINT)
+        try:
+            self._flush_copy_buffers(buffers)
+        except DBQueryException as e:
+            if e.code not in [DB_DATA_ERROR, DB_DUPLICATE_KEY]:
+                raise
+            if not self.data.rollback_savepoint(COPY_SAVEPOINT):
+                raise
+        else:
+            self.data.release_savepoint(COPY_SAVEPOINT)
+            return []
+
+        # Something in there was bad, so go back and write each message
+        # separately to find out which one(s)
+        bymessage = {}
+        for key, rows in buffers.iteritems():
+            for row in rows:
+                if row[0] not in bymessage:
+                    bymessage[row[0]] = {}
+                if key not in bymessage[row[0]]:
+                    bymessage[row[0]][key] = []
+                bymessage[row[0]][key].append(row)
+
+        rejected = []
+        for messageid in sorted(bymessage.keys()):
+            self.data.savepoint(COPY_SAVEPOINT)
+            try:
+                self._flush_copy_buffers(bymessage[messageid])
+            except DBQueryException as e:
+                if e.code not in [DB_DATA_ERROR, DB_DUPLICATE_KEY]:
+                    raise
+                if not self.data.rollback_savepoint(COPY_SAVEPOINT):
+                    raise
+                rejected.append(messageid)
+                self._insert_dead_letter(self.data, deadletter(messageid), e)
+                continue
+            self.data.release_savepoint(COPY_SAVEPOINT)
+
+        log("Rejected %d of %d messages while writing data using COPY" % \
+                (len(rejected), len(bymessage)))
+        return rejected
+
+    def _get_copy_coltypes(self, tablename):
+        # Column types are looked up from the template data table so that
+        # values can be formatted to suit the column they are going into
+        if tablename in self.copycoltypes:
+            return self.copycoltypes[tablename]
+
+        query = """SELECT column_name, udt_name FROM
+                information_schema.columns WHERE table_name=%s"""
+
+        self._basicquery(query, (tablename,))
+        coltypes = {}
+        for row in self.basic.cursor.fetchall():
+            coltypes[row[0]] = row[1]
+        self._releasebasic()
+
+        self.copycoltypes[tablename] = coltypes
+        return coltypes
 
     def create_aggregators(self):
         # Create a useful function to select a mode from any data
@@ -478,7 +1137,7 @@ class DBInsert(DatabaseCore):
 
         self._releasebasic()
 
-    def create_index(self, name, table, columns):
+    def create_index(self, name, table, columns, unique=False):
         if len(columns) == 0:
             return DB_NO_ERROR
 
@@ -503,7 +1162,10 @@ class DBInsert(DatabaseCore):
 
         self._releasebasic()
 
-        index = "CREATE INDEX %s ON %s"
+        if unique:
+            index = "CREATE UNIQUE INDEX %s ON %s"
+        else:
+            index = "CREATE INDEX %s ON %s"
         index += "(%s)" % (",".join(["%s"] * len(columns)))
 
         params = tuple([name] + [table] + columns)
@@ -565,6 +1227,19 @@ class DBInsert(DatabaseCore):
 
         self._basicquery(coltable)
 
+        # Messages that could not be processed end up here, rather than
+        # being retried forever
+        deadtable = """CREATE TABLE IF NOT EXISTS dead_letters (
+                id SERIAL PRIMARY KEY,
+                received integer NOT NULL,
+                module varchar NOT NULL,
+                modsubtype character varying,
+                source character varying,
+                error character varying,
+                body bytea)"""
+
+        self._basicquery(deadtable)
+
         createseq = """SELECT create_seq('streams_id_seq');"""
         try:
             self._basicquery(createseq)
@@ -580,6 +1255,10 @@ class DBInsert(DatabaseCore):
         for mod in modules.values():
             mod.tables(self)
 
+        # Let any running exporters know that they need to look at the
+        # collections again
+        self.notify_collection_change()
+
     def get_collection_id(self, mod, subtype):
 
         # Find the appropriate collection id
@@ -616,14 +1295,31 @@ class DBInsert(DatabaseCore):
 
         self._basicquery(insert, (mod, subtype, stable, dtable))
         self._releasebasic()
+        self.notify_collection_change()
 
+    def notify_collection_change(self):
+        """ Tells anyone caching collection metadata that a collection
+            has been added or changed. The notification is delivered when
+            the current transaction is committed.
+        """
+        self._basicquery("NOTIFY %s" % (COLLECTION_CHANNEL))
+        self._releasebasic()
 
-    def clone_table(self, original, streamid, foreignkey=None):
+
+    def clone_table(self, original, streamid, foreignkey=None,
+            indexes=True):
         tablename = original + "_" + str(streamid)
 
+        if indexes:
+            including = "INCLUDING INDEXES "
+        else:
+            # build_deferred_indexes() will add them later
+            including = ""
+            self.deferredindexes.append((original, tablename))
+
         # LIKE can't copy foreign keys so we have to explicitly add the
         # one we really want
-        query = "CREATE TABLE %s (LIKE %s INCLUDING DEFAULTS INCLUDING INDEXES INCLUDING CONSTRAINTS" % (tablename, original)
+        query = "CREATE TABLE %s (LIKE %s INCLUDING DEFAULTS %sINCLUDING CONSTRAINTS" % (tablename, original, including)
         if foreignkey is not None:
             query += ", %s)" % (foreignkey)
         else:
@@ -631,6 +1327,37 @@ class DBInsert(DatabaseCore):
 
         self._streamsquery(query)
 
+    def build_deferred_indexes(self):
+        """ Creates the indexes that were left off any data tables that
+            were created while deferindexes was set, copying them from the
+            template data table.
+        """
+        query = """SELECT pg_get_indexdef(i.indexrelid) FROM pg_index i
+                JOIN pg_class c ON c.oid = i.indrelid WHERE c.relname = %s"""
+
+        templates = {}
+        for original, tablename in self.deferredindexes:
+            if original not in templates:
+                self._basicquery(query, (original,))
+                templates[original] = [r[0] for r in \
+                        self.basic.cursor.fetchall()]
+                self._releasebasic()
+
+            for indexdef in templates[original]:
+                # Leave the index name out so postgres picks a new one
+                match = INDEXDEF_REGEX.match(indexdef)
+                if match is None:
+                    log("Unable to copy index for %s: %s" % (tablename,
+                            indexdef))
+                    continue
+                self._basicquery("CREATE %sINDEX ON %s %s" % \
+                        (match.group(1) or "", tablename, match.group(3)))
+                self._releasebasic()
+
+        count = len(self.deferredindexes)
+        self.deferredindexes = []
+        return count
+
     def add_foreign_key(self, tablename, column, foreigntable, foreigncolumn):
         # XXX Only supports one column foreign keys for now
 
@@ -669,17 +1396,17 @@ class DBInsert(DatabaseCore):
         return
 
     def get_last_timestamp(self, table, streamid):
-        lastdict = self.streamcache.fetch_all_last_timestamps("postgres",
-                table)
+        lastdict = self.streamcache.fetch_last_timestamps("postgres",
+                table, [streamid])
 
         if streamid not in lastdict:
             # Nothing useful in cache, query data table for max timestamp
             # Warning, this isn't going to be fast so try to avoid doing
             # this wherever possible!
-            query = "SELECT max(timestamp) FROM %s_" % (table)
-            query += "%s"   # stream id goes in here
+            sql, params = self.stream_data_sql(table, [streamid])
+            query = "SELECT max(timestamp) FROM (%s) AS data" % (sql)
 
-            self._basicquery(query, (streamid,))
+            self._basicquery(query, params)
 
             if self.basic.cursor.rowcount != 1:
                 log("Unexpected number of results when querying for max timestamp: %d" % (self.basic.cursor.rowcount))
@@ -690,8 +1417,8 @@ class DBInsert(DatabaseCore):
                 return 0
 
             lastts = int(row[0])
-            lastdict[streamid] = lastts
-            self.streamcache.set_last_timestamps("postgres", table, lastdict)
+            self.streamcache.set_last_timestamps("postgres", table,
+                    {streamid:lastts})
 
             self._releasebasic()
         else:
@@ -739,23 +1466,35 @@ class DBInsert(DatabaseCore):
             values.append(v)
         colstr += ") "
 
+        if len(self.reservedids) > 0:
+            streamid = "%s"
+            values.insert(0, self.reservedids.pop(0))
+        else:
+            streamid = "nextval('streams_id_seq')"
+
         params = tuple(values)
         insert = "INSERT INTO %s " % (tablename)
         insert += colstr
-        insert += "VALUES (nextval('streams_id_seq'), %s)" % \
-                (",".join(["%s"] * len(values)))
+        insert += "VALUES (%s, %s)" % (streamid,
+                ",".join(["%s"] * len(streamprops)))
         insert += " RETURNING stream_id"
 
+        # The streams connection may have a message's worth of other work
+        # on it, which a duplicate stream shouldn't throw away
+        self.streams.savepoint(STREAM_SAVEPOINT)
         try:
             self._streamsquery(insert, params)
         except DBQueryException as e:
+            self.streams.rollback_savepoint(STREAM_SAVEPOINT)
             if e.code == DB_DUPLICATE_KEY:
                 return self.find_existing_stream(tablename, streamprops)
             else:
                 raise
 
-        # Grab the new stream ID so we can return it
+        # Grab the new stream ID so we can return it -- this has to happen
+        # before the savepoint is released, as that replaces the result
         newid = self.streams.cursor.fetchone()[0]
+        self.streams.release_savepoint(STREAM_SAVEPOINT)
 
         if createdatatable:
             dbkey = "postgres"
@@ -769,8 +1508,9 @@ class DBInsert(DatabaseCore):
 
         # Create a new data table for this stream, using the "base" data
         # table as a template
-        if createdatatable:
-            self.clone_table(datatable, newid)
+        if createdatatable and self.datalayout != "partitioned":
+            self.clone_table(datatable, newid,
+                    indexes=not self.deferindexes)
 
         # Resist the urge to commit streams or do any live exporting here!
         #
@@ -787,23 +1527,102 @@ class DBInsert(DatabaseCore):
         return newid
 
     def custom_insert(self, customsql, values):
-        self._dataquery(customsql, values)
-        result = self.data.cursor.fetchone()
+        self._messagequery(customsql, values)
+        result = self._messagecursor().cursor.fetchone()
         return result
 
+    def custom_insert_rows(self, customsql, values):
+        """ Like custom_insert(), but returns every row of the result """
+        self._messagequery(customsql, values)
+        return self._messagecursor().cursor.fetchall()
+
+    def custom_query(self, customsql, values=None):
+        """ Runs a query that doesn't return anything as part of the
+            current streams transaction, e.g. when changing the layout of
+            existing tables. Call commit_streams() to save the changes.
+        """
+        self._streamsquery(customsql, values)
+
+    def table_exists(self, name):
+        """ Returns True if a table with the given name exists """
+        self._basicquery("""SELECT * FROM pg_class c JOIN pg_namespace n ON
+                    n.oid = c.relnamespace WHERE c.relname = %s AND
+                    c.relkind = 'r' AND n.nspname = 'public'""", (name,))
+        exists = self.basic.cursor.rowcount != 0
+        self._releasebasic()
+        return exists
+
+    def row_format(self, tablename, columns, casts=None):
+        """ Compiles everything needed to write rows with the given columns
+            (a tuple of names) into a data table. Pass the result to
+            insert_row() along with a tuple of values in the same order as
+            the columns.
+
+            casts maps column names to the SQL type that their values
+            should be cast to when using INSERT.
+        """
+        if casts is None:
+            casts = {}
+
+        columns = tuple(columns)
+        return RowFormat(tablename, columns,
+                self._insert_format(columns, casts))
+
+    def insert_row(self, fmt, stream, ts, values):
+        """ Writes a row of values to the data table for a stream, using a
+            format from row_format(). Depending on the insert mode, the row
+            may be buffered until the end of the batch or the commit.
+        """
+        if self.insertmode == "copy":
+            self._buffer_row(fmt, stream, ts, values)
+            return
+
+        values = (stream, ts) + values
+
+        if self.batchrows is not None:
+            if self.datalayout == "partitioned":
+                # all streams go into the same table, so can share an INSERT
+                key = (fmt, None)
+            else:
+                key = (fmt, stream)
+            rows = self.batchrows.get(key)
+            if rows is None:
+                rows = []
+                self.batchrows[key] = rows
+            rows.append(values)
+            return
+
+        self._insert_rows(fmt, stream, [values])
+
     def insert_data(self, tablename, collection, stream, ts, result,
             casts=None):
+        """ Like insert_row(), but takes a dictionary mapping each column
+            name to its value. Use insert_row() instead where the columns
+            are always the same.
+        """
+        if casts is None:
+            casts = {}
+
+        columns = tuple(result)
+        key = (tablename, columns, tuple([casts.get(k) for k in columns]))
+        compiled = self.rowformats.get(key)
+        if compiled is None:
+            compiled = (self.row_format(tablename, columns, casts),
+                    row_getter(columns))
+            self.rowformats[key] = compiled
 
+        fmt, getter = compiled
+        self.insert_row(fmt, stream, ts, getter(result))
+
+    def _insert_format(self, columns, casts):
+        """ Returns the column list and value placeholders for an INSERT
+            of the given columns into a data table.
+        """
         colstr = "(stream_id, timestamp"
         valstr = "%s, %s"
-        values = [stream, ts]
 
-        if casts is None:
-            casts = {}
-
-        for k, v in result.iteritems():
+        for k in columns:
             colstr += ', "%s"' % (k)
-            values.append(v)
 
             if k in casts:
                 valstr += ", CAST(%s AS " + casts[k] + ")"
@@ -811,12 +1630,54 @@ class DBInsert(DatabaseCore):
                 valstr += ", %s"
         colstr += ") "
 
-        params = tuple(values)
-        insert = "INSERT INTO %s_%s " % (tablename, stream)
+        return (colstr, "(%s)" % (valstr))
+
+    def _insert_rows(self, fmt, stream, rows):
+        colstr, valstr = fmt.insert
+        params = tuple(itertools.chain.from_iterable(rows))
+
+        insert = "INSERT INTO %s " % (self.data_table(fmt.table, stream))
         insert += colstr
-        insert += "VALUES (%s)" % (valstr)
+        insert += "VALUES "
+        insert += ", ".join([valstr] * len(rows))
+
+        self._messagequery(insert, params)
+        self.rowswritten += len(rows)
 
-        self._dataquery(insert, params)
+    def _copy_format(self, fmt):
+        """ Returns the COPY column list and destination column types for a
+            row format, filling them in the first time that they are needed.
+        """
+        if fmt.copy is None:
+            coltypes = self._get_copy_coltypes(fmt.table)
+            copycols = ("stream_id", "timestamp") + \
+                    tuple(['"%s"' % (k) for k in fmt.columns])
+            udts = tuple([coltypes.get(k) for k in fmt.columns])
+            fmt.copy = (copycols, udts)
+        return fmt.copy
+
+    def _buffer_row(self, fmt, stream, ts, values):
+        # No casts required here -- COPY parses each value according to
+        # the type of the column it is being written into
+        copycols, udts = self._copy_format(fmt)
+
+        line = [str(stream), str(ts)]
+        line += map(copy_format_value, values, udts)
+
+        key = (self.data_table(fmt.table, stream), copycols)
+        if key not in self.copybuffers:
+            self.copybuffers[key] = []
+        self.copybuffers[key].append((self.messageid, "\t".join(line)))
+        if self.inmessage:
+            self.copyjournal.append(key)
+
+    def data_table(self, tablename, stream):
+        """ Returns the name of the table that the data for a stream is
+            written to.
+        """
+        if self.datalayout == "partitioned":
+            return tablename
+        return "%s_%s" % (tablename, stream)
 
     def _columns_sql(self, name, columns):
 
@@ -874,13 +1735,207 @@ class DBInsert(DatabaseCore):
         basesql += self._columns_sql(name, columns)
         basesql += ")"
 
+        if self.datalayout == "partitioned":
+            basesql += " PARTITION BY RANGE (timestamp)"
+
         self._basicquery(basesql)
         self._releasebasic()
 
+        if self.datalayout == "partitioned":
+            self._create_default_partition(name)
+            self.create_index("%s_%s_idx" % (name, "stream_ts"), name,
+                    ["stream_id", "timestamp"])
+            return
+
         # Automatically create an index on timestamp
         self.create_index("%s_%s_idx" % (name, "timestamp"), name,
                     ["timestamp"])
 
+    def _create_default_partition(self, name):
+        # Anything that doesn't fit in one of the time range partitions
+        # ends up here until maintain_partitions() finds a home for it
+        self._basicquery("CREATE TABLE IF NOT EXISTS %s_default PARTITION OF %s DEFAULT" % (name, name))
+        self._releasebasic()
+
+    def partition_data_table(self, name):
+        """ Replaces the template data table for a collection with an
+            empty partitioned data table, so that an existing database can
+            start using the partitioned data layout. The per-stream data
+            tables are left alone, see migrate_stream_data().
+
+            Returns False if the table is already partitioned.
+        """
+        self._basicquery("""SELECT relkind FROM pg_class c JOIN pg_namespace n
+                ON n.oid = c.relnamespace WHERE c.relname = %s AND
+                n.nspname = 'public'""", (name,))
+        row = self.basic.cursor.fetchone()
+        self._releasebasic()
+
+        if row is None:
+            log("Cannot partition %s: no such table" % (name))
+            raise DBQueryException(DB_CODING_ERROR)
+        if row[0] == 'p':
+            return False
+
+        # The template should never hold any data itself
+        self._basicquery("SELECT 1 FROM %s LIMIT 1" % (name))
+        empty = self.basic.cursor.rowcount == 0
+        self._releasebasic()
+        if not empty:
+            log("Cannot partition %s: the table is not empty" % (name))
+            raise DBQueryException(DB_DATA_ERROR)
+
+        query = """CREATE TABLE %s_partitioned (LIKE %s INCLUDING DEFAULTS
+                INCLUDING CONSTRAINTS) PARTITION BY RANGE (timestamp);
+                DROP TABLE %s;
+                ALTER TABLE %s_partitioned RENAME TO %s""" % (name, name,
+                name, name, name)
+        self._basicquery(query)
+        self._releasebasic()
+
+        self._create_default_partition(name)
+        self.create_index("%s_%s_idx" % (name, "stream_ts"), name,
+                ["stream_id", "timestamp"])
+        return True
+
+    def migrate_stream_data(self, name, stream):
+        """ Moves the rows from a stream's own data table into the
+            partitioned data table for its collection, and drops the old
+            table.
+
+            Each stream is moved in a single transaction, so an
+            interrupted migration can be safely run again.
+
+            Returns the number of rows moved, or None if the stream has
+            already been migrated.
+        """
+        oldtable = "%s_%s" % (name, stream)
+        if not self.table_exists(oldtable):
+            return None
+
+        self._basicquery("SELECT min(timestamp), max(timestamp) FROM %s" % \
+                (oldtable))
+        row = self.basic.cursor.fetchone()
+        self._releasebasic()
+
+        if row[0] is not None:
+            self.create_partitions(name, row[0], row[1])
+
+        # Don't rely on the columns being in the same order, the old table
+        # may have been altered since it was created
+        self._basicquery("""SELECT column_name FROM information_schema.columns
+                WHERE table_name = %s ORDER BY ordinal_position""",
+                (oldtable,))
+        columns = ", ".join(['"%s"' % (r[0]) for r in \
+                self.basic.cursor.fetchall()])
+        self._releasebasic()
+
+        try:
+            self._streamsquery("INSERT INTO %s (%s) SELECT %s FROM %s" % \
+                    (name, columns, columns, oldtable))
+            moved = self.streams.cursor.rowcount
+
+            # this also removes any foreign keys on the old table
+            self._streamsquery("DROP TABLE %s CASCADE" % (oldtable))
+            self.commit_streams()
+        except DBQueryException:
+            self.rollback_streams()
+            raise
+        return moved
+
+    def _load_partitions(self, name):
+        query = """SELECT c.relname FROM pg_inherits i JOIN pg_class c ON
+                c.oid = i.inhrelid JOIN pg_class p ON p.oid = i.inhparent
+                WHERE p.relname = %s"""
+
+        self._basicquery(query, (name,))
+        starts = set()
+        for row in self.basic.cursor.fetchall():
+            match = PARTITION_REGEX.match(row[0])
+            if match is not None and match.group(1) == name:
+                starts.add(int(match.group(2)))
+        self._releasebasic()
+
+        self.partitions[name] = starts
+        return starts
+
+    def create_partitions(self, name, start, end):
+        """ Makes sure that a partitioned data table has a partition for
+            every time period between start and end (inclusive). Any rows
+            for those periods that are sitting in the default partition are
+            moved into the new partitions.
+
+            Returns the number of partitions that were created.
+        """
+        starts = self.partitions.get(name)
+        if starts is None:
+            starts = self._load_partitions(name)
+
+        created = 0
+        period = int(start) - (int(start) % DATA_PARTITION_PERIOD)
+        while period <= end:
+            if period not in starts:
+                try:
+                    self._create_partition(name, period)
+                except DBQueryException:
+                    # someone else may have created it in the meantime,
+                    # so check again next time
+                    del self.partitions[name]
+                    raise
+                starts.add(period)
+                created += 1
+            period += DATA_PARTITION_PERIOD
+        return created
+
+    def _create_partition(self, name, start):
+        # Creating the partition and moving any matching rows out of the
+        # default partition must happen together, otherwise attaching the
+        # partition will fail. Don't hang around waiting for locks if the
+        # table is busy though, we can always try again later.
+        partition = "%s_p%d" % (name, start)
+        end = start + DATA_PARTITION_PERIOD
+        where = "timestamp >= %d AND timestamp < %d" % (start, end)
+
+        query = """SET LOCAL lock_timeout = '10s';
+                CREATE TABLE %s (LIKE %s INCLUDING DEFAULTS
+                INCLUDING CONSTRAINTS);
+                INSERT INTO %s SELECT * FROM %s_default WHERE %s;
+                DELETE FROM %s_default WHERE %s;
+                ALTER TABLE %s ATTACH PARTITION %s FOR VALUES FROM (%d)
+                TO (%d)""" % (partition, name, partition, name, where,
+                name, where, name, partition, start, end)
+
+        self._basicquery(query)
+        self._releasebasic()
+
+    def maintain_partitions(self, now=None):
+        """ Creates the partitions that every partitioned data table will
+            need in the near future, as well as partitions for any older
+            data that has ended up in the default partition (e.g. after
+            importing old results).
+
+            Returns the number of partitions that were created.
+        """
+        if now is None:
+            now = time.time()
+
+        self._basicquery("SELECT relname FROM pg_class WHERE relkind = 'p'")
+        tables = [r[0] for r in self.basic.cursor.fetchall()]
+        self._releasebasic()
+
+        created = 0
+        for name in tables:
+            created += self.create_partitions(name,
+                    now - DATA_PARTITION_PERIOD,
+                    now + DATA_PARTITION_PREMAKE * DATA_PARTITION_PERIOD)
+
+            self._basicquery("SELECT min(timestamp), max(timestamp) FROM %s_default" % (name))
+            row = self.basic.cursor.fetchone()
+            self._releasebasic()
+            if row[0] is not None:
+                created += self.create_partitions(name, row[0], row[1])
+        return created
+
     def create_streams_table(self, name, columns, uniquecols=None):
 
         basesql = "CREATE TABLE IF NOT EXISTS %s (" % (name)
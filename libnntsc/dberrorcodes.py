@@ -38,6 +38,16 @@ DB_DUPLICATE_KEY = -6
 DB_NO_CURSOR = -7
 DB_QUERY_TIMEOUT = -8
 DB_CQ_ERROR = -9
+DB_STREAM_PENDING = -10
+
+# Errors caused by the query itself (or the data in it) rather than the
+# state of the database connection, i.e. trying again is not going to help
+DB_QUERY_ERRORS = [DB_DATA_ERROR, DB_CODING_ERROR, DB_DUPLICATE_KEY,
+        DB_GENERIC_ERROR]
+
+# Errors caused by losing (or waiting too long for) the database, which
+# should go away by themselves if we try again later
+DB_CONNECTION_ERRORS = [DB_OPERATIONAL_ERROR, DB_QUERY_TIMEOUT, DB_NO_CURSOR]
 
 class DBQueryException(Exception):
     def __init__(self, code):
@@ -61,6 +71,8 @@ class DBQueryException(Exception):
             return "Could not execute query as had no valid cursor"
         if self.code == DB_CQ_ERROR:
             return "Attempted to modify a continuous query that doesn't exist"
+        if self.code == DB_STREAM_PENDING:
+            return "Data is for a stream that has been queued for creation"
         if self.code == DB_NO_ERROR:
             return "No error occurred, why are we getting this exception?"
         return "Unknown error code for DBQueryException: %d" % (self.code)
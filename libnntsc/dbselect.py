@@ -35,6 +35,8 @@ from libnntscclient.logger import *
 from libnntsc.parsers import amp_traceroute
 from libnntsc.querybuilder import QueryBuilder
 from libnntsc.database import DatabaseCore, NNTSCCursor
+from libnntsc.activityindex import stream_activity_index
+from libnntsc.metadatacache import collection_metadata_cache
 from libnntsc.influx import InfluxSelector
 from libnntsc.dberrorcodes import *
 
@@ -53,14 +55,30 @@ traceroute_tables = ['data_amp_traceroute', 'data_amp_astraceroute']
 
 class DBSelector(DatabaseCore):
     def __init__(self, uniqueid, dbname, dbuser=None, dbpass=None, dbhost=None,
-                 timeout=0, cachetime=0):
+                 timeout=0, cachetime=0, pathstorage="stream",
+                 datalayout="stream", cachebackend="memcache",
+                 cachepath=None, cacheslots=None):
 
         super(DBSelector, self).__init__(dbname, dbuser, dbpass, dbhost,
-                timeout, cachetime)
+                timeout, cachetime, datalayout, cachebackend, cachepath,
+                cacheslots)
 
         self.qb = QueryBuilder()
         self.dbselid = uniqueid
 
+        # Traceroute paths are either in per-stream tables or in the
+        # global path dictionaries, see the pathstorage config option
+        self.pathstorage = pathstorage
+
+        # Which streams have data for which time periods, so that we only
+        # query the data tables for streams that might have something.
+        # Shared with every other DBSelector in this process
+        self.activity = stream_activity_index()
+
+        # Tables and columns for each collection, shared with every other
+        # DBSelector in this process
+        self.metadata = collection_metadata_cache()
+
         # The datacursor is used for querying the time series data tables.
         # It is a named server-side cursor which means that the results
         # will be sent back to the DBSelector in small chunks as required.
@@ -118,25 +136,8 @@ class DBSelector(DatabaseCore):
             of column names from the data table.
         """
 
-        self._basicquery(
-                "SELECT streamtable, datatable from collections WHERE id=%s",
-                (colid,))
-
-        tables = self.basic.cursor.fetchone()
-
-        # Parameterised queries don't work on the FROM clause -- our table
-        # names *shouldn't* be an SQL injection risk, right?? XXX
-        self._basicquery(
-                    "SELECT * from %s LIMIT 1" % (tables['streamtable']))
-
-        streamcolnames = [cn[0] for cn in self.basic.cursor.description]
-
-        self._basicquery(
-                    "SELECT * from %s LIMIT 1" % (tables['datatable']))
-
-        datacolnames = [cn[0] for cn in self.basic.cursor.description]
-        self._releasebasic()
-        return streamcolnames, datacolnames
+        metadata = self._collection_metadata(colid)
+        return list(metadata['streamcolumns']), list(metadata['datacolumns'])
 
     def select_streams_by_collection(self, coll, minid):
         """ Fetches all streams that belong to a given collection id.
@@ -348,10 +349,12 @@ class DBSelector(DatabaseCore):
 
             influx_start = start_time
             # Fetch any available postgres data
-            pgstreams = []
-            for sid in streams:
-                if self._was_stream_active(table, sid, start_time, stop_time):
-                    pgstreams.append(sid)
+            try:
+                pgstreams = self._active_streams(table, streams, start_time,
+                        stop_time)
+            except DBQueryException as e:
+                yield(None, label, None, None, e)
+                continue
 
             if len(pgstreams) > 0:
                 self._generate_from(table, label, pgstreams, streamtable)
@@ -498,10 +501,12 @@ class DBSelector(DatabaseCore):
                 continue
 
             # Fetch any available postgres data
-            pgstreams = []
-            for sid in streams:
-                if self._was_stream_active(table, sid, start_time, stop_time):
-                    pgstreams.append(sid)
+            try:
+                pgstreams = self._active_streams(table, streams, start_time,
+                        stop_time)
+            except DBQueryException as e:
+                yield(None, label, None, None, e)
+                continue
 
             if len(pgstreams) > 0:
                 self._generate_from(table, label, pgstreams, streamtable)
@@ -531,36 +536,18 @@ class DBSelector(DatabaseCore):
                     selectcols, start_time, stop_time):
                 yield row
 
-    def _datatable_exists(self, table, sid):
-
-        query = """SELECT EXISTS ( SELECT 1 FROM pg_catalog.pg_class c
-                   WHERE c.relname = %s )"""
-        tname = table + "_" + str(sid)
-
-        try:
-            self._basicquery(query, (tname,))
-        except DBQueryException as e:
-            return False
-
-        row = self.basic.cursor.fetchone()
-        if row is None:
-            return False
-
-        result = row[0]
-        self._releasebasic()
-        return result
-
     def query_timestamp(self, table, sid, first_or_last):
 
-        tname = table + "_" + str(sid)
         if first_or_last == "max":
             default = time.time()
         else:
             default = time.time() - (7 * 24 * 60 * 60)
 
-        query = """SELECT %s(timestamp) FROM %s""" % (first_or_last, tname)
         try:
-            self._basicquery(query, (tname,))
+            sql, params = self.stream_data_sql(table, [sid])
+            query = """SELECT %s(timestamp) FROM (%s) AS data""" % \
+                    (first_or_last, sql)
+            self._basicquery(query, params)
         except DBQueryException as e:
             return default
 
@@ -573,44 +560,89 @@ class DBSelector(DatabaseCore):
         return result
 
 
-    def _was_stream_active(self, table, sid, start, end):
-
-        if not self._datatable_exists(table, sid):
-            return False
-
-        firststamps = self.streamcache.fetch_all_first_timestamps("postgres",
-            table)
-        laststamps = self.streamcache.fetch_all_last_timestamps("postgres",
-            table)
-
-        if sid not in firststamps:
-            firststamps[sid] = None
-        if firststamps[sid] is None:
-            f = self.query_timestamp(table, sid, "min")
-            if f != 0:
-                firststamps[sid] = f
-                self.streamcache.set_first_timestamps("postgres", table,
-                        firststamps)
-
-        if sid not in laststamps:
-            laststamps[sid] = None
-        if laststamps[sid] is None:
-            l = self.query_timestamp(table, sid, "max")
-            if l != 0:
-                laststamps[sid] = l
-                self.streamcache.set_last_timestamps("postgres", table,
-                        laststamps)
-
-        if firststamps[sid] is None or laststamps[sid] is None:
-            return False
-
-        if firststamps[sid] > end:
-            return False
-        if laststamps[sid] < start and laststamps[sid] < time.time() - 600:
-            return False
+    def _active_streams(self, table, streams, start, end):
+        """ Returns the streams from the given list that may have data in
+            the given data table between start and end.
+        """
+        now = time.time()
+        stale = self.activity.stale(table, streams, now)
+        if len(stale) > 0:
+            self._refresh_activity(table, list(set(stale)), now)
 
-        return True
+        return self.activity.active_streams(table, streams, start, end, now)
 
+    def _refresh_activity(self, table, streams, now):
+        """ Updates the activity index for a set of streams, using as few
+            queries as possible.
+        """
+        owntables = set(self.streams_with_tables(table, streams))
+        if self.datalayout == "partitioned":
+            exists = set(streams)
+        else:
+            exists = owntables
+
+        cached = [s for s in streams if s in exists]
+        firststamps = self.streamcache.fetch_first_timestamps("postgres",
+                table, cached)
+        laststamps = self.streamcache.fetch_last_timestamps("postgres",
+                table, cached)
+
+        missing = [s for s in cached if firststamps.get(s) is None or \
+                laststamps.get(s) is None]
+
+        if len(missing) > 0:
+            newfirst = {}
+            newlast = {}
+            for sid, first, last in self._query_stream_bounds(table, missing,
+                    owntables):
+                if firststamps.get(sid) is None and first is not None:
+                    newfirst[sid] = first
+                if laststamps.get(sid) is None and last is not None:
+                    newlast[sid] = last
+
+            # only write back the streams that we had to look up
+            self.streamcache.set_first_timestamps("postgres", table,
+                    newfirst)
+            self.streamcache.set_last_timestamps("postgres", table, newlast)
+            firststamps.update(newfirst)
+            laststamps.update(newlast)
+
+        for sid in streams:
+            self.activity.update(table, sid, sid in exists,
+                    firststamps.get(sid), laststamps.get(sid), now)
+
+    def _query_stream_bounds(self, table, streams, owntables):
+        """ Finds the first and last timestamps for a set of streams using
+            a single query.
+
+            Returns a list of (stream id, first, last) tuples.
+        """
+        parts = []
+        params = []
+        for sid in streams:
+            if self.datalayout != "partitioned":
+                source = "%s_" % (table)
+                source += "%s"      # stream id will go here
+                srcparams = [sid]
+            else:
+                source = "(SELECT timestamp FROM %s WHERE stream_id = " % \
+                        (table)
+                source += "%s"
+                srcparams = [sid]
+                if sid in owntables:
+                    source += " UNION ALL SELECT timestamp FROM %s_" % (table)
+                    source += "%s"
+                    srcparams.append(sid)
+                source += ") AS data"
+
+            parts.append("SELECT %%s, (SELECT min(timestamp) FROM %s), " \
+                    "(SELECT max(timestamp) FROM %s)" % (source, source))
+            params += [sid] + srcparams + srcparams
+
+        self._basicquery(" UNION ALL ".join(parts), params)
+        bounds = [(r[0], r[1], r[2]) for r in self.basic.cursor.fetchall()]
+        self._releasebasic()
+        return bounds
 
     def _generate_label_case(self, label, stream_ids):
         """ Forms a CASE statement for an SQL query that converts all stream
@@ -632,26 +664,16 @@ class DBSelector(DatabaseCore):
 
     def _generate_union(self, basetable, streams):
 
-        unionparams = []
-        sql = "("
-
-        for i in range(0, len(streams)):
-            unionparams.append(streams[i])
-            sql += "SELECT * FROM %s_" % (basetable)
-            sql += "%s"     # stream id will go here
-
-            if i != len(streams) - 1:
-                sql += " UNION ALL "
-
-        sql += ") AS dataunion"
+        datasql, unionparams = self.stream_data_sql(basetable, streams)
+        sql = "(" + datasql + ") AS dataunion"
         self.qb.add_clause("union", sql, unionparams)
 
 
     def _query_timestamp(self, datatable, sid, agg):
-        query = "SELECT %s(timestamp) FROM %s_" % (agg, datatable)
-        query += "%s"   # stream id goes in here
+        sql, params = self.stream_data_sql(datatable, [sid])
+        query = "SELECT %s(timestamp) FROM (%s) AS data" % (agg, sql)
 
-        self._basicquery(query, (sid,))
+        self._basicquery(query, params)
 
         if self.basic.cursor.rowcount == 0:
             row = [None]
@@ -718,7 +740,9 @@ class DBSelector(DatabaseCore):
         self.qb.add_clause("joincondition", joincond, [])
 
         if table in traceroute_tables:
-            amp_traceroute.generate_union(self.qb, table, uniquestreams)
+            amp_traceroute.generate_union(self.qb, table, uniquestreams,
+                    self.pathstorage == "global",
+                    self.stream_data_sql(table, uniquestreams))
         else:
             self._generate_union(table, uniquestreams)
 
@@ -735,37 +759,68 @@ class DBSelector(DatabaseCore):
             Returns a tuple containing three items:
              1. the name of the data table
              2. a list of columns present in the table
+             3. the name of the streams table
 
         """
+        metadata = self._collection_metadata(col)
+        return metadata['datatable'], list(metadata['datacolumns']), \
+                metadata['streamtable']
+
+    def _collection_metadata(self, col):
+        """ Returns a dictionary describing the tables for a collection,
+            fetching it from the database if it is not already cached.
+        """
+        self._check_collection_changes()
+
+        metadata = self.metadata.get(col)
+        if metadata is not None:
+            return metadata
+
+        generation = self.metadata.generation
+
         self._basicquery(
                     "SELECT * from collections where id=%s", (col,))
 
         assert(self.basic.cursor.rowcount == 1)
 
         coldata = self.basic.cursor.fetchone()
-        tname = coldata['datatable']
-        streamtname = coldata['streamtable']
-        module = coldata['module']
-        subtype = coldata['modsubtype']
-
-        table = tname
-
-        # This is the quickest way to get the column names -- don't
-        # try querying the data table itself because that could be slow
-        # if the table is, for example, a complicated view.
+        metadata = {
+            "datatable": coldata['datatable'],
+            "streamtable": coldata['streamtable'],
+            "module": coldata['module'],
+            "subtype": coldata['modsubtype'],
+            "datacolumns": [],
+            "streamcolumns": [],
+        }
+
+        # Get the column names for both tables from the catalog in one go
+        # -- don't try querying the data table itself because that could
+        # be slow if the table is, for example, a complicated view. Avoid
+        # information_schema too, which is very slow once there are a lot
+        # of tables.
         self._basicquery(
-                "SELECT * from information_schema.columns WHERE table_name=%s",
-                (tname,))
+                """SELECT c.relname, a.attname FROM pg_attribute a
+                JOIN pg_class c ON a.attrelid = c.oid
+                WHERE c.relname IN (%s, %s) AND pg_table_is_visible(c.oid)
+                AND a.attnum > 0 AND NOT a.attisdropped
+                ORDER BY a.attnum""",
+                (metadata['datatable'], metadata['streamtable']))
+
+        for row in self.basic.cursor.fetchall():
+            if row['relname'] == metadata['datatable']:
+                metadata['datacolumns'].append(row['attname'])
+            if row['relname'] == metadata['streamtable']:
+                metadata['streamcolumns'].append(row['attname'])
+        self._releasebasic()
 
-        columns = []
-        while True:
-            row = self.basic.cursor.fetchone()
-            if row is None:
-                break
+        self.metadata.put(col, metadata, generation)
+        return metadata
 
-            columns.append(row['column_name'])
-        self._releasebasic()
-        return table, columns, streamtname
+    def _check_collection_changes(self):
+        """ Empties the collection metadata cache if any collections have
+            changed since we last checked.
+        """
+        self.metadata.check_changes(self.connstr)
 
     def _sanitise_columns(self, table, columns, selcols):
         """ Removes columns from the provided list if they are not present
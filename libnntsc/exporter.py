@@ -690,7 +690,12 @@ class DBWorker(threading.Thread):
         self.db = DBSelector(self.threadid, self.dbconf["name"],
                 self.dbconf["user"],
                 self.dbconf["pass"], self.dbconf["host"], self.timeout,
-                cachetime=self.dbconf["cachetime"])
+                cachetime=self.dbconf["cachetime"],
+                pathstorage=self.dbconf["pathstorage"],
+                datalayout=self.dbconf["datalayout"],
+                cachebackend=self.dbconf["cachebackend"],
+                cachepath=self.dbconf["cachepath"],
+                cacheslots=self.dbconf["cacheslots"])
         self.db.connect_db(30)
 
     def _connect_influx(self):
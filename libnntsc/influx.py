@@ -30,15 +30,20 @@
 #
 
 
-from requests import ConnectionError
+from requests import ConnectionError, Timeout
 import requests
 import math
+import time
+import zlib
 
 from influxdb import InfluxDBClient
 from influxdb.exceptions import InfluxDBClientError, InfluxDBServerError
 from libnntsc.dberrorcodes import *
 from libnntsc.querybuilder import QueryBuilder
 from libnntsc.cqs import getMatrixCQ, get_parser
+from libnntsc.packedarray import PACKED_FIELDS, pack_array, unpack_array
+from libnntsc.packedarray import is_packed
+from libnntsc.rollups import MatrixRollups
 import libnntscclient.logger as logger
 
 DEFAULT_RP = "nntscdefault"
@@ -46,6 +51,27 @@ OLD_DEFAULT_RP = "default"
 MATRIX_LONG_RP = "matrixlong"
 MATRIX_SHORT_RP = "matrixshort"
 
+# Data is sent to influx in chunks of at most this many bytes of line
+# protocol (before compression)
+INFLUX_CHUNK_SIZE = 2 * 1024 * 1024
+
+# How many times to try sending a chunk again if influx can't be reached
+INFLUX_WRITE_RETRIES = 3
+
+# Speed matters more than size when compressing the chunks
+INFLUX_COMPRESS_LEVEL = 1
+
+# The matrix bins maintained by NNTSC: bin size, how long each bin accepts
+# late data for, measurement suffix and retention policy
+MATRIX_BINS = [
+    (60, 15 * 60, "_matrix_short", MATRIX_SHORT_RP),
+    (60 * 60, 3 * 60 * 60, "_matrix_day", MATRIX_LONG_RP),
+]
+
+# The raw data used to fill the open matrix bins at startup is fetched in
+# slices of this many seconds, so that no single query returns too much
+SEED_CHUNK_SIZE = 5 * 60
+
 
 requests.packages.urllib3.disable_warnings()
 
@@ -70,6 +96,12 @@ class InfluxConnection(object):
         if timeout == 0:
             timeout = None
 
+        self.dbhost = dbhost
+        self.dbport = dbport
+        self.dbuser = dbuser
+        self.dbpass = dbpass
+        self.timeout = timeout
+
         try:
             self.client = InfluxDBClient(
                 dbhost, dbport, dbuser, dbpass, self.dbname, timeout=timeout)
@@ -107,15 +139,83 @@ class InfluxConnection(object):
         except Exception as e:
             raise e
 
+def _escape_name(name):
+    """Escapes a measurement, tag or field name for line protocol"""
+    return str(name).replace(",", "\\,").replace("=", "\\=").replace(" ",
+            "\\ ")
+
+def _field_value(value):
+    """
+    Formats a field value for line protocol, following the same rules as
+    InfluxDBClient.write_points(). Returns None if the field should be left
+    out, e.g. because the value is None.
+    """
+    if value is None:
+        return None
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, (int, long)):
+        return "%di" % (value)
+    if isinstance(value, float):
+        # influx can't store these, so leave them out rather than having
+        # the whole chunk rejected
+        if math.isnan(value) or math.isinf(value):
+            return None
+        return repr(value)
+    if isinstance(value, unicode):
+        value = value.encode("utf-8")
+    else:
+        value = str(value)
+    if value == "":
+        return None
+    return '"%s"' % (value.replace("\\", "\\\\").replace('"', '\\"'))
+
+def make_line(measurement, stream, ts, fields):
+    """
+    Serialises a single row as a line of influx line protocol, with a
+    timestamp in seconds. Returns None if the row has no fields to write.
+    """
+    values = []
+    for key in sorted(fields):
+        value = _field_value(fields[key])
+        if value is not None:
+            values.append("%s=%s" % (_escape_name(key), value))
+
+    if len(values) == 0:
+        return None
+
+    return "%s,stream=%s %s %d" % (_escape_name(measurement),
+            _escape_name(stream), ",".join(values), int(ts))
+
 class InfluxInsertor(InfluxConnection):
     """
     A class for inserting data into the influx database
+
+    Rows are converted to line protocol as they are inserted, then written
+    directly to the influx HTTP API in compressed chunks rather than via
+    InfluxDBClient.write_points().
     """
     def __init__(self, dbname, user, password, host, port, timeout=None):
         super(InfluxInsertor, self).__init__(dbname, user, password, host, port, timeout)
         self.to_write = []
+        self.messagestart = None
+        self.rowswritten = 0
         self.default_rp = DEFAULT_RP
 
+        # rows that need to be added to the matrix rollups once they have
+        # been written
+        self.rollups = MatrixRollups(MATRIX_BINS)
+        self.to_rollup = []
+
+        # a persistent session, so that the connection to influx is reused
+        # for every chunk
+        self.writeurl = "http://%s:%s/write" % (self.dbhost, self.dbport)
+        self.session = requests.Session()
+        self.session.headers.update({"Content-Encoding": "gzip",
+                "Content-Type": "application/octet-stream"})
+        if self.dbuser is not None:
+            self.session.auth = (self.dbuser, self.dbpass)
+
         # old installations are still using the retention policy named
         # "default", and changing policy will cause a break in the data.
         # Just let them keep using it for now.
@@ -131,78 +231,220 @@ class InfluxInsertor(InfluxConnection):
 
     def commit_data(self, retention_policy=None):
         """Send all data that has been observed"""
+        self.commit_pending(self.take_pending(), retention_policy)
+
+    def take_pending(self):
+        """Remove and return all of the points waiting to be written"""
+        points = (self.to_write, self.to_rollup)
+        self.to_write = []
+        self.to_rollup = []
+        return points
+
+    def commit_pending(self, points, retention_policy=None):
+        """Send a set of points returned by take_pending()"""
+        lines, observations = points
+        self._write_lines(lines, retention_policy)
+
+        # only count rows towards the rollups once they are safely written,
+        # otherwise they might be counted twice if they are sent again
+        if len(observations) > 0:
+            self.rollups.add(observations)
+        if self.rollups.flush_due():
+            self.flush_rollups()
+
+    def add_matrix_rollups(self, table, aggcols):
+        """
+        Starts maintaining the matrix aggregates for a table as its data is
+        inserted. aggcols is a list of (column, function, label) tuples.
+        """
+        self.rollups.add_definitions(table, aggcols)
+
+    def seed_rollups(self, now=None):
+        """
+        Fills the open matrix bins using the raw data that is already in
+        influx, so that bins that were partly written before NNTSC was
+        restarted aren't replaced by ones missing the older data.
+
+        Only the tables that have matrix rollups are seeded, i.e. those
+        for the tests this process handles. The data is fetched a few
+        minutes at a time. If a table can't be seeded, none of its bins
+        that were already open are written, rather than writing them
+        without the older data.
+        """
+        if now is None:
+            now = int(time.time())
+        since = now - self.rollups.maxwindow
+
+        for table, columns in self.rollups.columns.iteritems():
+            fields = ", ".join(['"{}"'.format(c) for c in columns])
+            try:
+                for start in xrange(since, now + 1, SEED_CHUNK_SIZE):
+                    querystring = 'SELECT {0} FROM {1} WHERE time >= {2}s AND time < {3}s GROUP BY stream'.format(
+                            fields, table, start, start + SEED_CHUNK_SIZE)
+                    results = self.query(querystring)
+
+                    observations = []
+                    for (series, tags), points in results.items():
+                        for point in points:
+                            observations.append((table, int(tags["stream"]),
+                                    point["time"], point))
+
+                    # these bins don't need writing again until they change
+                    self.rollups.add(observations, now, dirty=False)
+            except DBQueryException as e:
+                logger.log("Failed to fill the open matrix bins for %s: %s" \
+                        % (table, e))
+                logger.log("Matrix bins for %s that started before now will not be updated" % (table))
+                self.rollups.discard_before(table, now)
+
+    def flush_rollups(self):
+        """Write any matrix bins that have changed since the last flush"""
+        rows, keys = self.rollups.take_rows()
+        try:
+            for rp, binned in rows.iteritems():
+                lines = [make_line(*row) for row in binned]
+                self._write_lines([l for l in lines if l is not None], rp)
+        except DBQueryException:
+            # the raw data has been written, so there's no need to fail
+            # the whole batch, just try these bins again later
+            logger.log("Failed to write matrix rollups, will try again")
+            self.rollups.mark_dirty(keys)
+
+    def _write_lines(self, lines, retention_policy=None):
+        """
+        Sends lines of line protocol to influx, split into chunks of at
+        most INFLUX_CHUNK_SIZE bytes. If a chunk fails, only that chunk is
+        sent again. Influx overwrites points with the same series and time,
+        so writing a chunk more than once is harmless.
+        """
         if retention_policy is None:
             retention_policy = self.default_rp
-        try:
-            self.client.write_points(self.to_write, time_precision="s",
-                                     retention_policy=retention_policy)
-            self.to_write = []
-        except Exception as e:
-            self.handler(e)
+
+        chunk = []
+        size = 0
+        for line in lines:
+            if size + len(line) > INFLUX_CHUNK_SIZE and len(chunk) > 0:
+                self._write_chunk(chunk, retention_policy)
+                chunk = []
+                size = 0
+            chunk.append(line)
+            size += len(line) + 1
+
+        if len(chunk) > 0:
+            self._write_chunk(chunk, retention_policy)
+
+    def _write_chunk(self, chunk, retention_policy):
+        compressor = zlib.compressobj(INFLUX_COMPRESS_LEVEL, zlib.DEFLATED,
+                16 + zlib.MAX_WBITS)
+        body = compressor.compress("\n".join(chunk)) + compressor.flush()
+        params = {"db": self.dbname, "precision": "s",
+                "rp": retention_policy}
+
+        attempts = 0
+        while True:
+            try:
+                resp = self.session.post(self.writeurl, params=params,
+                        data=body, timeout=self.timeout)
+            except (ConnectionError, Timeout) as e:
+                error = str(e)
+            else:
+                if resp.status_code == 204:
+                    break
+
+                # the data itself was bad, sending it again won't help
+                if 400 <= resp.status_code < 500:
+                    logger.log("Influx rejected %d rows: %s" % (len(chunk),
+                            resp.text.strip()))
+                    raise DBQueryException(DB_GENERIC_ERROR)
+                error = "%d %s" % (resp.status_code, resp.text.strip())
+
+            attempts += 1
+            if attempts > INFLUX_WRITE_RETRIES:
+                logger.log("Failed to write %d rows to influx: %s" % \
+                        (len(chunk), error))
+                raise DBQueryException(DB_QUERY_TIMEOUT)
+
+            logger.log("Error writing to influx (%s), retrying" % (error))
+            time.sleep(attempts)
+
+        self.rowswritten += len(chunk)
+
+    def begin_message(self):
+        """Remember where the points for the current message start"""
+        self.messagestart = (len(self.to_write), len(self.to_rollup))
+
+    def end_message(self):
+        self.messagestart = None
+
+    def abort_message(self):
+        """Forget any points added since begin_message() was called"""
+        if self.messagestart is not None:
+            del self.to_write[self.messagestart[0]:]
+            del self.to_rollup[self.messagestart[1]:]
+        self.messagestart = None
 
     def insert_data(self, tablename, stream, ts, result, casts=None):
         """Prepare data for sending to database"""
         if casts:
+            # don't change the row itself, it may be exported to live
+            # clients afterwards
+            result = dict(result)
             for cast in casts:
                 if cast in result.keys():
                     result[cast] = casts[cast](result[cast])
-        self.to_write.append(
-            {
-                "measurement": tablename,
-                "tags":{
-                    "stream": stream
-                },
-                "time":ts,
-                "fields": result
-            }
-        )
-
-    def create_matrix_cq(self, aggcols, measurement):
-        daycqname = measurement + "_matrix_day"
-        shortcqname = measurement + "_matrix_short"
-        aggstring = ",".join(
-                ["{}({}) AS {}".format(cq[1], cq[0], cq[2]) for cq in aggcols])
-
-        aggstring = ""
-        countcols = []
-        for cq in aggcols:
-            if aggstring != "":
-                aggstring += ", "
-
-            aggstring += "{}({}) AS {}".format(cq[1], cq[0], cq[2])
-            if cq[0] not in countcols:
-                countcols.append(cq[0])
-                aggstring += ", count({}) AS magiccount_{}".format(cq[0], cq[0].replace('"', ''))
 
-        try:
-            query = """ DROP CONTINUOUS QUERY {0} ON {1}
-                    """.format(daycqname, self.dbname)
-            self.query(query)
-        except DBQueryException as e:
-            if e.code != DB_CQ_ERROR:
-                raise
+        line = make_line(tablename, stream, ts, result)
+        if line is not None:
+            self.to_write.append(line)
 
-        try:
-            query = """ DROP CONTINUOUS QUERY {0} ON {1}
-                    """.format(shortcqname, self.dbname)
-            self.query(query)
-        except DBQueryException as e:
-            if e.code != DB_CQ_ERROR:
-                raise
+        if self.rollups.wants(tablename):
+            self.to_rollup.append((tablename, stream, ts, result))
 
-        query = """
-            CREATE CONTINUOUS QUERY {0} ON {1} RESAMPLE EVERY 1h FOR 3h BEGIN
-            SELECT {2} INTO "{3}".{0} FROM {4} GROUP BY stream,time(1h) END
-            """.format(daycqname, self.dbname, aggstring, "matrixlong",
-                    measurement)
-        self.query(query)
+    def repack_arrays(self, table, field, start, end):
+        """
+        Rewrites the values of an array field between start and end that
+        were stored as the str() of the array, so that they use the packed
+        encoding instead. Points that are already packed are left alone.
 
-        query = """
-            CREATE CONTINUOUS QUERY {0} ON {1} RESAMPLE EVERY 1m FOR 15m BEGIN
-            SELECT {2} INTO "{3}".{0} FROM {4} GROUP BY stream,time(1m) END
-            """.format(shortcqname, self.dbname, aggstring, "matrixshort",
-                    measurement)
-        self.query(query)
+        Returns the number of points that were rewritten.
+        """
+        querystring = 'SELECT "{0}" FROM {1} WHERE time >= {2}s AND time < {3}s GROUP BY stream'.format(
+                field, table, start, end)
+        results = self.query(querystring)
+
+        count = 0
+        for (series, tags), points in results.items():
+            for point in points:
+                value = point[field]
+                if value is None or is_packed(value):
+                    continue
+                array = unpack_array(value)
+                if not isinstance(array, list):
+                    continue
+
+                # writing the same series and time again replaces the value
+                line = make_line(table, tags["stream"], point["time"],
+                        {field: pack_array(array)})
+                self.to_write.append(line)
+                count += 1
+
+        self.commit_data()
+        return count
+
+    def drop_matrix_cq(self, measurement):
+        """
+        Removes the continuous queries that used to build the matrix
+        aggregates for a measurement, now that NNTSC maintains them itself
+        as data is inserted.
+        """
+        for suffix in ["_matrix_day", "_matrix_short"]:
+            try:
+                query = """ DROP CONTINUOUS QUERY {0} ON {1}
+                        """.format(measurement + suffix, self.dbname)
+                self.query(query)
+            except DBQueryException as e:
+                if e.code != DB_CQ_ERROR:
+                    raise
 
     def get_last_timestamp(self, table, sid):
 
@@ -363,6 +605,9 @@ class InfluxSelector(InfluxConnection):
             rows = []
             for (table, tags), results in results.items():
                 for result in results:
+                    for field in PACKED_FIELDS:
+                        if field in result:
+                            result[field] = unpack_array(result[field])
                     result["nntsclabel"] = label
                     result["timestamp"] = result["time"]
                     del result["time"]
@@ -689,6 +934,12 @@ class InfluxSelector(InfluxConnection):
         Fixes up the result to be ready to send by packing up any \
         smoke arrays and removing unwanted empty results
         """
+        # Arrays are stored packed, so unpack any that were selected
+        for meas, agg in self.aggcols:
+            label = self._get_label(meas, agg)
+            if meas in PACKED_FIELDS and label in result:
+                result[label] = unpack_array(result[label])
+
         # Pack up the smoke array to be sent back
         aggs = [k[1] for k in self.aggcols]
 
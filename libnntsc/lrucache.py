@@ -0,0 +1,147 @@
+#
+# This file is part of NNTSC.
+#
+# Copyright (C) 2013-2017 The University of Waikato, Hamilton, New Zealand.
+#
+# Authors: Shane Alcock
+#          Brendon Jones
+#
+# All rights reserved.
+#
+# This code has been developed by the WAND Network Research Group at the
+# University of Waikato. For further information please see
+# http://www.wand.net.nz/
+#
+# NNTSC is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# NNTSC is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with NNTSC; if not, write to the Free Software Foundation, Inc.
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+#
+# Please report any bugs, questions or comments to contact@wand.net.nz
+#
+
+
+import time
+from collections import OrderedDict
+
+class LRUCache(object):
+    """ A dictionary with a maximum size. Once it is full, adding a new
+        item removes whichever item was least recently looked up or added.
+
+        Lookups made with get() are counted, so that callers can report
+        how effective the cache is.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.items = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def get(self, key, default=None):
+        """ Returns the value for a key, marking it as recently used, or
+            default if the key is not in the cache.
+        """
+        try:
+            value = self.items.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+
+        self.items[key] = value
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        if key in self.items:
+            del self.items[key]
+        elif len(self.items) >= self.maxsize:
+            self.items.popitem(last=False)
+            self.evictions += 1
+        self.items[key] = value
+
+    def update(self, other):
+        for key, value in other.iteritems():
+            self.put(key, value)
+
+    def clear(self):
+        self.items.clear()
+
+    def stats(self):
+        """ Returns a dictionary describing the size of the cache and how
+            many lookups have hit or missed it so far.
+        """
+        return {"size":len(self.items), "maxsize":self.maxsize,
+                "hits":self.hits, "misses":self.misses,
+                "evictions":self.evictions}
+
+    def describe(self):
+        lookups = self.hits + self.misses
+        if lookups > 0:
+            hitrate = 100.0 * self.hits / lookups
+        else:
+            hitrate = 0.0
+        return "%d/%d entries, %d hits, %d misses (%.1f%% hit rate), " \
+                "%d evictions" % (len(self.items), self.maxsize, self.hits,
+                self.misses, hitrate, self.evictions)
+
+class ExpiringLRUCache(LRUCache):
+    """ An LRUCache where each item is also forgotten once it has been in
+        the cache for longer than a fixed time (in seconds). Looking up an
+        expired item counts as a miss.
+    """
+
+    def __init__(self, maxsize, ttl):
+        super(ExpiringLRUCache, self).__init__(maxsize)
+        self.ttl = ttl
+        self.expirations = 0
+
+    def get(self, key, default=None, now=None):
+        try:
+            value, expires = self.items.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+
+        if now is None:
+            now = time.time()
+        if expires <= now:
+            self.misses += 1
+            self.expirations += 1
+            return default
+
+        self.items[key] = (value, expires)
+        self.hits += 1
+        return value
+
+    def put(self, key, value, now=None):
+        if now is None:
+            now = time.time()
+        super(ExpiringLRUCache, self).put(key, (value, now + self.ttl))
+
+    def stats(self):
+        stats = super(ExpiringLRUCache, self).stats()
+        stats["expirations"] = self.expirations
+        return stats
+
+    def describe(self):
+        return "%s, %d expired" % (super(ExpiringLRUCache, self).describe(),
+                self.expirations)
+
+# vim: set sw=4 tabstop=4 softtabstop=4 expandtab :
@@ -0,0 +1,169 @@
+#
+# This file is part of NNTSC.
+#
+# Copyright (C) 2013-2017 The University of Waikato, Hamilton, New Zealand.
+#
+# Authors: Shane Alcock
+#          Brendon Jones
+#
+# All rights reserved.
+#
+# This code has been developed by the WAND Network Research Group at the
+# University of Waikato. For further information please see
+# http://www.wand.net.nz/
+#
+# NNTSC is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# NNTSC is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with NNTSC; if not, write to the Free Software Foundation, Inc.
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+#
+# Please report any bugs, questions or comments to contact@wand.net.nz
+#
+""" A process-wide cache of collection metadata for DBSelector.
+
+    Every data request needs the data table, stream table and columns for
+    the requested collection. These hardly ever change, but looking them
+    up means querying the collections table and the system catalogs, which
+    get slow once there are a lot of tables. The cache is shared by every
+    DBSelector in the process (i.e. all of the exporter's DBWorkers).
+
+    Anything that changes a collection sends a notification on
+    COLLECTION_CHANNEL. The cache listens for it on a connection of its
+    own that stays open for the life of the process, because DBSelectors
+    (and their connections) only last for a single request, and empties
+    itself when one arrives.
+"""
+
+import time
+import threading
+import psycopg2
+
+from libnntscclient.logger import *
+
+# Postgresql NOTIFY channel used to announce changes to the collections
+COLLECTION_CHANNEL = "nntsc_collections"
+
+# How long (in seconds) metadata is trusted for, in case a change was made
+# without a notification (e.g. by hand)
+METADATA_CACHE_TTL = 600
+
+class CollectionMetadataCache(object):
+    def __init__(self, ttl=METADATA_CACHE_TTL):
+        self.ttl = ttl
+        self.collections = {}
+        self.lock = threading.Lock()
+
+        # Incremented whenever the cache is emptied, so that metadata
+        # fetched before a change can't be stored after it
+        self.generation = 0
+
+        # The connection that we are listening for collection changes on
+        self.listenconn = None
+        self.listenlock = threading.Lock()
+
+    def get(self, colid, now=None):
+        """ Returns the metadata for a collection, or None if it is not
+            cached.
+        """
+        if now is None:
+            now = time.time()
+        with self.lock:
+            entry = self.collections.get(colid)
+            if entry is None:
+                return None
+            if entry[1] <= now:
+                del self.collections[colid]
+                return None
+            return entry[0]
+
+    def put(self, colid, metadata, generation, now=None):
+        """ Stores the metadata for a collection, unless the cache has been
+            emptied since the given generation.
+        """
+        if now is None:
+            now = time.time()
+        with self.lock:
+            if generation != self.generation:
+                return
+            self.collections[colid] = (metadata, now + self.ttl)
+
+    def invalidate(self):
+        """ Empties the cache """
+        with self.lock:
+            self.collections = {}
+            self.generation += 1
+
+    def check_changes(self, connstr):
+        """ Empties the cache if any collections have changed since the
+            last check.
+
+            Notifications are delivered to the listening connection in the
+            background, so checking for them doesn't need a round trip to
+            the database. The connection is only made the first time this
+            is called (or after it has been lost), using connstr.
+        """
+        with self.listenlock:
+            if self.listenconn is None:
+                self._listen(connstr)
+                return
+
+            try:
+                self.listenconn.poll()
+            except psycopg2.Error as e:
+                # We may miss notifications until we're listening again
+                log("Lost the connection for collection changes: %s" % (e))
+                self._close_listen()
+                self.invalidate()
+                return
+
+            if len(self.listenconn.notifies) > 0:
+                del self.listenconn.notifies[:]
+                self.invalidate()
+
+    def _listen(self, connstr):
+        try:
+            conn = psycopg2.connect(connstr)
+            conn.autocommit = True
+            cursor = conn.cursor()
+            cursor.execute("LISTEN %s" % (COLLECTION_CHANNEL))
+            cursor.close()
+        except psycopg2.Error as e:
+            # Without notifications, nothing cached can be trusted
+            log("Unable to listen for collection changes: %s" % (e))
+            self.invalidate()
+            return
+
+        self.listenconn = conn
+
+        # Anything could have changed while nobody was listening
+        self.invalidate()
+
+    def _close_listen(self):
+        try:
+            self.listenconn.close()
+        except psycopg2.Error:
+            pass
+        self.listenconn = None
+
+_metadatacache = None
+_metadatacache_lock = threading.Lock()
+
+def collection_metadata_cache():
+    """ Returns the collection metadata cache for this process, creating it
+        the first time this is called.
+    """
+    global _metadatacache
+    with _metadatacache_lock:
+        if _metadatacache is None:
+            _metadatacache = CollectionMetadataCache()
+        return _metadatacache
+
+# vim: set sw=4 tabstop=4 softtabstop=4 expandtab :
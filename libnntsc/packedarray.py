@@ -0,0 +1,155 @@
+#
+# This file is part of NNTSC.
+#
+# Copyright (C) 2013-2017 The University of Waikato, Hamilton, New Zealand.
+#
+# Authors: Shane Alcock
+#          Brendon Jones
+#
+# All rights reserved.
+#
+# This code has been developed by the WAND Network Research Group at the
+# University of Waikato. For further information please see
+# http://www.wand.net.nz/
+#
+# NNTSC is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# NNTSC is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with NNTSC; if not, write to the Free Software Foundation, Inc.
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+#
+# Please report any bugs, questions or comments to contact@wand.net.nz
+#
+
+
+""" Compact string encodings for the array fields (e.g. the rtts for an
+    icmp stream) that are stored in influx, which has no array type.
+
+    Arrays of integers are delta encoded as zigzag varints, which suits the
+    sorted rtts well, while any other arrays are packed as doubles. Either
+    way the result is base64 encoded and prefixed with a character saying
+    which encoding was used. Missing values (None) are preserved.
+
+    Older points stored the str() of the array instead, these are still
+    understood by unpack_array().
+"""
+
+import ast
+import base64
+import math
+import struct
+
+INT_ARRAY = "i"
+FLOAT_ARRAY = "d"
+
+# Fields that are stored as packed arrays in influx
+PACKED_FIELDS = ["rtts", "pings", "percentiles"]
+
+def _is_integer(value):
+    return isinstance(value, (int, long)) and not isinstance(value, bool)
+
+def _pack_integers(values):
+    out = []
+    prev = 0
+    for v in values:
+        # 0 is reserved for missing values, so everything else is offset
+        # by one
+        if v is None:
+            out.append("\x00")
+            continue
+
+        delta = v - prev
+        prev = v
+        if delta >= 0:
+            n = (delta << 1) + 1
+        else:
+            n = ((-delta) << 1)
+
+        while n > 0x7f:
+            out.append(chr((n & 0x7f) | 0x80))
+            n >>= 7
+        out.append(chr(n))
+
+    return "".join(out)
+
+def _unpack_integers(packed):
+    values = []
+    prev = 0
+    n = 0
+    shift = 0
+    for c in packed:
+        b = ord(c)
+        n |= (b & 0x7f) << shift
+        if b & 0x80:
+            shift += 7
+            continue
+
+        if n == 0:
+            values.append(None)
+        else:
+            # even numbers were positive deltas, odd numbers negative
+            n -= 1
+            if n & 1:
+                prev -= (n + 1) >> 1
+            else:
+                prev += n >> 1
+            values.append(prev)
+        n = 0
+        shift = 0
+
+    return values
+
+def pack_array(values):
+    """ Encodes a list of numbers as a compact string, returning None if
+        there is no list.
+    """
+    if values is None:
+        return None
+
+    if all(v is None or _is_integer(v) for v in values):
+        return INT_ARRAY + base64.b64encode(_pack_integers(values))
+
+    doubles = [float('nan') if v is None else float(v) for v in values]
+    return FLOAT_ARRAY + base64.b64encode(struct.pack("<%dd" % \
+            (len(doubles)), *doubles))
+
+def unpack_array(packed):
+    """ Decodes a string created by pack_array(), or the str() of a list
+        written by an older version of NNTSC, back into a list. Anything
+        else is returned unchanged.
+    """
+    if not isinstance(packed, basestring) or packed == "":
+        return packed
+
+    if packed[0] == INT_ARRAY:
+        return _unpack_integers(base64.b64decode(packed[1:]))
+
+    if packed[0] == FLOAT_ARRAY:
+        raw = base64.b64decode(packed[1:])
+        doubles = struct.unpack("<%dd" % (len(raw) // 8), raw)
+        return [None if math.isnan(d) else d for d in doubles]
+
+    if packed == "None":
+        return None
+
+    if packed[0] == "[":
+        try:
+            return ast.literal_eval(packed)
+        except (ValueError, SyntaxError):
+            return packed
+
+    return packed
+
+def is_packed(value):
+    """ Returns True if a stored value is already using a packed encoding """
+    return isinstance(value, basestring) and value != "" and \
+            value[0] in [INT_ARRAY, FLOAT_ARRAY]
+
+# vim: set sw=4 tabstop=4 softtabstop=4 expandtab :
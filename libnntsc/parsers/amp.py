@@ -29,15 +29,29 @@
 #
 
 
+import os
 import sys
+import time
 import signal
 import logging
+import zlib
+import Queue as StdQueue
+from multiprocessing import Process, Queue, Value, Pool
 
-from libnntsc.database import DBInsert
+from libnntsc.database import DBInsert, DATA_PARTITION_CHECK_FREQ
 from libnntsc.influx import InfluxInsertor
 from libnntsc.configurator import *
-from libnntsc.pikaqueue import PikaConsumer, initExportPublisher
+from libnntsc.pikaqueue import PikaConsumer, PikaPubBuffer, \
+        initExportPublisher
+from libnntsc.sharding import ShardDispatcher, consume_shard
+from libnntsc.batching import BatchController, BATCH_FLUSH_SIZE, \
+        BATCH_FLUSH_AGE
+from libnntsc.pipeline import Pipeline, PIPELINE_DONE, PIPELINE_FAILED, \
+        PIPELINE_DROPPED
+from libnntsc.spool import IngestSpool, spooled_messages
+from libnntsc.streamsnapshot import StreamSnapshot
 from ampsave.importer import import_data_functions
+from libnntsc.parsers.common import DerivedDataCache, share_stream_registries
 from libnntsc.parsers.amp_icmp import AmpIcmpParser
 from libnntsc.parsers.amp_traceroute import AmpTracerouteParser
 from libnntsc.parsers.amp_traceroute_pathlen import AmpTraceroutePathlenParser
@@ -56,21 +70,71 @@ from google.protobuf.message import DecodeError
 import libnntscclient.logger as logger
 
 DEFAULT_COMMIT_FREQ = 50
+DEFAULT_MIN_COMMIT_FREQ = 10
+DEFAULT_MAX_COMMIT_FREQ = 1000
+DEFAULT_MAX_COMMIT_DELAY = 10
+DEFAULT_TARGET_COMMIT_LATENCY = 2.0
+
+# How often to log the state of the batch controller, in seconds
+BATCH_STATS_FREQ = 300
+
+# How often to check for batches that the pipeline has committed, in seconds
+PIPELINE_POLL_FREQ = 0.1
+DEFAULT_PIPELINE_DEPTH = 2
+
+# How long to wait between attempts to replay the spool while the database
+# is unavailable, in seconds
+SPOOL_RETRY_FREQ = 10
+DEFAULT_SPOOL_MAX_SIZE = 1024
+
+# Test types in roughly descending order of how expensive they are to
+# process, so that sharding by test spreads the heaviest ones across
+# different workers first
+SHARD_TEST_ORDER = ["traceroute", "icmp", "dns", "http", "fastping",
+        "tcpping", "throughput", "udpstream", "youtube", "external", "sip"]
 
 class AmpModule:
-    def __init__(self, tests, nntsc_config, routekey, exchange, queueid):
+    def __init__(self, tests, nntsc_config, routekey, exchange, queueid,
+            shard=None, offline=False, decodeworkers=None):
 
         self.pending = []
+        self.pendingsince = 0
+        self.channel = None
         self.exporter = None
         self.pubthread = None
+        self.shard = shard
+
+        # an offline module (e.g. nntsc-import) is fed messages directly
+        # and only ever writes them to the database
+        self.offline = offline
 
         logging.basicConfig()
+
+        # start the decoding pool before we have any database connections
+        # or threads that the pool processes might inherit
+        self.decoder = None
+        if decodeworkers is None:
+            decodeworkers = get_decode_workers(nntsc_config)
+        if decodeworkers > 0:
+            self.decoder = Pool(decodeworkers, _decoder_init)
+            self.decodeworkers = decodeworkers
+
         self.dbconf = get_nntsc_db_config(nntsc_config)
         if self.dbconf == {}:
             sys.exit(1)
 
+        # bulk loads are always fastest with COPY
+        if self.offline:
+            self.dbconf["insertmode"] = "copy"
+
         self.db = DBInsert(self.dbconf["name"], self.dbconf["user"],
-                self.dbconf["pass"], self.dbconf["host"])
+                self.dbconf["pass"], self.dbconf["host"],
+                insertmode=self.dbconf["insertmode"],
+                pathstorage=self.dbconf["pathstorage"],
+                datalayout=self.dbconf["datalayout"],
+                cachebackend=self.dbconf["cachebackend"],
+                cachepath=self.dbconf["cachepath"],
+                cacheslots=self.dbconf["cacheslots"])
 
         self.db.connect_db(15)
 
@@ -99,27 +163,53 @@ class AmpModule:
             if c['module'] == "amp":
                 self.collections[c['modsubtype']] = c['id']
 
-        self.parsers = {
-            "icmp": [AmpIcmpParser(self.db, self.influxdb)],
-            "traceroute": [AmpTracerouteParser(self.db),
-                    AmpTraceroutePathlenParser(self.db, self.influxdb)
-                    ],
-            "throughput": [AmpThroughputParser(self.db, self.influxdb)],
-            "dns": [AmpDnsParser(self.db, self.influxdb)],
-            "http": [AmpHttpParser(self.db, self.influxdb)],
-            "udpstream": [AmpUdpstreamParser(self.db, self.influxdb)],
-            "tcpping": [AmpTcppingParser(self.db, self.influxdb)],
-            "youtube": [AmpYoutubeParser(self.db, self.influxdb)],
-            "fastping": [AmpFastpingParser(self.db, self.influxdb)],
-            "external": [AmpExternalParser(self.db, self.influxdb)],
-            "sip": [AmpSipParser(self.db, self.influxdb)],
-        }
+        self.parsers = create_parsers(self.db, self.influxdb)
+
+        # a sharded worker only processes the test types it has been given
+        if self.shard is not None and self.shard["shardby"] == "test":
+            for test in self.parsers.keys():
+                if test not in self.shard["tests"]:
+                    del self.parsers[test]
+
+        # the matrix aggregates are built as the data is inserted, starting
+        # from whatever data is already in the bins that are still open
+        for plist in self.parsers.itervalues():
+            for p in plist:
+                p.add_matrix_rollups()
+        if self.influxdb and not self.offline:
+            try:
+                self.influxdb.seed_rollups()
+            except DBQueryException as e:
+                logger.log("Failed to fill the open matrix bins: %s" % (e))
+
+        # make sure there are partitions for the data we're about to insert,
+        # in case we haven't been running for a while
+        if self.db.datalayout == "partitioned" and not self.offline:
+            self._maintain_partitions()
+
+        # new streams are created in bulk part way through each batch, so
+        # that messages for streams we already know about aren't held up
+        for parsers in self.parsers.itervalues():
+            for p in parsers:
+                p.queue_new_streams()
+
+        # if there is a stream snapshot, the tests we are given are only the
+        # streams that are newer than it
+        snapshotpath = get_snapshot_config(nntsc_config)
+        if snapshotpath is not None:
+            highwater, maps, identity = load_stream_snapshot(self.db,
+                    StreamSnapshot(snapshotpath))
+            load_stream_maps(self.parsers, maps)
 
         # set all the streams that we already know about for easy lookup of
         # their stream id when reporting data
         for i in tests:
 
             testtype = i["modsubtype"]
+            if self.shard is not None and self.shard["shardby"] == "monitor":
+                if "source" in i and monitor_shard(i["source"],
+                        self.shard["workers"]) != self.shard["worker"]:
+                    continue
             if testtype in self.parsers:
                 for p in self.parsers[testtype]:
                     p.create_existing_stream(i)
@@ -134,51 +224,75 @@ class AmpModule:
         if liveconf == "NNTSCConfigMissing":
             liveconf = True
 
+        # nobody is interested in live data when importing old results
+        if self.offline:
+            liveconf = False
+
         if liveconf:
-            self.exporter, self.pubthread = \
+            publisher, self.pubthread = \
                     initExportPublisher(nntsc_config, routekey, exchange, \
                     queueid)
 
+            # live data is only exported once it has been committed
+            self.exporter = PikaPubBuffer(publisher)
+
             for parsers in self.parsers.itervalues():
                 for p in parsers:
                     p.add_exporter(self.exporter)
 
     def initSource(self, nntsc_config):
-        # Parse connection info
-        username = get_nntsc_config(nntsc_config, "amp", "username")
-        if username == "NNTSCConfigMissing":
-            username = "amp"
-        password = get_nntsc_config(nntsc_config, "amp", "password")
-        if password == "NNTSCConfigMissing":
-            logger.log("Password not set for AMP RabbitMQ source, using empty string as default")
-            password = ""
-        host = get_nntsc_config(nntsc_config, "amp", "host")
-        if host == "NNTSCConfigMissing":
-            host = "localhost"
-        port = get_nntsc_config(nntsc_config, "amp", "port")
-        if port == "NNTSCConfigMissing":
-            port = "5672"
-        ssl = get_nntsc_config_bool(nntsc_config, "amp", "ssl")
-        if ssl == "NNTSCConfigMissing":
-            ssl = False
-        queue = get_nntsc_config(nntsc_config, "amp", "queue")
-        if queue == "NNTSCConfigMissing":
-            queue = "amp-nntsc"
-
-        self.commitfreq = get_nntsc_config(nntsc_config, "amp", "commitfreq")
-        if self.commitfreq == "NNTSCConfigMissing":
-            self.commitfreq = DEFAULT_COMMIT_FREQ
-        else:
-            self.commitfreq = int(self.commitfreq)
+        self.batchconf = get_batch_config(nntsc_config)
+        self.batcher = BatchController(self.batchconf["commitfreq"],
+                self.batchconf["mincommitfreq"],
+                self.batchconf["maxcommitfreq"],
+                self.batchconf["maxcommitdelay"],
+                self.batchconf["targetcommitlatency"])
+        self.laststats = time.time()
 
-        if "NNTSCConfigError" in [username, password, host, port, ssl, queue]:
-            logger.log("Failed to configure AMP source")
-            sys.exit(1)
+        # partitions for new data are made well ahead of time, so they only
+        # need to be checked occasionally
+        self.nextpartitions = time.time() + DATA_PARTITION_CHECK_FREQ
+
+        self.pipeline = None
+        self.generation = 0
+        if self.batchconf["pipeline"] and not self.offline:
+            # the parse thread needs somewhere to put rows without touching
+            # the data connection, which belongs to the commit thread
+            self.db.set_pipelined()
+            self.committed = StdQueue.Queue()
+            self.pipeline = Pipeline([
+                    ("amp-parse", self._pipeline_parse),
+                    ("amp-commit", self._pipeline_commit)],
+                    self.batchconf["pipelinedepth"])
+            self.pipeline.start()
 
-        logger.log("Connecting to RabbitMQ queue %s on host %s:%s (ssl=%s), username %s" % (queue, host, port, ssl, username))
+        # messages that can't be committed are kept here until the
+        # database is available again
+        self.spool = None
+        self.spooling = False
+        self.replaying = None
+        self.quarantine = None
+        self.nextreplay = 0
+        spoolconf = get_spool_config(nntsc_config)
+        if spoolconf["spooldir"] is not None and not self.offline:
+            if self.shard is None:
+                spoolname = "amp.spool"
+            else:
+                spoolname = "amp-%d.spool" % (self.shard["worker"])
+            self.spool = IngestSpool(os.path.join(spoolconf["spooldir"],
+                    spoolname), spoolconf["spoolmaxsize"])
+
+        # sharded workers get their messages from the dispatcher instead,
+        # and offline modules are given them by the caller
+        if self.shard is not None or self.offline:
+            self.source = None
+            return
 
-        self.source = PikaConsumer('', queue, host, port,
-                ssl, username, password, True)
+        srcconf = get_source_config(nntsc_config)
+
+        self.source = PikaConsumer('', srcconf["queue"], srcconf["host"],
+                srcconf["port"], srcconf["ssl"], srcconf["username"],
+                srcconf["password"], True)
 
 
     def process_data(self, channel, method, properties, body):
@@ -186,97 +300,658 @@ class AmpModule:
             Depending on the test this message may include multiple results.
         """
 
+        # messages delivered on a channel that has since gone away are
+        # going to be redelivered, so don't try to process them twice
+        if channel is not self.channel:
+            self.drop_pending()
+            self.channel = channel
+            self.generation += 1
+
         # push every new message onto the end of the list to be processed
+        if len(self.pending) == 0:
+            self.pendingsince = time.time()
         self.pending.append((method, properties, body))
 
         # once there are enough messages ready to go, process them all
-        if len(self.pending) < self.commitfreq:
+        reason = self.batcher.should_flush(len(self.pending),
+                time.time() - self.pendingsince)
+        if reason is None:
             return
 
+        self.process_pending(channel, reason)
+
+    def check_pending(self, channel):
+        """ Commits the pending messages if the oldest has been waiting
+            for too long. Called periodically from the IO loop.
+        """
+
+        if channel is not self.channel:
+            self.drop_pending()
+            self.channel = channel
+            self.generation += 1
+
+        if self.pipeline is not None:
+            self._pipeline_completed(channel)
+
+        now = time.time()
+        reason = self.batcher.should_flush(len(self.pending),
+                now - self.pendingsince)
+        if reason == BATCH_FLUSH_AGE:
+            self.process_pending(channel, BATCH_FLUSH_AGE)
+        elif reason is not None and self.pipeline is not None:
+            # a full batch that the pipeline had no room for earlier
+            self.process_pending(channel, reason)
+
+        if self.spool is not None and not self.spool.empty() and \
+                now >= self.nextreplay:
+            self._replay_spool()
+
+        if now - self.laststats >= BATCH_STATS_FREQ:
+            logger.log("AMP batching: %s" % (self.batcher.describe()))
+            for parsers in self.parsers.itervalues():
+                for p in parsers:
+                    caches = p.describe_caches()
+                    if caches is not None:
+                        logger.log("AMP %s caches: %s" % (p.colname, caches))
+            logger.log("AMP stream timestamp cache (%s): %s" % \
+                    (self.db.streamcache.backend.name,
+                    self.db.streamcache.describe_local_cache()))
+            self.laststats = now
+
+        if self.db.datalayout == "partitioned" and \
+                now >= self.nextpartitions:
+            self._maintain_partitions()
+            self.nextpartitions = now + DATA_PARTITION_CHECK_FREQ
+
+    def _maintain_partitions(self):
+        try:
+            count = self.db.maintain_partitions()
+        except DBQueryException as e:
+            logger.log("AMP: failed to create new data partitions: %s" % (e))
+            return
+
+        if count > 0:
+            logger.log("AMP: created %d new data partitions" % (count))
+
+    def batch_stats(self):
+        """ Returns the current batch size and flush statistics """
+        return self.batcher.stats()
+
+    def drop_pending(self):
+        """ Forget about any messages that haven't been processed yet,
+            e.g. because they are going to be redelivered.
+        """
+        self.pending = []
+
+    def process_pending(self, channel, reason=BATCH_FLUSH_SIZE):
+        """ Process and commit all of the pending messages, then
+            acknowledge them.
+        """
+
+        if len(self.pending) == 0:
+            return
+
+        # don't bother trying the database while we know it is unavailable
+        if self.spooling and self._spool_messages(channel, self.pending):
+            self.pending = []
+            return
+
+        if self.pipeline is not None:
+            # hand the batch over to the pipeline, it will be acknowledged
+            # once the commit thread tells us that it has been committed.
+            # If the pipeline is still busy, keep the batch and try again
+            # from check_pending() -- nothing more will be delivered once
+            # the prefetch limit is reached, so the batch can't grow
+            # without bound while we wait
+            if self.pipeline.submit(self.generation, (self.pending, reason,
+                    time.time(), None, None)):
+                self.pending = []
+            return
+
+        started = time.time()
+
+        try:
+            self._commit_batch(self.pending)
+        except DBQueryException as e:
+            logger.log(e)
+            # only spool the batch if the database itself is the problem,
+            # anything else is better left to be redelivered
+            if e.code not in DB_CONNECTION_ERRORS or \
+                    not self._spool_messages(channel, self.pending):
+                # disconnect and restart processing in a new transaction
+                channel.close()
+            self.pending = []
+            return
+
+        # ack all data up to and including the most recent message
+        channel.basic_ack(self.pending[-1][0].delivery_tag, True)
+
+        self.batcher.record_commit(len(self.pending), time.time() - started,
+                reason)
+
+        # empty the list of pending data ready for more
+        self.pending = []
+
+    def _commit_batch(self, pending):
+        """ Processes and commits a batch of messages, rolling everything
+            back if that fails.
+        """
+        rejected = []
+        try:
+            processed = self._parse_messages(pending)
+
+            # commit the data if anything was successfully processed
+            if processed > 0:
+                rejected = self.db.commit_pending(self.db.take_pending(),
+                        self._dead_letter(pending))
+                if self.influxdb:
+                    self.influxdb.commit_data()
+        except DBQueryException:
+            self.db.rollback_data()
+            if self.influxdb:
+                self.influxdb.take_pending()
+            if self.exporter is not None:
+                self.exporter.take_pending()
+            self._abort_parsers()
+            raise
+
+        # some parsers need to update internal caches after confirming
+        # that data has been committed successfully
+        if processed > 0:
+            self._post_commit(rejected)
+
+    def _spool_messages(self, channel, pending):
+        """ Saves a batch of messages to the spool and acknowledges them,
+            so that they can be replayed once the database is available
+            again. Returns False if there is no spool or it is full.
+        """
+        if self.spool is None:
+            return False
+
+        records = []
+        for method, properties, body in pending:
+            # these would be ignored by _message_test() anyway
+            if getattr(properties, "user_id", None) is None or \
+                    properties.headers is None:
+                continue
+            records.append((properties.headers.get("x-amp-test-type"),
+                    properties.user_id, properties.timestamp, body))
+
+        try:
+            if not self.spool.append(records):
+                logger.log("AMP: Spool is full, leaving messages in the queue")
+                return False
+        except (IOError, OSError) as e:
+            logger.log("AMP: Failed to write to spool: %s" % (e))
+            return False
+
+        if not self.spooling:
+            logger.log("AMP: Database unavailable, spooling messages to %s" \
+                    % (self.spool.path))
+            self.spooling = True
+            self.nextreplay = time.time() + SPOOL_RETRY_FREQ
+
+        # earlier messages may still be in the pipeline, so each message
+        # has to be acknowledged separately
+        for method, properties, body in pending:
+            channel.basic_ack(method.delivery_tag)
+        return True
+
+    def _replay_spool(self):
+        """ Tries to commit the oldest messages in the spool """
+        if self.replaying is not None:
+            return
+
+        # new messages take priority, the spool can wait for a gap
+        if self.pipeline is not None and self.pipeline.full():
+            return
+
+        if self.quarantine is not None:
+            pending, error, offset = self.quarantine
+        else:
+            records, offset = self.spool.read(self.batchconf["maxcommitfreq"])
+            pending = spooled_messages(records)
+            error = None
+
+        if self.pipeline is not None:
+            if self.pipeline.submit(self.generation, (pending, None,
+                    time.time(), error, offset)):
+                self.replaying = offset
+            return
+
+        try:
+            self._commit_batch(pending)
+        except DBQueryException as e:
+            logger.log(e)
+            if e.code in DB_CONNECTION_ERRORS:
+                self._replay_failed(e)
+                return
+
+            # trying again isn't going to help, so move the whole batch to
+            # the dead letter table rather than replaying it forever
+            try:
+                self._quarantine_batch(pending, e)
+                self.db.commit_data()
+            except DBQueryException as e:
+                logger.log(e)
+                self.db.rollback_data()
+                self._replay_failed(e)
+                return
+
+        self._replay_done(offset)
+
+    def _replay_done(self, offset):
+        self.quarantine = None
+        self.spool.advance(offset)
+
+        if self.spooling:
+            logger.log("AMP: Database is available again, replaying spool")
+            self.spooling = False
+
+        if self.spool.empty():
+            logger.log("AMP: Finished replaying spool")
+
+    def _replay_failed(self, error):
+        # wait a while before trying again, spooling any new data in the
+        # meantime if the database has gone away
+        self.quarantine = None
+        if connection_error(error):
+            self.spooling = True
+        self.nextreplay = time.time() + SPOOL_RETRY_FREQ
+
+    def _post_commit(self, rejected=None):
+        # live data can be exported now that it is safely in the database,
+        # apart from anything that was moved to the dead letter table
+        if self.exporter is not None:
+            self.exporter.commit_pending(self.exporter.take_pending(),
+                    rejected)
+
+        # TODO limit this to parsers that recently processed data
+        for parsers in self.parsers.values():
+            for parser in parsers:
+                parser.post_commit()
+
+    def _parse_messages(self, pending):
+        """ Decodes a list of messages and passes them to the parsers.
+
+            Returns the number of messages that were successfully
+            processed or moved to the dead letter table. Raises a
+            DBQueryException if processing needs to be restarted in a new
+            transaction.
+        """
+
         # track how many messages were successfully written to the database
         processed = 0
 
-        for method, properties, body in self.pending:
-            # ignore any messages that don't have user_id set
-            if not hasattr(properties, "user_id"):
-                continue
+        tests = [self._message_test(properties) \
+                for method, properties, body in pending]
+        jobs = [(test, body, properties.user_id) \
+                for test, (method, properties, body) in zip(tests, pending) \
+                if test is not None]
 
-            test = properties.headers["x-amp-test-type"]
+        # decoding doesn't depend on any state, so can be farmed out to
+        # the pool if we have one. map() keeps everything in order.
+        if self.decoder is not None and len(jobs) > 0:
+            chunksize = max(1, len(jobs) // (self.decodeworkers * 4))
+            decoded = iter(self.decoder.map(_decoder_run, jobs, chunksize))
+        else:
+            decoded = (decode_message(self.amp_modules, self.parsers, j) \
+                    for j in jobs)
 
-            # ignore any messages for tests we don't have a module for
-            if test not in self.amp_modules:
-                logger.log("unknown test: '%s'" % (
-                        properties.headers["x-amp-test-type"]))
-                logger.log("AMP -- Data error, acknowledging and moving on")
-                continue
+        # group the messages by test, so that each parser can deal with
+        # all of its messages at once
+        groups = {}
+        order = []
 
-            # ignore any messages for tests we don't have a parser for
-            if test not in self.parsers:
+        for index, (method, properties, body) in enumerate(pending):
+            test = tests[index]
+            if test is None:
                 continue
 
-            try:
-                data = self.amp_modules[test].get_data(body)
-            except DecodeError as e:
-                # we got something that wasn't a valid protocol buffer message
-                logger.log("Failed to decode result from %s for %s test: %s" % (
-                            properties.user_id, test, e))
-                data = None
-            except AssertionError as e:
-                # A lot of ampsave functions assert fail if something goes
-                # wrong, so we need to catch that and chuck the bogus data
-                logger.log("Ignoring AMP result for %s test (ampsave assertion failure): %s" % (test, e))
-                data = None
+            prepared, error = next(decoded)
+            if error is not None:
+                logger.log(error)
 
             # ignore any broken messages and carry on
-            if data is None:
+            if prepared is None:
                 continue
 
+            if test not in groups:
+                groups[test] = []
+                order.append(test)
+            groups[test].append((index, properties.timestamp, prepared,
+                    properties.user_id))
+
+        for test in order:
+            processed += self._process_group(test, groups[test], pending)
+
+        return processed
+
+    def _process_group(self, test, group, pending):
+        """ Passes all of the messages for one test to its parsers.
+
+            If any of the messages cause an error, everything done for the
+            group is undone and the messages are processed again one at a
+            time so that the bad ones can be moved to the dead letter
+            table without losing the rest.
+
+            Messages that need new streams are set aside in the same way
+            until the rest of the group is done, then all of the streams
+            they need are created together and the messages are tried
+            again.
+        """
+        processed = 0
+
+        while True:
             try:
-                # pass the message off to the test specific code
-                for p in self.parsers[test]:
-                    p.process_data(properties.timestamp, data,
-                            properties.user_id)
-                processed += 1
+                self._process_messages(test, group)
+                return processed + len(group)
             except DBQueryException as e:
-                logger.log(e)
+                # the caller needs to restart processing in a new
+                # transaction if the problem was with the database itself
+                if e.code in DB_QUERY_ERRORS:
+                    if len(group) > 1:
+                        logger.log("AMP: Retrying %d %s results one at a time" \
+                                % (len(group), test))
+                elif e.code != DB_STREAM_PENDING:
+                    raise
 
-                if e.code == DB_DATA_ERROR:
-                    # Data was bad so we couldn't insert into the database.
-                    # Acknowledge the message so we can dump it from the queue
-                    # and move on but don't try to export it to clients.
-                    # TODO I assume this doesn't break the current transaction
-                    logger.log("Acknowledging data and moving on")
-                    continue
+            deferred = []
+            for item in group:
+                try:
+                    self._process_messages(test, [item])
+                except DBQueryException as e:
+                    if e.code == DB_STREAM_PENDING:
+                        deferred.append(item)
+                        continue
+                    if e.code not in DB_QUERY_ERRORS:
+                        raise
 
-                # disconnect and restart processing in a new transaction
-                channel.close()
-                self.pending = []
-                return
+                    # something about this message is bad, so set it
+                    # aside and carry on with the rest of the batch
+                    self._quarantine(test, pending[item[0]], e)
 
-        # commit the data if anything was successfully processed
-        if processed > 0:
+            # dead letters still need to be committed, so count them too
+            processed += len(group) - len(deferred)
+            if len(deferred) == 0:
+                return processed
+
+            if self._create_streams(test) == 0:
+                # nothing is going to change if we try them again
+                for item in deferred:
+                    self._quarantine(test, pending[item[0]],
+                            DBQueryException(DB_STREAM_PENDING))
+                return processed + len(deferred)
+
+            group = deferred
+
+    def _quarantine_batch(self, pending, error):
+        """ Moves every message in a batch to the dead letter table, as
+            part of the current transaction.
+        """
+        logger.log("AMP: Giving up on %d replayed messages: %s" % \
+                (len(pending), error))
+        for message in pending:
+            method, properties, body = message
+            self._quarantine(properties.headers["x-amp-test-type"],
+                    message, error)
+
+    def _quarantine(self, test, message, error):
+        method, properties, body = message
+        logger.log("AMP: Moving %s result from %s to dead letters" \
+                % (test, properties.user_id))
+        self.db.quarantine_message("amp", test, properties.user_id,
+                body, error)
+
+    def _create_streams(self, test):
+        """ Creates all of the streams that have been queued by the
+            parsers for a test in one transaction, then exports them.
+
+            Returns the number of streams that were created.
+        """
+        parsers = self.parsers[test]
+        count = sum([p.queued_stream_count() for p in parsers])
+        if count == 0:
+            return 0
+
+        logger.log("AMP: Creating %d new %s streams" % (count, test))
+
+        try:
+            self.db.reserve_stream_ids(count)
+            created = [p.create_queued_streams() for p in parsers]
+            self.db.commit_streams()
+        except DBQueryException:
+            self.db.rollback_streams()
+            for p in parsers:
+                p.discard_queued_streams()
+            raise
+
+        # don't tell anyone about the new streams until they are committed
+        for p, streams in zip(parsers, created):
+            p.publish_streams(streams)
+
+        return count
+
+    def _process_messages(self, test, group):
+        # anything these messages insert can be undone without losing the
+        # rest of the batch
+        self.db.begin_message(group[0][0])
+        if self.influxdb:
+            self.influxdb.begin_message()
+        if self.exporter is not None:
+            self.exporter.begin_message(group[0][0])
+
+        try:
+            # pass the messages off to the test specific code
+            for i, p in enumerate(self.parsers[test]):
+                p.process_batch([(index, timestamp, prepared[i], source) \
+                        for index, timestamp, prepared, source in group])
+        except DBQueryException as e:
+            # messages waiting for new streams are tried again later
+            if e.code == DB_STREAM_PENDING:
+                self._abort_message(test)
+                raise
+
+            logger.log(e)
+            if e.code in DB_QUERY_ERRORS:
+                self._abort_message(test)
+            raise
+
+        self.db.end_message()
+        if self.influxdb:
+            self.influxdb.end_message()
+        if self.exporter is not None:
+            self.exporter.end_message()
+
+    def _abort_message(self, test):
+        self.db.abort_message()
+        if self.influxdb:
+            self.influxdb.abort_message()
+        if self.exporter is not None:
+            self.exporter.abort_message()
+        for p in self.parsers[test]:
+            p.abort_message()
+
+    def _abort_parsers(self):
+        # everything done in the transaction has been rolled back, so the
+        # parsers must forget anything they found out during it (e.g. the
+        # ids of newly added paths)
+        for parsers in self.parsers.itervalues():
+            for p in parsers:
+                p.abort_message()
+
+    def _dead_letter(self, pending):
+        """ Returns a function that describes a message in the given batch
+            for the dead letter table, if the database rejects its rows
+            when they are committed.
+        """
+        def describe(index):
+            method, properties, body = pending[index]
+            return ("amp", properties.headers["x-amp-test-type"],
+                    properties.user_id, body)
+        return describe
+
+    def _message_test(self, properties):
+        """ Returns the test type for a message, or None if the message
+            should be ignored.
+        """
+        # ignore any messages that don't have user_id set
+        if not hasattr(properties, "user_id"):
+            return None
+
+        test = properties.headers["x-amp-test-type"]
+
+        # ignore any messages for tests we don't have a module for
+        if test not in self.amp_modules:
+            logger.log("unknown test: '%s'" % (
+                    properties.headers["x-amp-test-type"]))
+            logger.log("AMP -- Data error, acknowledging and moving on")
+            return None
+
+        # ignore any messages for tests we don't have a parser for
+        if test not in self.parsers:
+            return None
+
+        return test
+
+    def close(self):
+        if self.decoder is not None:
+            self.decoder.terminate()
+            self.decoder = None
+        if self.spool is not None:
+            self.spool.close()
+            self.spool = None
+
+    def _pipeline_parse(self, batch):
+        """ First stage of the pipeline: decodes and parses a batch of
+            messages, leaving the resulting rows ready to be committed by
+            the next stage.
+        """
+        pending, reason, started, quarantine, replay = batch
+
+        # parsers only ever get touched by this thread, so catch up on
+        # any commits that have been confirmed since the last batch
+        confirmed = False
+        while True:
             try:
-                self.db.commit_data()
-                if self.influxdb:
-                    self.influxdb.commit_data()
-            except DBQueryException as e:
-                logger.log(e)
+                self.committed.get(False)
+                confirmed = True
+            except StdQueue.Empty:
+                break
+        if confirmed:
+            self._post_commit()
+
+        if quarantine is not None:
+            # a replayed batch that failed for some reason other than the
+            # database being unavailable, so set all of it aside
+            try:
+                self._quarantine_batch(pending, quarantine)
+                self.db.commit_streams()
+            except DBQueryException:
+                self.db.rollback_streams()
+                raise
+            return (pending, 0, reason, started, None, None, None, replay)
+
+        try:
+            processed = self._parse_messages(pending)
+
+            # paths etc. are inserted using the streams connection
+            self.db.commit_streams()
+        except DBQueryException:
+            self.db.rollback_streams()
+            self.db.discard_pending()
+            if self.influxdb:
+                self.influxdb.take_pending()
+            if self.exporter is not None:
+                self.exporter.take_pending()
+            self._abort_parsers()
+            raise
+
+        dbdata = self.db.take_pending()
+        if self.influxdb:
+            points = self.influxdb.take_pending()
+        else:
+            points = None
+        if self.exporter is not None:
+            live = self.exporter.take_pending()
+        else:
+            live = None
+
+        return (pending, processed, reason, started, dbdata, points, live,
+                replay)
+
+    def _pipeline_commit(self, parsed):
+        """ Second stage of the pipeline: commits the rows produced by the
+            parsing stage.
+        """
+        pending, processed, reason, started, dbdata, points, live, replay = \
+                parsed
+
+        if processed > 0:
+            rejected = self.db.commit_pending(dbdata,
+                    self._dead_letter(pending))
+            if self.influxdb:
+                self.influxdb.commit_pending(points)
+            if live is not None:
+                self.exporter.commit_pending(live, rejected)
+            self.committed.put(True)
+
+        return (pending[-1][0].delivery_tag, len(pending), reason, started,
+                replay)
+
+    def _pipeline_completed(self, channel):
+        """ Acknowledges any batches that the pipeline has finished
+            committing. Must be called from the IO loop.
+        """
+        for status, generation, result, error in self.pipeline.completed():
+            # batches replayed from the spool end with the offset to
+            # advance the spool to, everything else ends with None
+            replay = result[-1]
+            if replay is not None:
+                self.replaying = None
+                if status == PIPELINE_DONE:
+                    self._replay_done(replay)
+                elif status == PIPELINE_FAILED:
+                    self._pipeline_replay_failed(result[0], replay, error)
+
+            if generation != self.generation or status == PIPELINE_DROPPED:
+                continue
+
+            if status == PIPELINE_FAILED:
+                # save the failed batch for later if we can, then
+                # disconnect so that everything unacknowledged is
+                # redelivered and restart with a new generation, so that
+                # the pipeline skips anything else it had queued up
+                if replay is None and connection_error(error):
+                    self._spool_messages(channel, result[0])
+                logger.log("AMP: pipeline failed, resetting channel")
+                self.drop_pending()
+                self.generation += 1
                 channel.close()
-                self.pending = []
-                return
+                continue
 
-            # some parsers need to update internal caches after confirming
-            # that data has been committed successfully
-            # TODO limit this to parsers that recently processed data
-            for parsers in self.parsers.values():
-                for parser in parsers:
-                    parser.post_commit()
+            if replay is not None:
+                continue
 
-        # ack all data up to and including the most recent message
-        channel.basic_ack(method.delivery_tag, True)
+            tag, count, reason, started, replay = result
+            channel.basic_ack(tag, True)
+            self.batcher.record_commit(count, time.time() - started, reason)
 
-        # empty the list of pending data ready for more
-        self.pending = []
+    def _pipeline_replay_failed(self, pending, offset, error):
+        """ Deals with a batch replayed from the spool that the pipeline
+            failed to commit. Must be called from the IO loop.
+        """
+        # only one replay is in the pipeline at a time, so if we were
+        # already trying to quarantine then that is what failed
+        if connection_error(error) or self.quarantine is not None:
+            self._replay_failed(error)
+            return
+
+        # trying again isn't going to help, so the next replay gets the
+        # parsing thread to move the whole batch to the dead letter table
+        # instead. It can't be submitted straight away, the pipeline is
+        # about to drop everything in the current generation.
+        self.quarantine = (pending, error, offset)
 
     def run(self):
         """ Run forever, calling the process_data callback for each message """
@@ -285,7 +960,14 @@ class AmpModule:
 
 
         try:
-            self.source.configure([], self.process_data, self.commitfreq)
+            # prefetch enough to fill the biggest batch we might want
+            self.source.configure([], self.process_data,
+                    self.batchconf["maxcommitfreq"])
+            if self.pipeline is not None:
+                interval = PIPELINE_POLL_FREQ
+            else:
+                interval = min(1.0, self.batchconf["maxcommitdelay"])
+            self.source.set_timer(interval, self.check_pending)
             self.source.run()
         except KeyboardInterrupt:
             self.source.halt_consumer()
@@ -295,16 +977,448 @@ class AmpModule:
             logger.log(e)
             raise
 
+        if self.pipeline is not None:
+            self.pipeline.stop()
+
         logger.log("AMP: Closed connection to RabbitMQ")
 
+    def run_shard(self, inqueue, results, generation):
+        """ Run forever, processing the messages handed to this worker
+            by the shard dispatcher
+        """
+
+        logger.log("Running amp shard %d: %s" % (self.shard["worker"],
+                " ".join(self.parsers)))
+
+        try:
+            consume_shard(self, self.shard["worker"], inqueue, results,
+                    generation)
+        except KeyboardInterrupt:
+            pass
+        except Exception as e:
+            logger.log("AMP: Unknown exception in shard %d" % \
+                    (self.shard["worker"]))
+            logger.log(e)
+            raise
+
+def connection_error(error):
+    """ Returns True if an exception means that the database is unavailable
+        (and so trying again later might work).
+    """
+    return isinstance(error, DBQueryException) and \
+            error.code in DB_CONNECTION_ERRORS
+
+def create_parsers(db, influxdb):
+    """ Returns a dictionary mapping each AMP test to the list of parsers
+        that process its results.
+    """
+    parsers = {
+        "icmp": [AmpIcmpParser(db, influxdb)],
+        "traceroute": [AmpTracerouteParser(db),
+                AmpTraceroutePathlenParser(db, influxdb)
+                ],
+        "throughput": [AmpThroughputParser(db, influxdb)],
+        "dns": [AmpDnsParser(db, influxdb)],
+        "http": [AmpHttpParser(db, influxdb)],
+        "udpstream": [AmpUdpstreamParser(db, influxdb)],
+        "tcpping": [AmpTcppingParser(db, influxdb)],
+        "youtube": [AmpYoutubeParser(db, influxdb)],
+        "fastping": [AmpFastpingParser(db, influxdb)],
+        "external": [AmpExternalParser(db, influxdb)],
+        "sip": [AmpSipParser(db, influxdb)],
+    }
+
+    # e.g. both traceroute parsers share the traceroute streams
+    share_stream_registries([p for plist in parsers.itervalues() \
+            for p in plist])
+    return parsers
+
+def load_stream_maps(parsers, maps):
+    """ Adds the stream maps from a stream snapshot to the parsers """
+    for plist in parsers.itervalues():
+        for p in plist:
+            if p.streamtable in maps:
+                p.streams.update(maps[p.streamtable])
+
+def load_stream_snapshot(db, snapshot):
+    """ Loads a stream snapshot, ignoring it if it was taken from another
+        database or from this database before it was rebuilt or restored.
+
+        Returns a tuple containing the highwater and stream maps from the
+        snapshot, and the identity of the database.
+    """
+    identity = db.get_database_identity()
+    highwater, maps = snapshot.load(identity)
+
+    # the stream ids in the snapshot can't be trusted if the sequence has
+    # gone backwards since it was taken
+    if highwater is not None and highwater > db.get_stream_highwater():
+        logger.log("AMP: Stream snapshot is newer than the database, ignoring it")
+        return None, {}, identity
+
+    return highwater, maps, identity
+
+def select_streams(db, nntsc_config):
+    """ Fetches the existing AMP streams to be passed into AmpModule.
+
+        If a stream snapshot has been configured, only the streams that
+        are newer than the snapshot are fetched and the snapshot is
+        brought up to date with them.
+    """
+    snapshotpath = get_snapshot_config(nntsc_config)
+    if snapshotpath is None:
+        return db.select_streams_by_module("amp")
+
+    snapshot = StreamSnapshot(snapshotpath)
+
+    # read this first, so that a stream created while we are fetching
+    # the others is fetched again next time rather than missed
+    newest = db.get_stream_highwater()
+    highwater, maps, identity = load_stream_snapshot(db, snapshot)
+    streams = db.select_streams_by_module("amp", highwater)
+
+    if highwater is None:
+        logger.log("AMP: No stream snapshot, fetched all %d streams" % \
+                (len(streams)))
+    else:
+        logger.log("AMP: Fetched %d streams newer than the stream snapshot" \
+                % (len(streams)))
+
+    if highwater == newest:
+        return streams
+
+    parsers = create_parsers(db, None)
+    load_stream_maps(parsers, maps)
+    for s in streams:
+        for p in parsers.get(s["modsubtype"], []):
+            p.create_existing_stream(s)
+
+    # parsers that share a streams table share their stream registry too
+    maps = {}
+    for plist in parsers.itervalues():
+        for p in plist:
+            maps[p.streamtable] = dict(p.streams)
+    snapshot.save(newest, maps, identity)
+    return streams
+
+def decode_message(modules, parsers, job):
+    """ Decodes a single AMP message and runs the prepare_data() step of
+        each parser for that test.
+
+        Returns a tuple containing the list of prepared results (one per
+        parser, or None if the message should be ignored) and an error
+        message to log (or None).
+    """
+    test, body, source = job
+
+    try:
+        data = modules[test].get_data(body)
+    except DecodeError as e:
+        # we got something that wasn't a valid protocol buffer message
+        return None, "Failed to decode result from %s for %s test: %s" % (
+                source, test, e)
+    except AssertionError as e:
+        # A lot of ampsave functions assert fail if something goes
+        # wrong, so we need to catch that and chuck the bogus data
+        return None, "Ignoring AMP result for %s test (ampsave assertion failure): %s" % (test, e)
+
+    if data is None:
+        return None, None
+
+    derived = DerivedDataCache()
+    return [p.prepare_data(data, source, derived) for p in parsers[test]], \
+            None
+
+# Each process in the decoding pool has its own copy of these, created by
+# _decoder_init(). The parsers have no database so can only be used for
+# prepare_data().
+_decoder_modules = None
+_decoder_parsers = None
+
+def _decoder_init():
+    global _decoder_modules, _decoder_parsers
+
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _decoder_modules = import_data_functions()
+    _decoder_parsers = create_parsers(None, None)
+
+def _decoder_run(job):
+    return decode_message(_decoder_modules, _decoder_parsers, job)
+
+def get_decode_workers(nntsc_config):
+    workers = get_nntsc_config_integer(nntsc_config, "amp", "decodeworkers")
+    if workers == "NNTSCConfigMissing":
+        workers = 0
+    if workers == "NNTSCConfigError":
+        logger.log("Failed to configure AMP decoding pool")
+        sys.exit(1)
+    return workers
+
+def _terminate(signum, frame):
+    sys.exit(0)
+
+def get_source_config(nntsc_config):
+    # Parse connection info
+    username = get_nntsc_config(nntsc_config, "amp", "username")
+    if username == "NNTSCConfigMissing":
+        username = "amp"
+    password = get_nntsc_config(nntsc_config, "amp", "password")
+    if password == "NNTSCConfigMissing":
+        logger.log("Password not set for AMP RabbitMQ source, using empty string as default")
+        password = ""
+    host = get_nntsc_config(nntsc_config, "amp", "host")
+    if host == "NNTSCConfigMissing":
+        host = "localhost"
+    port = get_nntsc_config(nntsc_config, "amp", "port")
+    if port == "NNTSCConfigMissing":
+        port = "5672"
+    ssl = get_nntsc_config_bool(nntsc_config, "amp", "ssl")
+    if ssl == "NNTSCConfigMissing":
+        ssl = False
+    queue = get_nntsc_config(nntsc_config, "amp", "queue")
+    if queue == "NNTSCConfigMissing":
+        queue = "amp-nntsc"
+
+    if "NNTSCConfigError" in [username, password, host, port, ssl, queue]:
+        logger.log("Failed to configure AMP source")
+        sys.exit(1)
+
+    logger.log("Connecting to RabbitMQ queue %s on host %s:%s (ssl=%s), username %s" % (queue, host, port, ssl, username))
+
+    return {"username":username, "password":password, "host":host,
+            "port":port, "ssl":ssl, "queue":queue}
+
+def get_batch_config(nntsc_config):
+    commitfreq = get_nntsc_config_integer(nntsc_config, "amp", "commitfreq")
+    if commitfreq == "NNTSCConfigMissing":
+        commitfreq = DEFAULT_COMMIT_FREQ
+    mincommit = get_nntsc_config_integer(nntsc_config, "amp", "mincommitfreq")
+    if mincommit == "NNTSCConfigMissing":
+        mincommit = DEFAULT_MIN_COMMIT_FREQ
+    maxcommit = get_nntsc_config_integer(nntsc_config, "amp", "maxcommitfreq")
+    if maxcommit == "NNTSCConfigMissing":
+        maxcommit = DEFAULT_MAX_COMMIT_FREQ
+    maxdelay = get_nntsc_config_integer(nntsc_config, "amp", "maxcommitdelay")
+    if maxdelay == "NNTSCConfigMissing":
+        maxdelay = DEFAULT_MAX_COMMIT_DELAY
+    target = get_nntsc_config(nntsc_config, "amp", "targetcommitlatency")
+    if target == "NNTSCConfigMissing":
+        target = DEFAULT_TARGET_COMMIT_LATENCY
+    elif target != "NNTSCConfigError":
+        try:
+            target = float(target)
+        except ValueError:
+            logger.log("Invalid targetcommitlatency for AMP: %s" % (target))
+            target = "NNTSCConfigError"
+
+    pipeline = get_nntsc_config_bool(nntsc_config, "amp", "pipeline")
+    if pipeline == "NNTSCConfigMissing":
+        pipeline = False
+    depth = get_nntsc_config_integer(nntsc_config, "amp", "pipelinedepth")
+    if depth == "NNTSCConfigMissing":
+        depth = DEFAULT_PIPELINE_DEPTH
+
+    if "NNTSCConfigError" in [commitfreq, mincommit, maxcommit, maxdelay,
+            target, pipeline, depth]:
+        logger.log("Failed to configure AMP commit batching")
+        sys.exit(1)
+
+    # commitfreq is only the starting point, but it should still be honoured
+    # if someone has set it outside of the default limits
+    mincommit = min(mincommit, commitfreq)
+    maxcommit = max(maxcommit, commitfreq)
+
+    return {"commitfreq":commitfreq, "mincommitfreq":mincommit,
+            "maxcommitfreq":maxcommit, "maxcommitdelay":maxdelay,
+            "targetcommitlatency":target, "pipeline":pipeline,
+            "pipelinedepth":max(1, depth)}
+
+def get_spool_config(nntsc_config):
+    spooldir = get_nntsc_config(nntsc_config, "amp", "spooldir")
+    if spooldir == "NNTSCConfigMissing" or spooldir == "":
+        spooldir = None
+    elif spooldir != "NNTSCConfigError" and not os.path.isdir(spooldir):
+        logger.log("AMP spool directory %s does not exist" % (spooldir))
+        spooldir = "NNTSCConfigError"
+
+    maxsize = get_nntsc_config_integer(nntsc_config, "amp", "spoolmaxsize")
+    if maxsize == "NNTSCConfigMissing":
+        maxsize = DEFAULT_SPOOL_MAX_SIZE
+
+    if "NNTSCConfigError" in [spooldir, maxsize]:
+        logger.log("Failed to configure AMP spool")
+        sys.exit(1)
+
+    # the size is configured in megabytes
+    return {"spooldir":spooldir, "spoolmaxsize":maxsize * 1024 * 1024}
+
+def get_snapshot_config(nntsc_config):
+    path = get_nntsc_config(nntsc_config, "amp", "streamsnapshot")
+    if path == "NNTSCConfigMissing" or path == "":
+        return None
+    if path == "NNTSCConfigError":
+        logger.log("Failed to configure AMP stream snapshot")
+        sys.exit(1)
+    return path
+
+def get_shard_config(nntsc_config):
+    workers = get_nntsc_config_integer(nntsc_config, "amp", "workers")
+    if workers == "NNTSCConfigMissing":
+        workers = 1
+    elif workers != "NNTSCConfigError" and workers < 1:
+        logger.log("AMP workers must be at least 1")
+        workers = "NNTSCConfigError"
+
+    shardby = get_nntsc_config(nntsc_config, "amp", "shardby")
+    if shardby == "NNTSCConfigMissing":
+        shardby = "test"
+    elif shardby not in ["test", "monitor"]:
+        logger.log("Invalid shardby option for AMP: %s" % (shardby))
+        logger.log("Suitable values are 'test' or 'monitor'")
+        shardby = "NNTSCConfigError"
+
+    if "NNTSCConfigError" in [workers, shardby]:
+        logger.log("Failed to configure AMP workers")
+        sys.exit(1)
+
+    return {"workers":workers, "shardby":shardby}
+
+def monitor_shard(monitor, workers):
+    """ Returns the worker responsible for all results from a monitor """
+    if isinstance(monitor, unicode):
+        monitor = monitor.encode('utf-8')
+    return (zlib.crc32(monitor) & 0xffffffff) % workers
+
+def assign_tests(workers):
+    """ Shares the AMP test types out across a number of workers.
+
+        Returns a dictionary mapping each test type to a worker number.
+    """
+    testmap = {}
+    for i, test in enumerate(SHARD_TEST_ORDER):
+        testmap[test] = i % workers
+    return testmap
+
+class AmpShardRouter(object):
+    def __init__(self, shardby, workers):
+        self.shardby = shardby
+        self.workers = workers
+        self.testmap = assign_tests(workers)
+
+    def __call__(self, properties):
+        # Messages without these get ignored by the workers anyway
+        user_id = getattr(properties, "user_id", None)
+        if user_id is None or properties.headers is None:
+            return None
+        test = properties.headers.get("x-amp-test-type")
+        if test is None:
+            return None
+
+        if self.shardby == "monitor":
+            return monitor_shard(user_id, self.workers)
+
+        # Tests we don't know about go to the first worker so they get
+        # logged and acknowledged there
+        return self.testmap.get(test, 0)
+
 def run_module(tests, config, key, exchange, queueid):
     signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # make sure the decoding pool gets cleaned up if we are terminated
+    signal.signal(signal.SIGTERM, _terminate)
     amp = AmpModule(tests, config, key, exchange, queueid)
-    amp.run()
+    try:
+        amp.run()
+    finally:
+        amp.close()
+
+    if amp.pubthread:
+        amp.pubthread.join()
+
+def run_worker(tests, config, key, exchange, queueid, shard, inqueue,
+        results, generation):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, _terminate)
+    amp = AmpModule(tests, config, key, exchange, queueid, shard)
+    try:
+        amp.run_shard(inqueue, results, generation)
+    finally:
+        amp.close()
 
     if amp.pubthread:
         amp.pubthread.join()
 
+def run_dispatcher(config, shardconf, workerqueues, results, generation):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    batchconf = get_batch_config(config)
+
+    srcconf = get_source_config(config)
+    router = AmpShardRouter(shardconf["shardby"], shardconf["workers"])
+    source = ShardDispatcher(srcconf["queue"], srcconf["host"],
+            srcconf["port"], srcconf["ssl"], srcconf["username"],
+            srcconf["password"], router, workerqueues, results, generation)
+
+    # Every worker needs to be able to build up a full batch
+    source.configure([], batchconf["maxcommitfreq"] * shardconf["workers"])
+
+    logger.log("Dispatching AMP data to %d workers by %s" % \
+            (shardconf["workers"], shardconf["shardby"]))
+    try:
+        source.run()
+    except KeyboardInterrupt:
+        source.halt_consumer()
+
+def create_processes(name, tests, config, key, exchange, queueid):
+    """ Creates the processes needed to ingest AMP data.
+
+        With a single worker this is just one process that reads from the
+        AMP queue and processes everything itself. Otherwise, there is one
+        process per worker plus a dispatcher that reads messages from the
+        AMP queue and shares them out between the workers, either by test
+        type or by monitor.
+    """
+
+    shardconf = get_shard_config(config)
+    workers = shardconf["workers"]
+
+    # daemonic processes aren't allowed to have children, so we can't be
+    # one if we need a decoding pool
+    daemon = (get_decode_workers(config) == 0)
+
+    if workers == 1:
+        p = Process(name=name, target=run_module, args=(tests, config,
+                key, exchange, queueid))
+        p.daemon = daemon
+        return [p]
+
+    if shardconf["shardby"] == "test" and workers > len(SHARD_TEST_ORDER):
+        logger.log("More AMP workers than test types, some will be idle")
+
+    testmap = assign_tests(workers)
+    results = Queue()
+    generation = Value('i', 0)
+    workerqueues = []
+    processes = []
+
+    for w in range(0, workers):
+        shard = {"worker": w, "workers": workers,
+                "shardby": shardconf["shardby"],
+                "tests": [t for t, o in testmap.iteritems() if o == w]}
+        inqueue = Queue()
+        workerqueues.append(inqueue)
+
+        p = Process(name="%s-%d" % (name, w), target=run_worker,
+                args=(tests, config, key, exchange, queueid, shard, inqueue,
+                results, generation))
+        p.daemon = daemon
+        processes.append(p)
+
+    p = Process(name="%s-dispatch" % (name), target=run_dispatcher,
+            args=(config, shardconf, workerqueues, results, generation))
+    p.daemon = True
+    processes.append(p)
+    return processes
+
 def create_cqs(db, influxdb):
 
     for p in [AmpIcmpParser, AmpDnsParser, AmpThroughputParser,
@@ -102,11 +102,11 @@ class AmpDnsParser(NNTSCParser):
 
 
     def _result_to_key(self, res):
-        key = (str(res['source']), str(res['destination']),
-                str(res['instance']),
-                res['address'], str(res['query']), str(res['query_type']),
-                str(res['query_class']), str(res['udp_payload_size']),
-                res['recurse'], res['dnssec'], res['nsid'])
+        key = self.streams.make_key((res['source'], res['destination'],
+                res['instance'], res['address'], res['query'],
+                res['query_type'], res['query_class'],
+                res['udp_payload_size'], res['recurse'], res['dnssec'],
+                res['nsid']))
 
         return key
 
@@ -115,8 +115,9 @@ class AmpDnsParser(NNTSCParser):
         self.streams[key] = stream_data['stream_id']
 
 
-    def process_data(self, timestamp, data, source):
-        done = {}
+    def prepare_data(self, data, source, derived=None):
+        """ Splits each DNS result into its stream and data properties """
+        prepared = []
 
         for r in data['results']:
             streamresult, dataresult = self._split_result(data, r)
@@ -125,6 +126,30 @@ class AmpDnsParser(NNTSCParser):
             streamresult['source'] = source
             key = self._result_to_key(streamresult)
 
+            if dataresult.get('query_len', 0) > 0:
+                # we sent a query, check if we got a result
+                dataresult['requests'] = 1
+                if dataresult.get('response_size', 0) > 0:
+                    dataresult['lossrate'] = 0.0
+                else:
+                    dataresult['lossrate'] = 1.0
+            else:
+                # no query could be sent, so this is an odd case of loss
+                dataresult['requests'] = 0
+                dataresult['lossrate'] = None
+
+            prepared.append((key, streamresult, dataresult))
+
+        return prepared
+
+    def process_data(self, timestamp, data, source):
+        self.process_prepared(timestamp, self.prepare_data(data, source),
+                source)
+
+    def process_prepared(self, timestamp, prepared, source):
+        done = {}
+
+        for key, streamresult, dataresult in prepared:
             if key in self.streams:
                 stream_id = self.streams[key]
 
@@ -140,22 +165,10 @@ class AmpDnsParser(NNTSCParser):
                     return
                 self.streams[key] = stream_id
 
-            if dataresult.get('query_len', 0) > 0:
-                # we sent a query, check if we got a result
-                dataresult['requests'] = 1
-                if dataresult.get('response_size', 0) > 0:
-                    dataresult['lossrate'] = 0.0
-                else:
-                    dataresult['lossrate'] = 1.0
-            else:
-                # no query could be sent, so this is an odd case of loss
-                dataresult['requests'] = 0
-                dataresult['lossrate'] = None
-
             self.insert_data(stream_id, timestamp, dataresult)
             done[stream_id] = 0
 
-        self.db.update_timestamp(self.datatable, done.keys(), timestamp,
+        self._update_timestamp(self.datatable, done.keys(), timestamp,
                 self.have_influx)
 
 
@@ -72,11 +72,8 @@ class AmpExternalParser(NNTSCParser):
 
     # convert stream properties into a key
     def _stream_key(self, stream_data):
-        key = ()
-        for column in self.uniquecolumns:
-            value = stream_data[column]
-            key += (value,)
-        return key
+        return self.streams.make_key([stream_data[column] \
+                for column in self.uniquecolumns])
 
     # convert raw data into stream properties
     def _stream_properties(self, data):
@@ -117,7 +114,7 @@ class AmpExternalParser(NNTSCParser):
                 self.streams[key] = stream_id
 
             self.insert_data(stream_id, timestamp, result)
-            self.db.update_timestamp(self.datatable, [stream_id], timestamp,
+            self._update_timestamp(self.datatable, [stream_id], timestamp,
                     self.have_influx)
 
 # vim: set sw=4 tabstop=4 softtabstop=4 expandtab :
@@ -30,6 +30,7 @@
 
 from libnntsc.parsers.common import NNTSCParser
 from libnntsc.dberrorcodes import DB_DATA_ERROR
+from libnntsc.packedarray import pack_array
 import libnntscclient.logger as logger
 
 class AmpFastpingParser(NNTSCParser):
@@ -44,6 +45,12 @@ class AmpFastpingParser(NNTSCParser):
         self.source = "amp"
         self.module = "fastping"
 
+        # influx has no array type, so the percentiles are packed into a string
+        if self.influxdb:
+            self.datacasts = {"percentiles":pack_array}
+        else:
+            self.datacasts = {"percentiles":"integer[]"}
+
         self.streamcolumns = [
             {"name":"source", "type":"varchar", "null":False},
             {"name":"destination", "type":"varchar", "null":False},
@@ -80,12 +87,8 @@ class AmpFastpingParser(NNTSCParser):
 
     # convert stream properties into a key
     def _stream_key(self, stream_data):
-        key = ()
-        for column in self.uniquecolumns:
-            value = stream_data[column]
-
-            key += (value,)
-        return key
+        return self.streams.make_key([stream_data[column] \
+                for column in self.uniquecolumns])
 
     # convert raw data into stream properties
     def _stream_properties(self, data):
@@ -111,12 +114,13 @@ class AmpFastpingParser(NNTSCParser):
     def _mangle_result(self, data):
         # Our columns are slightly different to the names that AMPsave uses,
         # so we'll have to mangle them to match what we're expecting
-        key = self._stream_key(self._stream_properties(data))
+        props = self._stream_properties(data)
+        key = self._stream_key(props)
 
         mangled = {}
-        mangled['source'] = key[0]
-        mangled['destination'] = key[1]
-        mangled['family'] = key[2]
+        mangled['source'] = props['source']
+        mangled['destination'] = props['destination']
+        mangled['family'] = props['family']
 
         # XXX why is there a results array when we can only have one?
         if data['results'][0]['runtime']:
@@ -124,7 +128,8 @@ class AmpFastpingParser(NNTSCParser):
             if rtt:
                 # TODO we can do better than a random offset into a list
                 mangled['median'] = int(rtt['percentiles'][8])
-                mangled['lossrate'] = 1.0 - (rtt['samples'] / float(key[5]))
+                mangled['lossrate'] = 1.0 - (rtt['samples'] /
+                        float(props['packet_count']))
                 mangled['percentiles'] = rtt['percentiles']
             else:
                 mangled['median'] = None
@@ -154,12 +159,8 @@ class AmpFastpingParser(NNTSCParser):
                 return
             self.streams[key] = stream_id
 
-        if self.influxdb:
-            casts = {"percentiles":str}
-        else:
-            casts = {"percentiles":"integer[]"}
-        self.insert_data(stream_id, timestamp, mangled, casts)
-        self.db.update_timestamp(self.datatable, [stream_id], timestamp,
+        self.insert_data(stream_id, timestamp, mangled)
+        self._update_timestamp(self.datatable, [stream_id], timestamp,
                 self.have_influx)
 
 # vim: set sw=4 tabstop=4 softtabstop=4 expandtab :
@@ -82,7 +82,7 @@ class AmpHttpParser(NNTSCParser):
         ]
 
 
-    def _stream_key(self, stream_data):
+    def _stream_parts(self, stream_data):
         src = str(stream_data["source"])
 
         if 'url' in stream_data:
@@ -107,9 +107,11 @@ class AmpHttpParser(NNTSCParser):
             persist = stream_data['persist']
         caching = stream_data['caching']
 
-        key = (src, dest, max_c, max_cps, max_pcps, pipe_max, persist, pipe, caching)
+        return (src, dest, max_c, max_cps, max_pcps, pipe_max, persist, pipe,
+                caching)
 
-        return key
+    def _stream_key(self, stream_data):
+        return self.streams.make_key(self._stream_parts(stream_data))
 
     def create_existing_stream(self, stream_data):
         """Extract the stream key from the stream data provided by NNTSC
@@ -121,18 +123,19 @@ class AmpHttpParser(NNTSCParser):
     def _mangle_result(self, data):
         # Our columns are slightly different to the names that AMPsave uses,
         # so we'll have to mangle them to match what we're expecting
-        key = self._stream_key(data)
+        parts = self._stream_parts(data)
+        key = self.streams.make_key(parts)
 
         mangled = {}
-        mangled['source'] = key[0]
-        mangled['destination'] = key[1]
-        mangled['max_connections'] = key[2]
-        mangled['max_connections_per_server'] = key[3]
-        mangled['max_persistent_connections_per_server'] = key[4]
-        mangled['pipelining_max_requests'] = key[5]
-        mangled['persist'] = key[6]
-        mangled['pipelining'] = key[7]
-        mangled['caching'] = key[8]
+        mangled['source'] = parts[0]
+        mangled['destination'] = parts[1]
+        mangled['max_connections'] = parts[2]
+        mangled['max_connections_per_server'] = parts[3]
+        mangled['max_persistent_connections_per_server'] = parts[4]
+        mangled['pipelining_max_requests'] = parts[5]
+        mangled['persist'] = parts[6]
+        mangled['pipelining'] = parts[7]
+        mangled['caching'] = parts[8]
 
         mangled['server_count'] = data['server_count']
         mangled['object_count'] = data['object_count']
@@ -146,10 +149,16 @@ class AmpHttpParser(NNTSCParser):
 
         return mangled, key
 
-    def process_data(self, timestamp, data, source):
+    def prepare_data(self, data, source, derived=None):
         data['source'] = source
+        return self._mangle_result(data)
+
+    def process_data(self, timestamp, data, source):
+        self.process_prepared(timestamp, self.prepare_data(data, source),
+                source)
 
-        mangled, key = self._mangle_result(data)
+    def process_prepared(self, timestamp, prepared, source):
+        mangled, key = prepared
 
         if key in self.streams:
             stream_id = self.streams[key]
@@ -164,7 +173,7 @@ class AmpHttpParser(NNTSCParser):
             self.streams[key] = stream_id
 
         self.insert_data(stream_id, timestamp, mangled)
-        self.db.update_timestamp(self.datatable, [stream_id], timestamp,
+        self._update_timestamp(self.datatable, [stream_id], timestamp,
                 self.have_influx)
 
 # vim: set sw=4 tabstop=4 softtabstop=4 expandtab :
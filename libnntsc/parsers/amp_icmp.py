@@ -30,6 +30,7 @@
 
 from libnntsc.parsers.common import NNTSCParser
 from libnntsc.dberrorcodes import DB_DATA_ERROR
+from libnntsc.packedarray import pack_array
 import libnntscclient.logger as logger
 
 class AmpIcmpParser(NNTSCParser):
@@ -44,6 +45,12 @@ class AmpIcmpParser(NNTSCParser):
         self.source = "amp"
         self.module = "icmp"
 
+        # influx has no array type, so the rtts are packed into a string
+        if self.influxdb:
+            self.datacasts = {"rtts":pack_array}
+        else:
+            self.datacasts = {"rtts":"integer[]"}
+
         self.streamcolumns = [
             {"name":"source", "type":"varchar", "null":False},
             {"name":"destination", "type":"varchar", "null":False},
@@ -89,7 +96,7 @@ class AmpIcmpParser(NNTSCParser):
         size = str(stream_data["packet_size"])
         streamid = stream_data["stream_id"]
 
-        key = (src, dest, family, size)
+        key = self.streams.make_key((src, dest, family, size))
 
         self.streams[key] = streamid
 
@@ -125,8 +132,8 @@ class AmpIcmpParser(NNTSCParser):
         props['family'] = family
         props['packet_size'] = sizestr
 
-        key = (props['source'], props['destination'], props['family'], \
-                props['packet_size'])
+        key = self.streams.make_key((props['source'], props['destination'],
+                props['family'], props['packet_size']))
         return props, key
 
     def _mangle_result(self, result):
@@ -206,14 +213,10 @@ class AmpIcmpParser(NNTSCParser):
         for sid, streamdata in observed.iteritems():
             self._aggregate_streamdata(streamdata)
 
-            if self.influxdb:
-                casts = {"rtts":str}
-            else:
-                casts = {"rtts":"integer[]"}
-            self.insert_data(sid, timestamp, streamdata, casts)
+            self.insert_data(sid, timestamp, streamdata)
 
         # update the last timestamp for all streams we just got data for
-        self.db.update_timestamp(self.datatable, observed.keys(), timestamp,
+        self._update_timestamp(self.datatable, observed.keys(), timestamp,
                 self.have_influx)
 
 # vim: set sw=4 tabstop=4 softtabstop=4 expandtab :
@@ -131,8 +131,8 @@ class AmpSipParser(NNTSCParser):
         max_duration = str(streamdata["max_duration"])
         dscp = str(streamdata["dscp"])
 
-        return (src, dest, proxy, address, direction, filename, repeat,
-                max_duration, dscp)
+        return self.streams.make_key((src, dest, proxy, address, direction,
+                filename, repeat, max_duration, dscp))
 
 
     def _process_single_result(self, timestamp, resdict):
@@ -197,7 +197,7 @@ class AmpSipParser(NNTSCParser):
                     return
                 done[streamid] = 0
 
-        self.db.update_timestamp(self.datatable, done.keys(), timestamp,
+        self._update_timestamp(self.datatable, done.keys(), timestamp,
                 self.have_influx)
 
 # vim: set sw=4 tabstop=4 softtabstop=4 expandtab :
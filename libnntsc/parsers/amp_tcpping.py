@@ -80,7 +80,7 @@ class AmpTcppingParser(AmpIcmpParser):
         port = str(stream_data['port'])
         size = str(stream_data['packet_size'])
 
-        key = (src, dest, port, family, size)
+        key = self.streams.make_key((src, dest, port, family, size))
         self.streams[key] = stream_data['stream_id']
 
     def _stream_properties(self, source, result):
@@ -121,8 +121,8 @@ class AmpTcppingParser(AmpIcmpParser):
         props['family'] = family
         props['packet_size'] = sizestr
 
-        key = (props['source'], props['destination'], props['port'], \
-                props['family'], props['packet_size'])
+        key = self.streams.make_key((props['source'], props['destination'],
+                props['port'], props['family'], props['packet_size']))
         return props, key
 
 
@@ -89,8 +89,8 @@ class AmpThroughputParser(NNTSCParser):
         reused = stream_data["tcpreused"]
         protocol = str(stream_data["protocol"])
 
-        key = (src, dest, direction, remote, duration, writesize, reused,
-                protocol)
+        key = self.streams.make_key((src, dest, direction, remote, duration,
+                writesize, reused, protocol))
         return key
 
     def create_existing_stream(self, stream_data):
@@ -122,8 +122,8 @@ class AmpThroughputParser(NNTSCParser):
         return stream_id
 
 
-    def process_data(self, timestamp, data, source):
-        done = {}
+    def prepare_data(self, data, source, derived=None):
+        prepared = []
         for result in data['results']:
             resdict = {}
             resdict['source'] = source
@@ -157,12 +157,24 @@ class AmpThroughputParser(NNTSCParser):
                 resdict['packets'] = None
             resdict['tcpreused'] = result['tcpreused']
 
+            prepared.append(resdict)
+
+        return prepared
+
+    def process_data(self, timestamp, data, source):
+        self.process_prepared(timestamp, self.prepare_data(data, source),
+                source)
+
+    def process_prepared(self, timestamp, prepared, source):
+        done = {}
+
+        for resdict in prepared:
             streamid = self._process_single_result(timestamp, resdict)
             if streamid < 0:
                 return
             done[streamid] = 0
 
-        self.db.update_timestamp(self.datatable, done.keys(), timestamp,
+        self._update_timestamp(self.datatable, done.keys(), timestamp,
                 self.have_influx)
 
 # vim: set sw=4 tabstop=4 softtabstop=4 expandtab :
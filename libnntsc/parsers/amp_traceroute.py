@@ -29,13 +29,31 @@
 #
 
 
-import time
 from libnntsc.dberrorcodes import DBQueryException
 from libnntsc.dberrorcodes import DB_CODING_ERROR, DB_DATA_ERROR
+from libnntsc.lrucache import LRUCache
 import libnntscclient.logger as logger
 from libnntsc.parsers.amp_icmp import AmpIcmpParser
+from libnntsc.parsers.common import DerivedDataCache
 
-PATH_FLUSH_FREQ = 60 * 60
+# Maximum number of path ids to remember for each type of path
+PATH_CACHE_SIZE = 250000
+ASPATH_CACHE_SIZE = 50000
+
+# Tables holding the paths shared by every stream, if pathstorage is "global"
+GLOBAL_PATH_TABLE = "traceroute_path_dictionary"
+GLOBAL_ASPATH_TABLE = "traceroute_aspath_dictionary"
+
+def path_hash_sql(column):
+    """ Returns an SQL expression for the 64 bit hash of the path (an
+        array of either addresses or AS hops) in the given column.
+
+        The hash is always calculated by the database, so that paths that
+        were written differently but cast to the same array get the same
+        hash.
+    """
+    return "('x' || substr(md5(array_to_string(%s, ',', '*')), 1, 16))" \
+            "::bit(64)::bigint" % (column)
 
 class AmpTracerouteParser(AmpIcmpParser):
     def __init__(self, db):
@@ -48,11 +66,24 @@ class AmpTracerouteParser(AmpIcmpParser):
         self.source = "amp"
         self.module = "traceroute"
 
-        self.paths = {}
-        self.aspaths = {}
+        # path ids that are known to have been committed, and those that
+        # were looked up or added as part of the current transaction
+        self.paths = LRUCache(PATH_CACHE_SIZE)
+        self.aspaths = LRUCache(ASPATH_CACHE_SIZE)
         self.pending_paths = {}
         self.pending_aspaths = {}
 
+        # If set, paths are stored once in a global dictionary rather than
+        # in separate paths tables for each stream. Parsers that are only
+        # used for decoding (e.g. in the decode pool) have no database.
+        self.globalpaths = \
+                (getattr(db, "pathstorage", "stream") == "global")
+
+        # If set, the data for every stream goes into the same (partitioned)
+        # data tables rather than a separate table for each stream
+        self.partitioned = \
+                (getattr(db, "datalayout", "stream") == "partitioned")
+
         self.ipdatacolumns = [
             {"name":"path_id", "type":"integer", "null":False},
             {"name":"aspath_id", "type":"integer", "null":True},
@@ -72,10 +103,6 @@ class AmpTracerouteParser(AmpIcmpParser):
         self.ascollectionid = None
         self.ipcollectionid = None
 
-        now = int(time.time())
-        self.nextpathflush = (now - (now % PATH_FLUSH_FREQ)) + \
-                PATH_FLUSH_FREQ
-
     def data_table(self):
         self.db.create_data_table(self.asdatatable, self.asdatacolumns)
         self._create_indexes(self.asdatatable, [])
@@ -117,6 +144,49 @@ class AmpTracerouteParser(AmpIcmpParser):
             logger.log("Error was: %s" % (str(e)))
             raise
 
+        if self.globalpaths:
+            self.create_path_dictionaries()
+
+    def create_path_dictionaries(self):
+        """ Creates the global path dictionaries, which are shared by all
+            of the traceroute streams. Paths are found using a unique index
+            on the hash of each path and the path itself, so that the same
+            path can't be added twice by processes writing at the same
+            time.
+        """
+        aspathcols = [ \
+            {"name":"aspath_id", "type":"serial primary key"},
+            {"name":"aspath_hash", "type":"bigint", "null":False},
+            {"name":"aspath", "type":"varchar[]", "null":False},
+            {"name":"aspath_length", "type":"smallint", "null":False},
+            {"name":"uniqueas", "type":"smallint", "null":False},
+            {"name":"responses", "type":"smallint", "null":False},
+        ]
+
+        pathcols = [ \
+            {"name":"path_id", "type":"serial primary key"},
+            {"name":"path_hash", "type":"bigint", "null":False},
+            {"name":"path", "type":"inet[]", "null":False},
+            {"name":"length", "type":"smallint", "null":False},
+        ]
+
+        try:
+            self.db.create_misc_table(GLOBAL_ASPATH_TABLE, aspathcols)
+            self.db.create_misc_table(GLOBAL_PATH_TABLE, pathcols)
+        except DBQueryException as e:
+            logger.log("Failed to create path dictionaries for %s" % \
+                    (self.colname))
+            logger.log("Error was: %s" % (str(e)))
+            raise
+
+        self._create_indexes(GLOBAL_ASPATH_TABLE,
+                [{"name":"%s_aspath_key" % (GLOBAL_ASPATH_TABLE),
+                "columns":["aspath_hash", "aspath"], "unique":True}])
+        self._create_indexes(GLOBAL_PATH_TABLE,
+                [{"name":"%s_path_key" % (GLOBAL_PATH_TABLE),
+                "columns":["path_hash", "path"], "unique":True}])
+        self.db.commit_streams()
+
     def register(self):
         # Very similar to the parent class, but we have to register two
         # collections instead of just one.
@@ -157,6 +227,22 @@ class AmpTracerouteParser(AmpIcmpParser):
         # create_new_stream provided by the NNTSCParser class.
         """ Insert a new traceroute stream into the streams table """
 
+        if self.queuestreams:
+            return self._queue_stream(streamparams, timestamp)
+
+        streamid = self._insert_new_stream(streamparams, timestamp)
+
+        try:
+            self.db.commit_streams()
+        except DBQueryException as e:
+            logger.log("Failed to commit new stream for %s" % (self.colname))
+            logger.log("Error was: %s" % (str(e)))
+            raise
+
+        self._publish_stream(streamid, streamparams)
+        return streamid
+
+    def _insert_new_stream(self, streamparams, timestamp):
         # This will automatically clone the ipdatatable
         try:
             streamid = self.db.insert_stream(self.streamtable,
@@ -168,7 +254,8 @@ class AmpTracerouteParser(AmpIcmpParser):
 
         # Manually clone the AS data table
         try:
-            self.db.clone_table("data_amp_astraceroute", streamid)
+            if not self.partitioned:
+                self.db.clone_table("data_amp_astraceroute", streamid)
         except DBQueryException as e:
             logger.log("Failed to clone AS data table for new %s stream" % \
                     (self.colname))
@@ -177,9 +264,37 @@ class AmpTracerouteParser(AmpIcmpParser):
 
         # Don't forget to set the 'first' timestamp (just like insert_stream
         # does).
-        self.db.update_timestamp("data_amp_astraceroute", [streamid],
+        self._update_timestamp("data_amp_astraceroute", [streamid],
                 timestamp, False)
 
+        if not self.globalpaths:
+            self._clone_path_tables(streamid)
+
+        # The shared data tables can't refer to any one stream's paths
+        if self.partitioned:
+            return streamid
+
+        try:
+            # Ensure our custom foreign keys gets perpetuated
+            ipdatatable = "%s_%d" % (self.ipdatatable, streamid)
+            asdatatable = "%s_%d" % (self.asdatatable, streamid)
+            pathtable, aspathtable = self._path_tables(streamid)
+
+            self.db.add_foreign_key(asdatatable, "aspath_id", aspathtable,
+                    "aspath_id")
+            self.db.add_foreign_key(ipdatatable, "aspath_id", aspathtable,
+                    "aspath_id")
+            self.db.add_foreign_key(ipdatatable, "path_id", pathtable,
+                    "path_id")
+        except DBQueryException as e:
+            logger.log("Failed to add foreign key to paths tables for %s" \
+                    % (self.colname))
+            logger.log("Error was: %s" % (str(e)))
+            raise
+
+        return streamid
+
+    def _clone_path_tables(self, streamid):
         try:
             self.db.clone_table("data_amp_traceroute_aspaths",
                     streamid)
@@ -198,51 +313,127 @@ class AmpTracerouteParser(AmpIcmpParser):
             logger.log("Error was: %s" % (str(e)))
             raise
 
-        try:
-            # Ensure our custom foreign keys gets perpetuated
-            ipdatatable = "%s_%d" % (self.ipdatatable, streamid)
-            asdatatable = "%s_%d" % (self.asdatatable, streamid)
-            pathtable = "data_amp_traceroute_paths_%d" % (streamid)
-            aspathtable = "data_amp_traceroute_aspaths_%d" % (streamid)
+    def migrate_paths(self, streamid):
+        """ Moves the paths for a stream out of its own paths tables and
+            into the global path dictionaries, rewriting the path ids in
+            the stream's data tables to match. The per-stream paths tables
+            are dropped afterwards.
 
-            self.db.add_foreign_key(asdatatable, "aspath_id", aspathtable,
-                    "aspath_id")
-            self.db.add_foreign_key(ipdatatable, "aspath_id", aspathtable,
-                    "aspath_id")
-            self.db.add_foreign_key(ipdatatable, "path_id", pathtable,
-                    "path_id")
-        except DBQueryException as e:
-            logger.log("Failed to add foreign key to paths tables for %s" \
-                    % (self.colname))
-            logger.log("Error was: %s" % (str(e)))
-            raise
+            Each stream is migrated in its own transaction, so an
+            interrupted migration can be safely run again.
+
+            Returns False if the stream has already been migrated.
+        """
+        pathtable = "data_amp_traceroute_paths_%d" % (streamid)
+        aspathtable = "data_amp_traceroute_aspaths_%d" % (streamid)
+
+        if not self.db.table_exists(pathtable):
+            return False
 
         try:
+            self._merge_paths(pathtable, GLOBAL_PATH_TABLE, "path_id",
+                    ["path", "length"])
+            self._merge_paths(aspathtable, GLOBAL_ASPATH_TABLE, "aspath_id",
+                    ["aspath", "aspath_length", "uniqueas", "responses"])
+
+            # this also removes the foreign keys that refer to the old tables
+            self.db.custom_query("DROP TABLE %s, %s CASCADE" % (pathtable,
+                    aspathtable))
+
+            for table, columns in [(self.ipdatatable, ["path_id",
+                    "aspath_id"]), (self.asdatatable, ["aspath_id"])]:
+                self._remap_path_ids(table, streamid, columns)
             self.db.commit_streams()
         except DBQueryException as e:
-            logger.log("Failed to commit new stream for %s" % (self.colname))
+            logger.log("Failed to migrate paths for %s stream %d" % \
+                    (self.colname, streamid))
             logger.log("Error was: %s" % (str(e)))
+            self.db.rollback_streams()
             raise
 
+        return True
+
+    def _remap_path_ids(self, datatable, streamid, columns):
+        """ Rewrites the path ids in a stream's data using the mapping
+            tables built by _merge_paths().
+        """
+        # With the partitioned data layout, the stream's data is in the
+        # shared data table, apart from anything that is still waiting to
+        # be moved out of the stream's old data table
+        oldtable = "%s_%d" % (datatable, streamid)
+        tables = []
+        if self.partitioned:
+            tables.append((datatable, "AND t.stream_id = %d" % (streamid)))
+        if not self.partitioned or self.db.table_exists(oldtable):
+            tables.append((oldtable, ""))
+
+        for table, where in tables:
+            for column in columns:
+                self.db.custom_query("UPDATE %s t SET %s = m.newid " \
+                        "FROM %s_map m WHERE t.%s = m.oldid AND " \
+                        "m.oldid != m.newid %s" % (table, column, column,
+                        column, where))
+
+        if not self.partitioned or len(tables) > 1:
+            for column in columns:
+                if column == "path_id":
+                    dictionary = GLOBAL_PATH_TABLE
+                else:
+                    dictionary = GLOBAL_ASPATH_TABLE
+                self.db.add_foreign_key(oldtable, column, dictionary, column)
+
+    def _merge_paths(self, pathtable, dictionary, idcol, columns):
+        """ Adds the paths from a per-stream paths table to a global
+            dictionary, and builds a temporary table that maps the old
+            path ids to their ids in the dictionary.
+        """
+        pathcol = columns[0]
+        pathhash = path_hash_sql("o.%s" % (pathcol))
+        match = "d.%s_hash = %s AND d.%s = o.%s" % (pathcol, pathhash,
+                pathcol, pathcol)
+
+        sql = "INSERT INTO %s (%s_hash, %s) " % (dictionary, pathcol,
+                ", ".join(columns))
+        sql += "SELECT %s, %s FROM %s o " % (pathhash,
+                ", ".join(["o.%s" % (c) for c in columns]), pathtable)
+        sql += "WHERE NOT EXISTS (SELECT 1 FROM %s d WHERE %s) " % \
+                (dictionary, match)
+        sql += "ON CONFLICT DO NOTHING"
+        self.db.custom_query(sql)
+
+        sql = "CREATE TEMPORARY TABLE %s_map ON COMMIT DROP AS " % (idcol)
+        sql += "SELECT o.%s AS oldid, min(d.%s) AS newid " % (idcol, idcol)
+        sql += "FROM %s o JOIN %s d ON %s GROUP BY o.%s" % (pathtable,
+                dictionary, match, idcol)
+        self.db.custom_query(sql)
+
+    def _path_tables(self, stream):
+        """ Returns the names of the IP and AS paths tables that hold the
+            paths for a stream.
+        """
+        if self.globalpaths:
+            return GLOBAL_PATH_TABLE, GLOBAL_ASPATH_TABLE
+        return "data_amp_traceroute_paths_%d" % (stream), \
+                "data_amp_traceroute_aspaths_%d" % (stream)
+
+    def _publish_stream(self, streamid, streamparams):
         if self.exporter is None:
-            return streamid
+            return
 
         colid = self._get_iptraceroute_collection_id()
         if colid <= 0:
-            return streamid
+            return
 
         self.exporter.publishStream(colid, "amp-traceroute", streamid,
                 streamparams)
 
         colid = self._get_astraceroute_collection_id()
         if colid <= 0:
-            return streamid
+            return
 
         self.exporter.publishStream(colid, "amp-astraceroute", streamid,
                 streamparams)
 
-        return streamid
-
     def _get_collection_id(self, module):
         try:
             colid = self.db.get_collection_id(self.source, module)
@@ -276,103 +467,229 @@ class AmpTracerouteParser(AmpIcmpParser):
 
         return self.ipcollectionid
 
-    def _ippath_insertion_sql(self, stream, pathdata):
-        pathtable = "data_amp_traceroute_paths_%d" % stream
-
-        pathinsert = "WITH s AS (SELECT path_id, path FROM %s " % pathtable
-        pathinsert += "WHERE path = CAST (%s as inet[])), "
-        pathinsert += "i AS (INSERT INTO %s (path, length) " % pathtable
-        pathinsert += "SELECT CAST(%s as inet[]), %s "
-        pathinsert += "WHERE NOT EXISTS "
-        pathinsert += "(SELECT path FROM %s WHERE path " % pathtable
-        pathinsert += "= CAST(%s as inet[])) RETURNING path_id, path) "
-        pathinsert += "SELECT path_id,path FROM i UNION ALL "
-        pathinsert += "SELECT path_id,path FROM s"
-
-        path = pathdata['path']
-        params = (path, path, pathdata['length'], path)
-
-        return pathinsert, params
-
-    def _aspath_insertion_sql(self, stream, pathdata):
-        pathtable = "data_amp_traceroute_aspaths_%d" % stream
-
-        pathinsert = "WITH s AS (SELECT aspath_id, aspath FROM %s " % pathtable
-        pathinsert += "WHERE aspath = CAST (%s as varchar[])), "
-        pathinsert += "i AS (INSERT INTO %s " % pathtable
-        pathinsert += "(aspath, aspath_length, uniqueas, responses) "
-        pathinsert += "SELECT CAST(%s as varchar[]), %s, %s, %s "
-        pathinsert += "WHERE NOT EXISTS "
-        pathinsert += "(SELECT aspath FROM %s WHERE aspath " % pathtable
-        pathinsert += "= CAST(%s as varchar[])) RETURNING aspath_id, aspath) "
-        pathinsert += "SELECT aspath_id,aspath FROM i UNION ALL "
-        pathinsert += "SELECT aspath_id,aspath FROM s"
-
-        path = pathdata['aspath']
-        params = (path, path, pathdata['aspathlen'], pathdata['uniqueas'], \
-                pathdata['responses'], path)
-
-        return pathinsert, params
-
-    def _insert_path(self, pathtype, stream, path):
-        if pathtype == "ip":
-            pathinsert, params = self._ippath_insertion_sql(stream, path)
+    def _path_insertion_sql(self, pathtable, idcol, columns, rows):
+        """ Builds a query that finds the ids for a list of paths in a
+            paths table, inserting any paths that aren't there yet. The
+            first column must be the path itself.
 
-        elif pathtype == "as":
-            pathinsert, params = self._aspath_insertion_sql(stream, path)
+            Paths in the global dictionaries are matched using their hash
+            as well, so that the index on the hash can be used.
+
+            Paths that are added by someone else while the query is running
+            are skipped rather than added twice, but their ids are not
+            returned either -- see _insert_paths().
+        """
+        names = [c[0] for c in columns]
+        pathcol = names[0]
+
+        values = []
+        params = []
+        rowsql = "(%s, " + ", ".join(["CAST(%%s AS %s)" % (c[1]) \
+                for c in columns]) + ")"
+        for n, row in enumerate(rows):
+            values.append(rowsql)
+            params += [n] + row
+
+        sql = "WITH v (n, %s) AS (VALUES %s), " % (", ".join(names),
+                ", ".join(values))
+
+        if self.globalpaths:
+            hashcol = "%s_hash" % (pathcol)
+            sql += "h AS (SELECT v.*, %s AS %s FROM v), " % \
+                    (path_hash_sql("v.%s" % (pathcol)), hashcol)
+            src = "h"
+            names = [hashcol] + names
+            keycols = [hashcol, pathcol]
         else:
-            return DB_CODING_ERROR
+            src = "v"
+            keycols = [pathcol]
+
+        def match(alias):
+            return " AND ".join(["%s.%s = %s.%s" % (alias, k, src, k) \
+                    for k in keycols])
+
+        sql += "i AS (INSERT INTO %s (%s) " % (pathtable, ", ".join(names))
+        sql += "SELECT %s FROM %s WHERE NOT EXISTS " % (", ".join(names), src)
+        sql += "(SELECT 1 FROM %s p WHERE %s) " % (pathtable, match("p"))
+        sql += "ON CONFLICT DO NOTHING "
+        sql += "RETURNING %s, %s) " % (idcol, ", ".join(keycols))
+        sql += "SELECT %s.n, i.%s FROM %s JOIN i ON %s " % (src, idcol, src,
+                match("i"))
+        sql += "UNION ALL SELECT %s.n, p.%s FROM %s " % (src, idcol, src)
+        sql += "JOIN %s p ON %s" % (pathtable, match("p"))
+
+        return sql, params
+
+    def _ippath_insertion_sql(self, stream, paths):
+        pathtable = self._path_tables(stream)[0]
+        columns = [("path", "inet[]"), ("length", "smallint")]
+        rows = [[p['path'], p['length']] for p in paths]
+
+        return self._path_insertion_sql(pathtable, "path_id", columns, rows)
+
+    def _aspath_insertion_sql(self, stream, paths):
+        pathtable = self._path_tables(stream)[1]
+        columns = [("aspath", "varchar[]"), ("aspath_length", "smallint"),
+                ("uniqueas", "smallint"), ("responses", "smallint")]
+        rows = [[p['aspath'], p['aspathlen'], p['uniqueas'], p['responses']] \
+                for p in paths]
+
+        return self._path_insertion_sql(pathtable, "aspath_id", columns, rows)
+
+    def _insert_paths(self, pathtype, stream, paths):
+        """ Finds the ids for a list of paths belonging to a stream, adding
+            any paths that are new. All of the paths are dealt with using a
+            single query.
+
+            Returns a list of path ids in the same order as the paths.
+        """
+        pathids = self._query_path_ids(pathtype, stream, paths)
+
+        # Paths that another process added while our query was running
+        # (or that appeared twice in the query) were skipped without
+        # returning an id. A new query will be able to see them.
+        missing = [i for i, pathid in enumerate(pathids) if pathid is None]
+        if len(missing) > 0:
+            found = self._query_path_ids(pathtype, stream,
+                    [paths[i] for i in missing])
+            for i, pathid in zip(missing, found):
+                pathids[i] = pathid
+
+        if None in pathids:
+            logger.log("No query result when getting path_id for %s (stream %s)" % \
+                    (self.colname, stream))
+            raise DBQueryException(DB_DATA_ERROR)
 
+        return pathids
+
+    def _query_path_ids(self, pathtype, stream, paths):
+        """ Runs a single query to find or add a list of paths, returning
+            their ids in the same order as the paths. Any paths that the
+            query didn't return an id for are None.
+        """
+        if pathtype == "ip":
+            pathinsert, params = self._ippath_insertion_sql(stream, paths)
+        elif pathtype == "as":
+            pathinsert, params = self._aspath_insertion_sql(stream, paths)
+        else:
+            raise DBQueryException(DB_CODING_ERROR)
 
         try:
-            queryret = self.db.custom_insert(pathinsert, params)
+            queryret = self.db.custom_insert_rows(pathinsert, params)
         except DBQueryException as e:
-            logger.log("Failed to get path_id for %s test result (stream %d)" \
+            logger.log("Failed to get path_id for %s test result (stream %s)" \
                     % (self.colname, stream))
             logger.log("Error was: %s" % (str(e)))
             raise
 
-        if queryret is None:
-            logger.log("No query result when getting path_id for %s (stream %d)" % \
-                    (self.colname, stream))
-            raise DBQueryException(DB_DATA_ERROR)
+        pathids = [None] * len(paths)
+        for n, pathid in queryret:
+            pathids[n] = int(pathid)
+        return pathids
+
+    def _path_caches(self, pathtype):
+        if pathtype == "ip":
+            return self.pending_paths, self.paths
+        return self.pending_aspaths, self.aspaths
+
+    def _path_key(self, stream, path):
+        # paths in the global dictionaries have the same id for every stream
+        if self.globalpaths:
+            return (None, tuple(path))
+        return (stream, tuple(path))
+
+    def _find_path(self, pathtype, stream, path, pathdata):
+        """ Returns the id for a single path, adding it to the database
+            if it isn't already there.
+        """
+        pending, cache = self._path_caches(pathtype)
+        key = self._path_key(stream, path)
+
+        if key in pending:
+            return pending[key]
+
+        pathid = cache.get(key)
+        if pathid is None:
+            pathid = self._insert_paths(pathtype, stream, [pathdata])[0]
+            pending[key] = pathid
+        return pathid
+
+    def _resolve_batch_paths(self, batch):
+        """ Looks up the ids of all of the paths seen in a batch of
+            messages, so that any paths that aren't cached can be found or
+            added with one query per paths table rather than one query
+            per path.
+
+            The ids are saved as pending paths, so processing the messages
+            afterwards won't have to go to the database for them.
+        """
+        wanted = {"ip":{}, "as":{}}
+
+        for messageid, timestamp, prepared, source in batch:
+            for d, streamparams, key, hops in prepared:
+                # new streams don't have any paths tables yet
+                if key is None or key not in self.streams:
+                    continue
+                stream = self.streams[key]
+
+                if 'ip' not in d or d['ip'] != 0:
+                    self._want_path(wanted["ip"], "ip", stream, hops['path'],
+                            {"path":hops['path'], "length":d['length']})
+                elif 'as' not in d or d['as'] == 0:
+                    continue
+
+                if len(hops['aspath']) > 0:
+                    self._want_path(wanted["as"], "as", stream,
+                            hops['aspath'], hops)
+
+        for pathtype, streams in wanted.iteritems():
+            pending, cache = self._path_caches(pathtype)
+            for stream, paths in streams.iteritems():
+                keys = paths.keys()
+                pathids = self._insert_paths(pathtype, stream,
+                        [paths[k] for k in keys])
+                pending.update(zip(keys, pathids))
+
+    def _want_path(self, wanted, pathtype, stream, path, pathdata):
+        pending, cache = self._path_caches(pathtype)
+        key = self._path_key(stream, path)
+
+        if key in pending:
+            return
+
+        # remember cached paths as pending too, so that they are only
+        # counted as a cache hit once
+        pathid = cache.get(key)
+        if pathid is not None:
+            pending[key] = pathid
+            return
+
+        # paths are looked up together if they are in the same table
+        owner = key[0]
+        if owner not in wanted:
+            wanted[owner] = {}
+        wanted[owner][key] = pathdata
 
-        return int(queryret[0])
+    def path_cache_stats(self):
+        """ Returns the statistics for the IP and AS path caches """
+        return {"ip":self.paths.stats(), "as":self.aspaths.stats()}
 
+    def describe_caches(self):
+        return "IP paths: %s; AS paths: %s" % (self.paths.describe(),
+                self.aspaths.describe())
 
     def insert_ippath(self, stream, ts, result):
         """ Insert data for a single traceroute path into the database """
 
         if 'path' not in result or result['path'] is None:
             return
-        keystr = "%s" % (stream)
-        for p in result['path']:
-            keystr += "_%s" % (p)
 
-        if keystr in self.paths:
-            result['path_id'] = self.paths[keystr][0]
-        else:
-            pathid = self._insert_path("ip", stream, result)
-            if pathid < 0:
-                return
-
-            result['path_id'] = pathid
-            self.pending_paths[keystr] = (pathid, int(time.time()))
+        result['path_id'] = self._find_path("ip", stream, result['path'],
+                result)
 
         if result['aspath'] != None:
-            keystr = "%s" % (stream)
-            for p in result['aspath']:
-                keystr += "_%s" % (p)
-
-            if keystr in self.aspaths:
-                result['aspath_id'] = self.aspaths[keystr][0]
-            else:
-                pathid = self._insert_path("as", stream, result)
-                if pathid < 0:
-                    return
-
-                result['aspath_id'] = pathid
-                self.pending_aspaths[keystr] = (pathid, int(time.time()))
+            result['aspath_id'] = self._find_path("as", stream,
+                    result['aspath'], result)
 
         # XXX Could almost just call parent insert_data here, except for the
         # line where we have to add an entry for "path" before exporting live
@@ -426,23 +743,12 @@ class AmpTracerouteParser(AmpIcmpParser):
                     observed[streamid]['errors'], 1)
 
         if datapoint['aspath'] != None:
-            keystr = "%s" % (streamid)
-            for p in datapoint['aspath']:
-                keystr += "_%s" % (p)
-
             # XXX This is going to insert all observed AS paths, even
             # if they aren't going to appear in the AS-traceroute data
             # table. This may be a tad inefficient, but I imagine we are
             # not going to have many AS paths anyway.
-            if keystr in self.aspaths:
-                aspath_id = self.aspaths[keystr][0]
-            else:
-                pathid = self._insert_path("as", streamid, datapoint)
-                if pathid < 0:
-                    return
-
-                aspath_id = pathid
-                self.pending_aspaths[keystr] = (pathid, int(time.time()))
+            aspath_id = self._find_path("as", streamid, datapoint['aspath'],
+                    datapoint)
 
             if aspath_id not in observed[streamid]['paths']:
                 observed[streamid]['paths'][aspath_id] = { \
@@ -478,16 +784,23 @@ class AmpTracerouteParser(AmpIcmpParser):
             streamdata['responses'] = streamdata['paths'][commonpathid]['responses']
 
 
+    def prepare_data(self, data, source, derived=None):
+        if derived is None:
+            derived = DerivedDataCache()
+        return prepare_traceroute(self, data, source, derived)
+
     def process_data(self, timestamp, data, source):
         """ Process a AMP traceroute message, which can contain 1 or more
             sets of results
         """
+        return self.process_prepared(timestamp,
+                self.prepare_data(data, source), source)
+
+    def process_prepared(self, timestamp, prepared, source):
         asobserved = {}
         ipobserved = {}
 
-        for d in data:
-            streamparams, key = self._stream_properties(source, d)
-
+        for d, streamparams, key, hops in prepared:
             if key is None:
                 logger.log("Failed to determine stream for %s result" % \
                         (self.colname))
@@ -504,7 +817,7 @@ class AmpTracerouteParser(AmpIcmpParser):
             else:
                 streamid = self.streams[key]
 
-            self._extract_paths(d)
+            d = self._path_result(d, hops)
 
             # IP flag tells us if this is intended as an IP traceroute.
             # If the flag isn't present, we're running an old ampsave
@@ -522,16 +835,14 @@ class AmpTracerouteParser(AmpIcmpParser):
             self.insert_aspath(sid, timestamp, streamdata)
 
         # update the last timestamp for all streams we just got data for
-        self.db.update_timestamp(self.ipdatatable, ipobserved.keys(),
+        self._update_timestamp(self.ipdatatable, ipobserved.keys(),
                 timestamp, False)
-        self.db.update_timestamp(self.asdatatable, asobserved.keys(),
+        self._update_timestamp(self.asdatatable, asobserved.keys(),
                 timestamp, False)
 
-        now = int(time.time())
-        if now > self.nextpathflush:
-            self._flush_unused_paths(now)
-            self.nextpathflush = (now - (now % PATH_FLUSH_FREQ)) + \
-                    PATH_FLUSH_FREQ
+    def process_batch(self, batch):
+        self._resolve_batch_paths(batch)
+        super(AmpTracerouteParser, self).process_batch(batch)
 
     def post_commit(self):
         # all pending paths are confirmed to have been committed, move them
@@ -541,22 +852,11 @@ class AmpTracerouteParser(AmpIcmpParser):
         self.pending_paths.clear()
         self.pending_aspaths.clear()
 
-    def _flush_unused_paths(self, now):
-        toremove = []
-        for k, v in self.aspaths.iteritems():
-            if v[1] + PATH_FLUSH_FREQ < now:
-                toremove.append(k)
-
-        for k in toremove:
-            del self.aspaths[k]
-
-        toremove = []
-        for k, v in self.paths.iteritems():
-            if v[1] + PATH_FLUSH_FREQ * 3 < now:
-                toremove.append(k)
-
-        for k in toremove:
-            del self.paths[k]
+    def abort_message(self):
+        # some of the pending path ids may have been rolled back, so play
+        # it safe and look them all up again next time
+        self.pending_paths.clear()
+        self.pending_aspaths.clear()
 
     def insert_aspath(self, stream, ts, result):
         filtered = {}
@@ -585,73 +885,102 @@ class AmpTracerouteParser(AmpIcmpParser):
             self.exporter.publishLiveData(colid, stream, ts, filtered)
 
 
-    def _extract_paths(self, result):
-        aspath = []
-        ippath = []
-        rtts = []
-        currentas = None
-        responses = 0
-        count = 0
-        aspathlen = 0
+    def _path_result(self, result, hops):
+        # Copy the result rather than changing it, it is shared with the
+        # pathlen parser
+        result = dict(result)
 
-        seenas = []
-
-        for x in result['hops']:
-            if 'address' in x:
-                ippath.append(x['address'])
-            else:
-                ippath.append(None)
+        # these are fine as empty arrays if there was no path (e.g. it
+        # couldn't be tested)
+        result['path'] = hops['path']
+        result['hop_rtt'] = hops['hop_rtt']
 
-            if 'rtt' in x:
-                rtts.append(x['rtt'])
-            else:
-                rtts.append(None)
+        if len(hops['aspath']) == 0:
+            result["aspath"] = None
+            result["aspathlen"] = None
+            result["uniqueas"] = None
+            result["responses"] = None
+        else:
+            result["aspath"] = hops['aspath']
+            result["aspathlen"] = hops['aspathlen']
+            result["uniqueas"] = hops['uniqueas']
+            result["responses"] = hops['responses']
+        return result
+
+def prepare_traceroute(parser, data, source, derived):
+    """ Finds the stream properties and walks the hops for each result in
+        a traceroute message. Both of the traceroute parsers need these, so
+        they are kept in the derived data cache to be shared.
+    """
+    prepared = []
+    for i, d in enumerate(data):
+        streamparams, key = derived.get(("traceroute-stream", i),
+                parser._stream_properties, source, d)
+        if key is None:
+            hops = None
+        else:
+            hops = derived.get(("traceroute-hops", i), walk_hops, d['hops'])
+        prepared.append((d, streamparams, key, hops))
+    return prepared
+
+def walk_hops(hops):
+    """ Builds the IP and AS paths for a traceroute result, along with the
+        other values that depend on the AS of each hop.
+    """
+    aspath = []
+    ippath = []
+    rtts = []
+    currentas = None
+    responses = 0
+    count = 0
+    aspathlen = 0
+
+    seenas = set()
+
+    for x in hops:
+        if 'address' in x:
+            ippath.append(x['address'])
+        else:
+            ippath.append(None)
 
-            if 'as' not in x:
-                continue
+        if 'rtt' in x:
+            rtts.append(x['rtt'])
+        else:
+            rtts.append(None)
 
-            if currentas != x['as']:
-                if currentas != None:
-                    assert(count != 0)
-                    aspath.append("%d.%d" % (count, currentas))
-                currentas = x['as']
-                count = 1
-            else:
-                count += 1
+        if 'as' not in x:
+            continue
 
-            # Keep track of unique AS numbers in the path, not counting
-            # null hops, RFC 1918 addresses or failed lookups
-            if x['as'] not in seenas and x['as'] >= 0:
-                seenas.append(x['as'])
+        if currentas != x['as']:
+            if currentas != None:
+                assert(count != 0)
+                aspath.append("%d.%d" % (count, currentas))
+            currentas = x['as']
+            count = 1
+        else:
+            count += 1
 
-            aspathlen += 1
-            responses += 1
+        # Keep track of unique AS numbers in the path, not counting
+        # null hops, RFC 1918 addresses or failed lookups
+        if x['as'] >= 0:
+            seenas.add(x['as'])
 
-        if currentas != None:
-            assert(count != 0)
-            assert(responses >= count)
+        aspathlen += 1
+        responses += 1
 
-            aspath.append("%d.%d" % (count, currentas))
+    if currentas != None:
+        assert(count != 0)
+        assert(responses >= count)
 
-            # Remove tailing "null hops" from our responses count
-            if currentas == -1:
-                responses -= count
+        aspath.append("%d.%d" % (count, currentas))
 
-        # these are fine as empty arrays if there was no path (e.g. it
-        # couldn't be tested)
-        result['path'] = ippath
-        result['hop_rtt'] = rtts
+        # Remove tailing "null hops" from our responses count
+        if currentas == -1:
+            responses -= count
 
-        if len(aspath) == 0:
-            result["aspath"] = None
-            result["aspathlen"] = None
-            result["uniqueas"] = None
-            result["responses"] = None
-        else:
-            result["aspath"] = aspath
-            result["aspathlen"] = aspathlen
-            result["uniqueas"] = len(seenas)
-            result["responses"] = responses
+    return {"path": ippath, "hop_rtt": rtts, "aspath": aspath,
+            "aspathlen": aspathlen, "uniqueas": len(seenas),
+            "responses": responses}
 
 
 # Helper functions for dbselect module which deal with complications
@@ -659,25 +988,42 @@ class AmpTracerouteParser(AmpIcmpParser):
 
 # This is a bit of nasty join -- are we going to run into problems with
 # joining and unioning so many tables?
-def generate_union(qb, table, streams):
+def generate_union(qb, table, streams, globalpaths=False, datasql=None):
 
-    allstreams = []
-    unionparams = []
+    allstreams = list(streams)
     sql = "(SELECT allstreams.*, "
     if "astraceroute" not in table:
         sql += "paths.path, paths.length, "
     sql += "aspaths.aspath, "
     sql += "aspaths.responses, aspaths.aspath_length, aspaths.uniqueas FROM ("
 
-    for i in range(0, len(streams)):
-        allstreams.append(streams[i])
-        sql += "SELECT * FROM %s_" % (table)
-        sql += "%s"     # stream id will go here
+    # The query for the data rows themselves depends on the data layout,
+    # so the caller can provide it (and its parameters)
+    if datasql is not None:
+        sql += datasql[0]
+        unionparams = list(datasql[1])
+    else:
+        for i in range(0, len(streams)):
+            sql += "SELECT * FROM %s_" % (table)
+            sql += "%s"     # stream id will go here
 
-        if i != len(streams) - 1:
-            sql += " UNION ALL "
+            if i != len(streams) - 1:
+                sql += " UNION ALL "
+
+        unionparams = list(allstreams)
+
+    # With global path dictionaries, there is only one table of each type
+    # of path to join against no matter how many streams there are
+    if globalpaths:
+        sql += ") AS allstreams LEFT JOIN "
+        if "astraceroute" not in table:
+            sql += "%s AS paths " % (GLOBAL_PATH_TABLE)
+            sql += "ON (allstreams.path_id = paths.path_id) LEFT JOIN "
+        sql += "%s AS aspaths " % (GLOBAL_ASPATH_TABLE)
+        sql += "ON (allstreams.aspath_id = aspaths.aspath_id)) AS dataunion"
+        qb.add_clause("union", sql, unionparams)
+        return
 
-    unionparams = list(allstreams)
     sql += ") AS allstreams LEFT JOIN ("
 
     if "astraceroute" not in table:
@@ -32,6 +32,8 @@
 from libnntsc.dberrorcodes import DB_DATA_ERROR
 import libnntscclient.logger as logger
 from libnntsc.parsers.amp_icmp import AmpIcmpParser
+from libnntsc.parsers.amp_traceroute import prepare_traceroute
+from libnntsc.parsers.common import DerivedDataCache
 
 class AmpTraceroutePathlenParser(AmpIcmpParser):
     def __init__(self, db, influxdb=None):
@@ -60,15 +62,22 @@ class AmpTraceroutePathlenParser(AmpIcmpParser):
         return False
 
 
+    def prepare_data(self, data, source, derived=None):
+        if derived is None:
+            derived = DerivedDataCache()
+        return prepare_traceroute(self, data, source, derived)
+
     def process_data(self, timestamp, data, source):
         """ Process a AMP traceroute message, which can contain 1 or more
             sets of results
         """
-        lengthseen = {}
+        return self.process_prepared(timestamp,
+                self.prepare_data(data, source), source)
 
-        for d in data:
-            streamparams, key = self._stream_properties(source, d)
+    def process_prepared(self, timestamp, prepared, source):
+        lengthseen = {}
 
+        for d, streamparams, key, hops in prepared:
             if key is None:
                 logger.log("Failed to determine stream for %s result" % \
                         (self.colname))
@@ -86,57 +95,62 @@ class AmpTraceroutePathlenParser(AmpIcmpParser):
             else:
                 streamid = self.streams[key]
 
-            self._extract_paths(d)
+            # TODO the information coming from the test should be more
+            # explicit so we don't have to guess based on the address
+            noaddress = self.is_null_address(d["address"])
 
             # IP flag tells us if this is intended as an IP traceroute.
             # If the flag isn't present, we're running an old ampsave
             # that pre-dates AS path support so assume an IP traceroute in
             # that case
             if 'ip' not in d or d['ip'] != 0:
+                path = hops['path']
+                length = d['length']
 
-                if d['path'] is not None:
-                    if len(d['path']) == 0:
-                        # zero length path, it must have been incomplete
-                        d['length'] = 0.5
-                    elif d['path'][-1] is None:
-                        # last hop is None, it's incomplete
-                        d['length'] += 0.5
-                        # remove all the incomplete hops from the end
-                        while len(d['path']) > 0 and d['path'][-1] is None:
-                            d['path'] = d['path'][:-1]
-                            d['length'] -= 1
-                    else:
-                        # good path that reached the target, just add the
-                        # zero decimal so the types are correct
-                        d['length'] += 0.0
-                else:
+                if len(path) == 0 and noaddress:
                     # test couldn't run, length doesn't make sense
-                    d['length'] = None
+                    length = None
+                elif len(path) == 0:
+                    # zero length path, it must have been incomplete
+                    length = 0.5
+                elif path[-1] is None:
+                    # last hop is None, it's incomplete
+                    length += 0.5
+                    # don't count any of the incomplete hops at the end
+                    end = len(path)
+                    while end > 0 and path[end - 1] is None:
+                        end -= 1
+                        length -= 1
+                else:
+                    # good path that reached the target, just add the
+                    # zero decimal so the types are correct
+                    length += 0.0
 
                 if streamid not in lengthseen:
-                    lengthseen[streamid] = {d['length']: 1}
-                elif d['length'] not in lengthseen[streamid]:
-                    lengthseen[streamid][d['length']] = 1
+                    lengthseen[streamid] = {length: 1}
+                elif length not in lengthseen[streamid]:
+                    lengthseen[streamid][length] = 1
                 else:
-                    lengthseen[streamid][d['length']] += 1
+                    lengthseen[streamid][length] += 1
 
             elif 'as' in d and d['as'] != 0:
-                if d['aspath'] is not None:
-                    if len(d['aspath']) == 0:
-                        d['responses'] = 0.5
-                    elif "-" in d['aspath'][-1]:
-                        d['responses'] += 0.5
-                    else:
-                        d['responses'] += 0.0
+                aspath = hops['aspath']
+
+                if len(aspath) == 0 and noaddress:
+                    responses = None
+                elif len(aspath) == 0:
+                    responses = 0.5
+                elif "-" in aspath[-1]:
+                    responses = hops['responses'] + 0.5
                 else:
-                    d['responses'] = None
+                    responses = hops['responses'] + 0.0
 
                 if streamid not in lengthseen:
-                    lengthseen[streamid] = {d['responses']: 1}
-                elif d['responses'] not in lengthseen[streamid]:
-                    lengthseen[streamid][d['responses']] = 1
+                    lengthseen[streamid] = {responses: 1}
+                elif responses not in lengthseen[streamid]:
+                    lengthseen[streamid][responses] = 1
                 else:
-                    lengthseen[streamid][d['responses']] += 1
+                    lengthseen[streamid][responses] += 1
 
         for sid, lengths in lengthseen.iteritems():
             modelen = None
@@ -154,82 +168,7 @@ class AmpTraceroutePathlenParser(AmpIcmpParser):
             self.insert_data(sid, timestamp, toinsert)
 
         # update the last timestamp for all streams we just got data for
-        self.db.update_timestamp(self.datatable, lengthseen.keys(),
+        self._update_timestamp(self.datatable, lengthseen.keys(),
                 timestamp, False)
 
-    def _extract_paths(self, result):
-        aspath = []
-        ippath = []
-        rtts = []
-        currentas = None
-        responses = 0
-        count = 0
-        aspathlen = 0
-
-        seenas = []
-
-        for x in result['hops']:
-            if 'address' in x:
-                ippath.append(x['address'])
-            else:
-                ippath.append(None)
-
-            if 'rtt' in x:
-                rtts.append(x['rtt'])
-            else:
-                rtts.append(None)
-
-            if 'as' not in x:
-                continue
-
-            if currentas != x['as']:
-                if currentas != None:
-                    assert(count != 0)
-                    aspath.append("%d.%d" % (count, currentas))
-                currentas = x['as']
-                count = 1
-            else:
-                count += 1
-
-            # Keep track of unique AS numbers in the path, not counting
-            # null hops, RFC 1918 addresses or failed lookups
-            if x['as'] not in seenas and x['as'] >= 0:
-                seenas.append(x['as'])
-
-            aspathlen += 1
-            responses += 1
-
-        if currentas != None:
-            assert(count != 0)
-            assert(responses >= count)
-
-            aspath.append("%d.%d" % (count, currentas))
-
-            # Remove tailing "null hops" from our responses count
-            if currentas == -1:
-                responses -= count
-
-        if len(rtts) == 0 and self.is_null_address(result["address"]):
-            result["hop_rtt"] = None
-        else:
-            result['hop_rtt'] = rtts
-
-        # TODO the information coming from the test should be more explicit
-        # so we don't have to guess based on the address
-        if len(aspath) == 0 and self.is_null_address(result["address"]):
-            result["aspath"] = None
-            result["aspathlen"] = None
-            result["uniqueas"] = None
-            result["responses"] = None
-        else:
-            result["aspath"] = aspath
-            result["aspathlen"] = aspathlen
-            result["uniqueas"] = len(seenas)
-            result["responses"] = responses
-
-        if len(ippath) == 0 and self.is_null_address(result["address"]):
-            result["path"] = None
-        else:
-            result['path'] = ippath
-
 # vim: set sw=4 tabstop=4 softtabstop=4 expandtab :
@@ -113,8 +113,8 @@ class AmpUdpstreamParser(NNTSCParser):
         packet_count = str(streamdata["packet_count"])
         dscp = str(streamdata["dscp"])
 
-        return (src, dest, address, direction, packet_size, packet_spacing, \
-                packet_count, dscp)
+        return self.streams.make_key((src, dest, address, direction,
+                packet_size, packet_spacing, packet_count, dscp))
 
 
     def _process_single_result(self, timestamp, resdict):
@@ -137,8 +137,8 @@ class AmpUdpstreamParser(NNTSCParser):
         self.insert_data(stream_id, timestamp, resdict)
         return stream_id
 
-    def process_data(self, timestamp, data, source):
-        done = {}
+    def prepare_data(self, data, source, derived=None):
+        prepared = []
 
         for result in data['results']:
             resdict = {}
@@ -203,12 +203,24 @@ class AmpUdpstreamParser(NNTSCParser):
                 resdict['jitter_percentile_90'] = result['percentiles'][8]
                 resdict['jitter_percentile_100'] = result['percentiles'][9]
 
+            prepared.append(resdict)
+
+        return prepared
+
+    def process_data(self, timestamp, data, source):
+        self.process_prepared(timestamp, self.prepare_data(data, source),
+                source)
+
+    def process_prepared(self, timestamp, prepared, source):
+        done = {}
+
+        for resdict in prepared:
             streamid = self._process_single_result(timestamp, resdict)
             if streamid < 0:
                 return
             done[streamid] = 0
 
-        self.db.update_timestamp(self.datatable, done.keys(), timestamp,
+        self._update_timestamp(self.datatable, done.keys(), timestamp,
                 self.have_influx)
 
 # vim: set sw=4 tabstop=4 softtabstop=4 expandtab :
@@ -81,7 +81,7 @@ class AmpYoutubeParser(NNTSCParser):
         ]
 
 
-    def _stream_key(self, stream_data):
+    def _stream_parts(self, stream_data):
         src = str(stream_data["source"])
 
         if 'video' in stream_data:
@@ -95,9 +95,10 @@ class AmpYoutubeParser(NNTSCParser):
         else:
             quality = str(stream_data['quality'])
 
-        key = (src, dest, quality)
+        return (src, dest, quality)
 
-        return key
+    def _stream_key(self, stream_data):
+        return self.streams.make_key(self._stream_parts(stream_data))
 
     def create_existing_stream(self, stream_data):
         """Extract the stream key from the stream data provided by NNTSC
@@ -113,12 +114,13 @@ class AmpYoutubeParser(NNTSCParser):
 
         # Our columns are slightly different to the names that AMPsave uses,
         # so we'll have to mangle them to match what we're expecting
-        key = self._stream_key(data)
+        parts = self._stream_parts(data)
+        key = self.streams.make_key(parts)
 
         mangled = {}
-        mangled['source'] = key[0]
-        mangled['destination'] = key[1]
-        mangled['quality'] = key[2]
+        mangled['source'] = parts[0]
+        mangled['destination'] = parts[1]
+        mangled['quality'] = parts[2]
 
         mangled['total_time'] = int(data['total_time'])
         mangled['pre_time'] = int(data['pre_time'])
@@ -130,10 +132,16 @@ class AmpYoutubeParser(NNTSCParser):
 
         return mangled, key
 
-    def process_data(self, timestamp, data, source):
+    def prepare_data(self, data, source, derived=None):
         data['source'] = source
+        return self._mangle_result(data)
+
+    def process_data(self, timestamp, data, source):
+        self.process_prepared(timestamp, self.prepare_data(data, source),
+                source)
 
-        mangled, key = self._mangle_result(data)
+    def process_prepared(self, timestamp, prepared, source):
+        mangled, key = prepared
 
         if key in self.streams:
             stream_id = self.streams[key]
@@ -148,7 +156,7 @@ class AmpYoutubeParser(NNTSCParser):
             self.streams[key] = stream_id
 
         self.insert_data(stream_id, timestamp, mangled)
-        self.db.update_timestamp(self.datatable, [stream_id], timestamp,
+        self._update_timestamp(self.datatable, [stream_id], timestamp,
                 self.have_influx)
 
 # vim: set sw=4 tabstop=4 softtabstop=4 expandtab :
@@ -28,9 +28,64 @@
 # Please report any bugs, questions or comments to contact@wand.net.nz
 #
 
-from libnntsc.dberrorcodes import DBQueryException
+from libnntsc.dberrorcodes import DBQueryException, DB_STREAM_PENDING
 import libnntscclient.logger as logger
 
+class DerivedDataCache(object):
+    """ Values calculated from a single message, shared between all of
+        the parsers that are processing that message.
+    """
+    def __init__(self):
+        self.values = {}
+
+    def get(self, name, func, *args):
+        """ Returns the value with the given name, calling func(*args) to
+            calculate it if no parser has asked for it yet.
+        """
+        if name not in self.values:
+            self.values[name] = func(*args)
+        return self.values[name]
+
+# Separates the stream properties within a stream key
+STREAM_KEY_SEPARATOR = "\x00"
+
+class StreamRegistry(dict):
+    """ Maps stream keys to stream ids.
+
+        Rather than a tuple of stream properties, each key is a single
+        interned string made by make_key(). This takes a fraction of the
+        memory when there are a lot of streams, and because a string only
+        calculates its hash once a key can be made ahead of time (e.g.
+        while preparing a message) and then looked up repeatedly for free.
+
+        Parsers that use the same streams table should share a registry,
+        see share_stream_registries().
+    """
+
+    def make_key(self, parts):
+        """ Returns the key for a stream, given a sequence of the
+            properties that identify it.
+        """
+        packed = []
+        for p in parts:
+            if isinstance(p, unicode):
+                p = p.encode("utf-8")
+            elif not isinstance(p, str):
+                p = str(p)
+            packed.append(p)
+        return intern(STREAM_KEY_SEPARATOR.join(packed))
+
+def share_stream_registries(parsers):
+    """ Makes every parser in the list that uses the same streams table
+        as an earlier parser use that parser's stream registry.
+    """
+    registries = {}
+    for p in parsers:
+        if p.streamtable in registries:
+            p.streams = registries[p.streamtable]
+        else:
+            registries[p.streamtable] = p.streams
+
 class NNTSCParser(object):
     def __init__(self, db, influxdb=None):
         self.db = db
@@ -47,16 +102,35 @@ class NNTSCParser(object):
         self.source = None
         self.module = None
 
-        self.streams = {}
+        self.streams = StreamRegistry()
         self.streamcolumns = []
         self.uniquecolumns = []
         self.streamindexes = []
         self.datacolumns = []
+
+        # Casts to apply to data columns when they are inserted: SQL type
+        # names for postgres or functions for influx
+        self.datacasts = {}
+
+        # Names of the data columns and the database's compiled format for
+        # writing them, worked out the first time a result is inserted --
+        # see insert_data()
+        self.rowcolumns = None
+        self.rowformat = None
         self.dataindexes = []
         self.exporter = None
 
         self.collectionid = None
 
+        # Latest timestamp seen for each stream during process_batch()
+        self.batchtimestamps = None
+
+        # New streams waiting to be created by create_queued_streams(), if
+        # queue_new_streams() has been called
+        self.queuestreams = False
+        self.queuedstreams = {}
+        self.createdstreams = {}
+
         self.cqs = []
         self.matrix_cq = []
 
@@ -75,6 +149,16 @@ class NNTSCParser(object):
     def add_exporter(self, exp):
         self.exporter = exp
 
+    def queue_new_streams(self):
+        """ Stops new streams from being created as soon as they are seen.
+
+            Instead, create_new_stream() queues the stream and raises a
+            DBQueryException with the DB_STREAM_PENDING code. The caller
+            should undo the message, call create_queued_streams() and
+            publish_streams() and then try the message again.
+        """
+        self.queuestreams = True
+
     def get_data_table_name(self):
         return self.datatable
 
@@ -91,8 +175,17 @@ class NNTSCParser(object):
         if not self.influxdb:
             logger.log("Tried to build Continuous Queries without InfluxDB")
             return
+        # the matrix aggregates are now maintained by add_matrix_rollups(),
+        # so remove any continuous queries left over from older versions
         if len(self.matrix_cq) > 0:
-            self.influxdb.create_matrix_cq(self.matrix_cq, self.datatable)
+            self.influxdb.drop_matrix_cq(self.datatable)
+
+    def add_matrix_rollups(self):
+        """ Has the matrix aggregates for this parser's data maintained as
+            the data is inserted into influx.
+        """
+        if self.influxdb and len(self.matrix_cq) > 0:
+            self.influxdb.add_matrix_rollups(self.datatable, self.matrix_cq)
 
     def get_matrix_cq(self):
         return self.matrix_cq
@@ -112,7 +205,8 @@ class NNTSCParser(object):
                 indname = ind["name"]
 
             try:
-                self.db.create_index(indname, table, ind["columns"])
+                self.db.create_index(indname, table, ind["columns"],
+                        ind.get("unique", False))
             except DBQueryException as e:
                 logger.log("Failed to create index for %s" % (table))
                 logger.log("Error was: %s" % (str(e)))
@@ -157,6 +251,89 @@ class NNTSCParser(object):
     def post_commit(self):
         pass
 
+    def describe_caches(self):
+        """ Returns a summary of how well any caches kept by the parser
+            are working, to be logged periodically.
+        """
+        return None
+
+    def abort_message(self):
+        """ Called when the database changes made while processing a
+            message have been undone, so that any state derived from them
+            can be forgotten.
+        """
+        pass
+
+    def prepare_data(self, data, source, derived=None):
+        """ Does any processing of a decoded message that doesn't need the
+            database or the stream map, so that it can be done ahead of time
+            (possibly in another process).
+
+            The returned value must be picklable and is later passed to
+            process_prepared().
+
+            If several parsers handle the same message, they are all given
+            the same DerivedDataCache so that any work they have in common
+            only needs to be done once.
+        """
+        return data
+
+    def process_prepared(self, timestamp, prepared, source):
+        """ Processes a message that has already been through
+            prepare_data().
+        """
+        self.process_data(timestamp, prepared, source)
+
+    def process_batch(self, batch):
+        """ Processes a group of messages at once. Each item in the batch
+            is a (messageid, timestamp, prepared, source) tuple, where
+            prepared is the result of prepare_data() for that message.
+
+            Stream timestamps are only updated once at the end of the
+            batch and rows that would otherwise be inserted one at a time
+            are written with a single INSERT per table.
+        """
+        self.batchtimestamps = {}
+        self.db.begin_batch()
+
+        try:
+            for messageid, timestamp, prepared, source in batch:
+                self.db.tag_message(messageid)
+                if self.exporter is not None:
+                    self.exporter.tag_message(messageid)
+                self.process_prepared(timestamp, prepared, source)
+            self.db.end_batch()
+        except DBQueryException:
+            self.db.discard_batch()
+            self.batchtimestamps = None
+            raise
+
+        stamps = self.batchtimestamps
+        self.batchtimestamps = None
+
+        for (table, is_influx), latest in stamps.iteritems():
+            bytime = {}
+            for sid, ts in latest.iteritems():
+                if ts not in bytime:
+                    bytime[ts] = []
+                bytime[ts].append(sid)
+
+            for ts, sids in bytime.iteritems():
+                self.db.update_timestamp(table, sids, ts, is_influx)
+
+    def _update_timestamp(self, table, streamids, timestamp, is_influx):
+        if self.batchtimestamps is None:
+            self.db.update_timestamp(table, streamids, timestamp, is_influx)
+            return
+
+        if (table, is_influx) not in self.batchtimestamps:
+            self.batchtimestamps[(table, is_influx)] = {}
+        latest = self.batchtimestamps[(table, is_influx)]
+
+        for sid in streamids:
+            if sid not in latest or timestamp > latest[sid]:
+                latest[sid] = timestamp
+
     def _get_collection_id(self):
         if self.collectionid is None:
             try:
@@ -183,55 +360,125 @@ class NNTSCParser(object):
             else:
                 streamprops[col['name']] = None
 
+        if self.queuestreams:
+            return self._queue_stream(streamprops, timestamp,
+                    createdatatable)
+
+        streamid = self._insert_new_stream(streamprops, timestamp,
+                createdatatable)
+
         try:
-            streamid = self.db.insert_stream(self.streamtable,
-                    self.datatable, timestamp, streamprops, createdatatable)
+            self.db.commit_streams()
         except DBQueryException as e:
-            logger.log("Failed to insert new stream into database for %s" \
-                    % (self.colname))
+            logger.log("Failed to commit new stream for %s" % \
+                    (self.colname))
             logger.log("Error was: %s" % (str(e)))
             raise
 
+        self._publish_stream(streamid, streamprops)
+        return streamid
+
+    def _insert_new_stream(self, streamprops, timestamp, createdatatable):
         try:
-            self.db.commit_streams()
+            return self.db.insert_stream(self.streamtable,
+                    self.datatable, timestamp, streamprops, createdatatable)
         except DBQueryException as e:
-            logger.log("Failed to commit new stream for %s" % \
-                    (self.colname))
+            logger.log("Failed to insert new stream into database for %s" \
+                    % (self.colname))
             logger.log("Error was: %s" % (str(e)))
             raise
 
+    def _publish_stream(self, streamid, streamprops):
         if self.exporter is None:
-            return streamid
+            return
 
         colid = self._get_collection_id()
         if colid <= 0:
             # Not sure what we should do if we get a bad collection id,
             # but for now I'm going to go with not exporting the new
             # stream
-            return streamid
+            return
 
         self.exporter.publishStream(colid, self.colname, streamid,
                 streamprops)
-        return streamid
-
-    def insert_data(self, stream, ts, result, casts=None):
-        filtered = {}
-        if casts is None:
-            casts = {}
 
-        for col in self.datacolumns:
-            if col["name"] in result:
-                filtered[col["name"]] = result[col["name"]]
-            else:
-                filtered[col["name"]] = None
+    def _queue_stream(self, streamprops, timestamp, *args):
+        key = tuple(sorted(streamprops.items()))
+
+        # the stream might have been created while this message was
+        # waiting to be tried again
+        if key in self.createdstreams:
+            return self.createdstreams[key]
+
+        if key not in self.queuedstreams:
+            self.queuedstreams[key] = [streamprops, timestamp, args]
+        elif timestamp < self.queuedstreams[key][1]:
+            self.queuedstreams[key][1] = timestamp
+
+        raise DBQueryException(DB_STREAM_PENDING)
+
+    def queued_stream_count(self):
+        return len(self.queuedstreams)
+
+    def create_queued_streams(self):
+        """ Inserts all of the queued streams and creates their tables,
+            without committing them.
+
+            Returns a list of the new streams, to be passed to
+            publish_streams() once they have been committed.
+        """
+        created = []
+        self.createdstreams = {}
+
+        for key, (streamprops, timestamp, args) in \
+                self.queuedstreams.iteritems():
+            streamid = self._insert_new_stream(streamprops, timestamp, *args)
+            self.createdstreams[key] = streamid
+            created.append((streamid, streamprops))
+
+        self.queuedstreams = {}
+        return created
+
+    def discard_queued_streams(self):
+        """ Forgets about any queued or newly created streams, e.g.
+            because creating them was rolled back.
+        """
+        self.queuedstreams = {}
+        self.createdstreams = {}
+
+    def publish_streams(self, created):
+        """ Exports the streams returned by create_queued_streams(), now
+            that they have been committed.
+        """
+        for streamid, streamprops in created:
+            self._publish_stream(streamid, streamprops)
+
+    def _compile_row_format(self):
+        # The subclass constructors fill in datacolumns after this class
+        # has been initialised, so this can't be done any earlier
+        self.rowcolumns = tuple([col["name"] for col in self.datacolumns])
+        if not self.influxdb:
+            self.rowformat = self.db.row_format(self.datatable,
+                    self.rowcolumns, self.datacasts)
+        return self.rowcolumns
+
+    def insert_data(self, stream, ts, result):
+        # Every result is written with the same set of columns, filling in
+        # None for anything missing
+        names = self.rowcolumns
+        if names is None:
+            names = self._compile_row_format()
+        values = tuple(map(result.get, names))
+        filtered = None
 
         try:
             if self.influxdb:
+                # influx writes each field by name
+                filtered = dict(zip(names, values))
                 self.influxdb.insert_data(self.datatable,
-                                          stream, ts, filtered, casts)
+                                          stream, ts, filtered, self.datacasts)
             else:
-                self.db.insert_data(self.datatable, self.colname, stream, ts,
-                                filtered, casts)
+                self.db.insert_row(self.rowformat, stream, ts, values)
         except DBQueryException as e:
             logger.log("Failed to insert new data for %s stream %d" % \
                     (self.colname, stream))
@@ -246,6 +493,8 @@ class NNTSCParser(object):
         colid = self._get_collection_id()
 
         if self.exporter != None and colid > 0:
+            if filtered is None:
+                filtered = dict(zip(names, values))
             self.exporter.publishLiveData(colid, stream, ts, filtered)
 
 
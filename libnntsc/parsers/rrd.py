@@ -34,7 +34,7 @@ import sys
 import time
 
 import rrdtool
-from libnntsc.database import DBInsert
+from libnntsc.database import DBInsert, DATA_PARTITION_CHECK_FREQ
 from libnntsc.dberrorcodes import *
 from libnntsc.configurator import *
 from libnntsc.parsers.rrd_smokeping import RRDSmokepingParser
@@ -57,7 +57,12 @@ class RRDModule:
             sys.exit(1)
 
         self.db = DBInsert(dbconf["name"], dbconf["user"], dbconf["pass"],
-                dbconf["host"], cachetime=dbconf['cachetime'])
+                dbconf["host"], cachetime=dbconf['cachetime'],
+                insertmode=dbconf['insertmode'],
+                datalayout=dbconf['datalayout'],
+                cachebackend=dbconf['cachebackend'],
+                cachepath=dbconf['cachepath'],
+                cacheslots=dbconf['cacheslots'])
         self.db.connect_db(15)
 
         self.influxconf = get_influx_config(nntsc_conf)
@@ -73,6 +78,12 @@ class RRDModule:
 
 
         self.smokeparser = RRDSmokepingParser(self.db, self.influxdb)
+        self.smokeparser.add_matrix_rollups()
+        if self.influxdb:
+            try:
+                self.influxdb.seed_rollups()
+            except DBQueryException as e:
+                logger.log("Failed to fill the open matrix bins: %s" % (e))
         self.smokepings = {}
         self.rrds = {}
         for r in rrds:
@@ -215,7 +226,17 @@ class RRDModule:
 
     def run(self):
         logger.log("Starting RRD module")
+        nextpartitions = 0
         while True:
+            if self.db.datalayout == "partitioned" and \
+                    time.time() >= nextpartitions:
+                try:
+                    self.db.maintain_partitions()
+                except DBQueryException as e:
+                    logger.log("Failed to create new data partitions: %s" % \
+                            (e))
+                nextpartitions = time.time() + DATA_PARTITION_CHECK_FREQ
+
             result = self.rrdloop()
 
             if result == RRD_RETRY:
@@ -30,6 +30,7 @@
 
 from libnntsc.parsers.common import NNTSCParser
 from libnntsc.dberrorcodes import DB_DATA_ERROR
+from libnntsc.packedarray import pack_array
 import libnntscclient.logger as logger
 
 class RRDSmokepingParser(NNTSCParser):
@@ -44,6 +45,12 @@ class RRDSmokepingParser(NNTSCParser):
         self.source = "rrd"
         self.module = "smokeping"
 
+        # influx has no array type, so the pings are packed into a string
+        if self.influxdb:
+            self.datacasts = {"pings":pack_array}
+        else:
+            self.datacasts = {"pings":"double precision[]"}
+
         self.streamcolumns = [
             {"name":"filename", "type":"varchar", "null":False},
             {"name":"source", "type":"varchar", "null":False},
@@ -129,11 +136,7 @@ class RRDSmokepingParser(NNTSCParser):
         else:
             kwargs['lossrate'] = kwargs['loss'] / float(sent)
 
-        if self.influxdb:
-            casts = {"pings": str}
-        else:
-            casts = {"pings":"double precision[]"}
-        self.insert_data(stream, ts, kwargs, casts)
+        self.insert_data(stream, ts, kwargs)
 
 
 # vim: set sw=4 tabstop=4 softtabstop=4 expandtab :
@@ -235,6 +235,77 @@ class PikaPubQueue(object):
             return -1
         return 0
 
+    def tag_message(self, messageid):
+        # Live data is published straight away, so there is nothing to tag
+        pass
+
+
+class PikaPubBuffer(object):
+    """ Holds live data back until the rows it describes have been
+        committed, so that clients never see rows that are later rolled
+        back or moved to the dead letter table, and don't see the same
+        row twice when a message is processed again.
+
+        Works like the per-message buffering in the database and Influx
+        inserters: begin_message(), end_message() and abort_message()
+        mark out the rows for each message, take_pending() removes every
+        buffered row and commit_pending() publishes them once the commit
+        has succeeded. New streams and pushes are published immediately.
+    """
+    def __init__(self, pubqueue):
+        self._pubqueue = pubqueue
+        self._pending = []
+        self._messageid = None
+        self._messagestart = None
+
+    def publishStream(self, colid, colname, streamid, streamprops):
+        return self._pubqueue.publishStream(colid, colname, streamid,
+                streamprops)
+
+    def publishPush(self, colid, ts):
+        return self._pubqueue.publishPush(colid, ts)
+
+    def publishLiveData(self, colname, stream, ts, result):
+        self._pending.append((self._messageid, (colname, stream, ts, result)))
+        return 0
+
+    def begin_message(self, messageid=None):
+        """ Remember where the rows for the current message start """
+        self._messagestart = len(self._pending)
+        self._messageid = messageid
+
+    def tag_message(self, messageid):
+        """ Changes the message id that is attached to buffered rows """
+        self._messageid = messageid
+
+    def end_message(self):
+        self._messagestart = None
+        self._messageid = None
+
+    def abort_message(self):
+        """ Forget any rows added since begin_message() was called """
+        if self._messagestart is not None:
+            del self._pending[self._messagestart:]
+        self.end_message()
+
+    def take_pending(self):
+        """ Remove and return all of the rows waiting to be published """
+        rows = self._pending
+        self._pending = []
+        return rows
+
+    def commit_pending(self, rows, rejected=None):
+        """ Publishes a set of rows returned by take_pending(), leaving out
+            any that belong to the messages listed in rejected.
+        """
+        if rejected:
+            rejected = set(rejected)
+
+        for messageid, row in rows:
+            if rejected and messageid in rejected:
+                continue
+            self._pubqueue.publishLiveData(*row)
+
 
 class PikaConsumer(PikaBasicAsync):
     def __init__(self, exchange, queuename, host, port, ssl, user, pword,
@@ -247,6 +318,8 @@ class PikaConsumer(PikaBasicAsync):
         self._prefetch = 0
         self.callback = None
         self.noack = False
+        self._timer = None
+        self._timerconn = None
 
     def halt_consumer(self):
         self._closing = True
@@ -292,6 +365,28 @@ class PikaConsumer(PikaBasicAsync):
         self._consumer_tag = self._channel.basic_consume(self.callback,
                 self._queuename, self.noack)
 
+        # Only schedule the timer once per connection, it will keep
+        # rescheduling itself after that
+        if self._timer is not None and self._timerconn is not self._connection:
+            self._timerconn = self._connection
+            self._connection.add_timeout(self._timer[0], self._run_timer)
+
+    def _run_timer(self):
+        if self._closing or self._timer is None:
+            return
+
+        if self._channel is not None:
+            self._timer[1](self._channel)
+
+        if self._connection is not None and not self._closing:
+            self._connection.add_timeout(self._timer[0], self._run_timer)
+
+    def set_timer(self, interval, callback):
+        """ Arranges for callback to be called every 'interval' seconds
+            from within the IO loop, so that it can safely use the channel.
+            The callback is passed the current channel as its only argument.
+        """
+        self._timer = (interval, callback)
 
     def configure(self, keys, callback, prefetch, noack=False):
         self._keys = keys[:]
@@ -0,0 +1,159 @@
+#
+# This file is part of NNTSC.
+#
+# Copyright (C) 2013-2017 The University of Waikato, Hamilton, New Zealand.
+#
+# Authors: Shane Alcock
+#          Brendon Jones
+#
+# All rights reserved.
+#
+# This code has been developed by the WAND Network Research Group at the
+# University of Waikato. For further information please see
+# http://www.wand.net.nz/
+#
+# NNTSC is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# NNTSC is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with NNTSC; if not, write to the Free Software Foundation, Inc.
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+#
+# Please report any bugs, questions or comments to contact@wand.net.nz
+#
+
+
+
+from threading import Thread
+import Queue as StdQueue
+
+import libnntscclient.logger as logger
+
+PIPELINE_DONE = 0
+PIPELINE_FAILED = 1
+PIPELINE_DROPPED = 2
+
+class Pipeline(object):
+    """ Runs a series of processing stages, each in its own thread, with a
+        bounded queue between each stage so that one stage can be working
+        on the next item while a later stage is still busy with the
+        previous one.
+
+        Each stage is a function that takes the output of the previous stage
+        and returns the input for the next one. Items pass through the
+        stages in the order they were submitted.
+
+        Every item is submitted with a generation number. If a stage raises
+        an exception, the item is reported as failed and every other item
+        with the same (or an older) generation is dropped by the remaining
+        stages. The caller should move on to a newer generation once it has
+        dealt with the failure.
+
+        Results are collected by calling completed(), which never blocks, so
+        that the caller can deal with them in whichever thread it likes.
+        Failed items are reported along with the exception that the stage
+        raised.
+    """
+
+    def __init__(self, stages, depth=2):
+        self.failedgen = -1
+        self.queues = []
+        self.threads = []
+        self.results = StdQueue.Queue()
+
+        for i in range(0, len(stages)):
+            self.queues.append(StdQueue.Queue(depth))
+
+        for i, (name, func) in enumerate(stages):
+            if i == len(stages) - 1:
+                outq = None
+            else:
+                outq = self.queues[i + 1]
+
+            t = Thread(target=self._run_stage, name=name,
+                    args=(name, func, self.queues[i], outq))
+            t.daemon = True
+            self.threads.append(t)
+
+    def start(self):
+        for t in self.threads:
+            t.start()
+
+    def stop(self):
+        # A None item tells each stage to pass the message on and exit
+        self.queues[0].put(None)
+        for t in self.threads:
+            t.join()
+
+    def full(self):
+        """ Returns True if the first stage already has a full queue of
+            work waiting, i.e. submit() would fail.
+        """
+        return self.queues[0].full()
+
+    def submit(self, generation, item):
+        """ Adds an item to the start of the pipeline. Never blocks, so
+            that it can be called from the IO loop.
+
+            Returns False if the first stage already has a full queue of
+            work waiting, in which case the caller should hold on to the
+            item and try again later.
+        """
+        try:
+            self.queues[0].put((generation, item), False)
+        except StdQueue.Full:
+            return False
+        return True
+
+    def completed(self):
+        """ Returns a list of (status, generation, result, error) tuples
+            for every item that has either made it through the last stage
+            or failed since the last call.
+
+            For failed and dropped items, the result is the item that was
+            given to the stage that failed or dropped it. The error is the
+            exception raised by the stage for failed items and None for
+            everything else.
+        """
+        done = []
+        while True:
+            try:
+                done.append(self.results.get(False))
+            except StdQueue.Empty:
+                break
+        return done
+
+    def _run_stage(self, name, func, inq, outq):
+        while True:
+            job = inq.get()
+            if job is None:
+                if outq is not None:
+                    outq.put(None)
+                return
+
+            generation, item = job
+            if generation <= self.failedgen:
+                self.results.put((PIPELINE_DROPPED, generation, item, None))
+                continue
+
+            try:
+                result = func(item)
+            except Exception as e:
+                logger.log("Pipeline stage %s failed: %s" % (name, e))
+                if generation > self.failedgen:
+                    self.failedgen = generation
+                self.results.put((PIPELINE_FAILED, generation, item, e))
+                continue
+
+            if outq is None:
+                self.results.put((PIPELINE_DONE, generation, result, None))
+            else:
+                outq.put((generation, result))
+
+# vim: set sw=4 tabstop=4 softtabstop=4 expandtab :
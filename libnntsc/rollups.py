@@ -0,0 +1,261 @@
+#
+# This file is part of NNTSC.
+#
+# Copyright (C) 2013-2017 The University of Waikato, Hamilton, New Zealand.
+#
+# Authors: Shane Alcock
+#          Brendon Jones
+#
+# All rights reserved.
+#
+# This code has been developed by the WAND Network Research Group at the
+# University of Waikato. For further information please see
+# http://www.wand.net.nz/
+#
+# NNTSC is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# NNTSC is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with NNTSC; if not, write to the Free Software Foundation, Inc.
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+#
+# Please report any bugs, questions or comments to contact@wand.net.nz
+#
+
+
+""" Incremental matrix rollups.
+
+    The matrix shows recent summaries of each stream, which used to be
+    built by continuous queries that re-aggregated the last 15 minutes
+    (or 3 hours) of raw data in influx every minute (or hour). Instead,
+    NNTSC now keeps running aggregates for each open matrix bin as the
+    data is inserted and writes them to influx periodically.
+"""
+
+import math
+import time
+
+# How often to write the open bins that have changed, in seconds
+ROLLUP_FLUSH_FREQ = 60
+
+class RollupColumn(object):
+    """ The running aggregates of one column within a single bin """
+
+    __slots__ = ["count", "total", "mean", "m2", "maxval", "minval",
+            "freq", "order"]
+
+    def __init__(self, wantmode):
+        self.count = 0
+        self.total = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.maxval = None
+        self.minval = None
+
+        # only needed for the mode, which has to remember every value
+        if wantmode:
+            self.freq = {}
+            self.order = []
+        else:
+            self.freq = None
+            self.order = None
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+
+        # Welford's method, so the stddev doesn't suffer from
+        # cancellation when the values are large
+        delta = value - self.mean
+        self.mean += delta / float(self.count)
+        self.m2 += delta * (value - self.mean)
+
+        if self.maxval is None or value > self.maxval:
+            self.maxval = value
+        if self.minval is None or value < self.minval:
+            self.minval = value
+
+        if self.freq is not None:
+            if value not in self.freq:
+                self.freq[value] = 0
+                self.order.append(value)
+            self.freq[value] += 1
+
+    def result(self, agg):
+        """ Returns the value of an aggregation function over the column,
+            following the same rules as influx does.
+        """
+        if agg == "count":
+            return self.count
+        if self.count == 0:
+            return None
+
+        if agg in ["mean", "avg"]:
+            return self.total / float(self.count)
+        if agg == "sum":
+            return self.total
+        if agg == "max":
+            return self.maxval
+        if agg == "min":
+            return self.minval
+        if agg == "stddev":
+            if self.count < 2:
+                return None
+            return math.sqrt(self.m2 / (self.count - 1))
+        if agg in ["mode", "most"] and self.freq is not None:
+            # ties go to whichever value was seen first
+            mode = None
+            for value in self.order:
+                if mode is None or self.freq[value] > self.freq[mode]:
+                    mode = value
+            return mode
+        return None
+
+class MatrixRollups(object):
+    """ Keeps the matrix aggregates for every open bin of every stream.
+
+        bins is a list of (binsize, window, suffix, retention policy)
+        tuples. Each bin stays open until it is more than window seconds
+        old, after which late data is ignored. The aggregates are written to
+        the measurement named after the data table plus the suffix.
+    """
+
+    def __init__(self, bins):
+        self.bins = bins
+        self.maxwindow = max([b[1] for b in bins])
+
+        # For each table: the (column, agg, label) rollups and the set of
+        # columns that need to be aggregated
+        self.definitions = {}
+        self.columns = {}
+
+        self.open = {}
+        self.dirty = set()
+        self.lastflush = time.time()
+
+        # For each table, bins that start before this time are missing
+        # some of their data so must never be written, see discard_before()
+        self.incomplete = {}
+
+    def add_definitions(self, table, aggcols):
+        """ Adds the matrix aggregations for a table, in the same form as
+            the matrix_cq of each parser.
+        """
+        defs = [(c.replace('"', ''), agg, label.replace('"', '')) \
+                for c, agg, label in aggcols]
+        self.definitions[table] = defs
+
+        columns = {}
+        for column, agg, label in defs:
+            columns[column] = columns.get(column, False) or \
+                    agg in ["mode", "most"]
+        self.columns[table] = columns
+
+    def wants(self, table):
+        return table in self.definitions
+
+    def add(self, observations, now=None, dirty=True):
+        """ Adds a list of (table, stream, timestamp, row) observations to
+            the open bins. Observations for bins that have closed already
+            are ignored.
+        """
+        if now is None:
+            now = time.time()
+
+        for table, stream, ts, row in observations:
+            columns = self.columns.get(table)
+            if columns is None:
+                continue
+            incomplete = self.incomplete.get(table)
+
+            for binsize, window, suffix, rp in self.bins:
+                binstart = ts - (ts % binsize)
+                if binstart < now - window:
+                    continue
+                if incomplete is not None and binstart < incomplete:
+                    continue
+
+                key = (table, binsize, stream, binstart)
+                binned = self.open.get(key)
+                if binned is None:
+                    binned = dict([(c, RollupColumn(wantmode)) \
+                            for c, wantmode in columns.iteritems()])
+                    self.open[key] = binned
+
+                for column, agg in binned.iteritems():
+                    value = row.get(column)
+                    if value is not None:
+                        agg.add(value)
+
+                if dirty:
+                    self.dirty.add(key)
+
+    def flush_due(self, now=None):
+        if now is None:
+            now = time.time()
+        return now - self.lastflush >= ROLLUP_FLUSH_FREQ
+
+    def take_rows(self, now=None):
+        """ Returns the rows for every bin that has changed since the last
+            time this was called, as a dictionary mapping each retention
+            policy to a list of (measurement, stream, binstart, fields)
+            tuples. Bins that have closed are forgotten afterwards.
+
+            Also returns the keys for the bins, so that they can be given
+            to mark_dirty() if the rows couldn't be written.
+        """
+        if now is None:
+            now = time.time()
+
+        policies = dict([(b[0], (b[2], b[3])) for b in self.bins])
+        rows = {}
+        for key in self.dirty:
+            table, binsize, stream, binstart = key
+            binned = self.open[key]
+
+            fields = {}
+            for column, agg, label in self.definitions[table]:
+                fields[label] = binned[column].result(agg)
+            for column in binned:
+                fields["magiccount_%s" % (column)] = binned[column].count
+
+            suffix, rp = policies[binsize]
+            if rp not in rows:
+                rows[rp] = []
+            rows[rp].append((table + suffix, stream, binstart, fields))
+
+        keys = self.dirty
+        self.dirty = set()
+        self.lastflush = now
+
+        windows = dict([(b[0], b[1]) for b in self.bins])
+        for key in self.open.keys():
+            if key[3] < now - windows[key[1]]:
+                del self.open[key]
+
+        return rows, keys
+
+    def discard_before(self, table, ts):
+        """ Forgets every bin for a table that starts before ts and ignores
+            any data for them from now on, e.g. because they couldn't be
+            filled with the data that was already written for them.
+        """
+        self.incomplete[table] = ts
+        for key in self.open.keys():
+            if key[0] == table and key[3] < ts:
+                del self.open[key]
+                self.dirty.discard(key)
+
+    def mark_dirty(self, keys):
+        """ Makes sure the given bins are written next time, if they are
+            still open.
+        """
+        self.dirty.update([k for k in keys if k in self.open])
+
+# vim: set sw=4 tabstop=4 softtabstop=4 expandtab :
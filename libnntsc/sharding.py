@@ -0,0 +1,218 @@
+#
+# This file is part of NNTSC.
+#
+# Copyright (C) 2013-2017 The University of Waikato, Hamilton, New Zealand.
+#
+# Authors: Shane Alcock
+#          Brendon Jones
+#
+# All rights reserved.
+#
+# This code has been developed by the WAND Network Research Group at the
+# University of Waikato. For further information please see
+# http://www.wand.net.nz/
+#
+# NNTSC is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# NNTSC is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with NNTSC; if not, write to the Free Software Foundation, Inc.
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+#
+# Please report any bugs, questions or comments to contact@wand.net.nz
+#
+
+
+
+import Queue as StdQueue
+
+from libnntsc.pikaqueue import PikaConsumer
+from libnntsc.batching import BATCH_FLUSH_IDLE
+import libnntscclient.logger as logger
+
+# How often (in seconds) the dispatcher checks for acknowledgements from
+# the workers
+RESULT_POLL_INTERVAL = 0.1
+
+# How long (in seconds) a worker will wait for a new message before
+# committing whatever it already has
+WORKER_IDLE_FLUSH = 1
+
+class ShardProperties(object):
+    """ The subset of the message properties that a worker needs, in a form
+        that can be passed through a multiprocessing queue.
+    """
+    def __init__(self, properties):
+        self.user_id = getattr(properties, "user_id", None)
+        self.timestamp = getattr(properties, "timestamp", None)
+        self.headers = getattr(properties, "headers", None)
+
+class ShardMethod(object):
+    def __init__(self, delivery_tag):
+        self.delivery_tag = delivery_tag
+
+class ShardChannel(object):
+    """ Stands in for the pika channel within a worker process.
+
+        Acknowledgements and requests to close the channel are passed
+        back to the dispatcher, which owns the real channel.
+    """
+    def __init__(self, results, worker):
+        self.results = results
+        self.worker = worker
+        self.generation = 0
+
+    def basic_ack(self, delivery_tag=0, multiple=False):
+        self.results.put(("ack", self.worker, self.generation, delivery_tag,
+                multiple))
+
+    def close(self):
+        self.results.put(("close", self.worker, self.generation, 0, False))
+
+class ShardDispatcher(PikaConsumer):
+    """ Consumes messages from a rabbit queue and hands each of them to one
+        of a set of worker processes without decoding them.
+
+        Messages are only acknowledged once the worker that received them
+        reports that they have been committed. Each worker commits
+        independently, so messages are acknowledged individually rather
+        than cumulatively.
+
+        Every time the channel is opened or closed the shared generation
+        counter is incremented. Unacknowledged messages will be redelivered
+        on the new channel, so workers discard anything they are holding
+        from an older generation.
+    """
+
+    def __init__(self, queuename, host, port, ssl, user, pword, route,
+            workerqueues, results, generation):
+        super(ShardDispatcher, self).__init__('', queuename, host, port, ssl,
+                user, pword, True)
+
+        self._route = route
+        self._workerqueues = workerqueues
+        self._results = results
+        self._generation = generation
+        self._outstanding = [[] for w in workerqueues]
+
+    def _new_generation(self):
+        with self._generation.get_lock():
+            self._generation.value += 1
+        self._outstanding = [[] for w in self._workerqueues]
+
+    def _pikaConnectionOpen(self, unused):
+        super(ShardDispatcher, self)._pikaConnectionOpen(unused)
+        self._connection.add_timeout(RESULT_POLL_INTERVAL, self._poll_results)
+
+    def _pikaChannelOpen(self, channel):
+        self._new_generation()
+        super(ShardDispatcher, self)._pikaChannelOpen(channel)
+
+    def _pikaChannelClosed(self, channel, replycode, replytext):
+        self._new_generation()
+        super(ShardDispatcher, self)._pikaChannelClosed(channel, replycode,
+                replytext)
+
+    def dispatch(self, channel, method, properties, body):
+        worker = self._route(properties)
+
+        if worker is None:
+            # Nobody is going to want this message, so there's no point
+            # keeping it around
+            channel.basic_ack(method.delivery_tag)
+            return
+
+        self._outstanding[worker].append(method.delivery_tag)
+        self._workerqueues[worker].put((self._generation.value,
+                method.delivery_tag, ShardProperties(properties), body))
+
+    def _poll_results(self):
+        while True:
+            try:
+                result = self._results.get(False)
+            except StdQueue.Empty:
+                break
+            self._handle_result(result)
+
+        if not self._closing:
+            self._connection.add_timeout(RESULT_POLL_INTERVAL,
+                    self._poll_results)
+
+    def _handle_result(self, result):
+        action, worker, generation, tag, multiple = result
+
+        # Anything from an old channel is meaningless now
+        if generation != self._generation.value or self._channel is None:
+            return
+
+        if action == "close":
+            logger.log("Shard worker %d requested a channel reset" % (worker))
+            self._channel.close()
+            return
+
+        if action != "ack":
+            return
+
+        outstanding = self._outstanding[worker]
+        if multiple:
+            acked = [t for t in outstanding if t <= tag]
+            self._outstanding[worker] = [t for t in outstanding if t > tag]
+        else:
+            acked = [tag]
+            if tag in outstanding:
+                outstanding.remove(tag)
+
+        for t in acked:
+            self._channel.basic_ack(t)
+
+    def configure(self, keys, prefetch):
+        super(ShardDispatcher, self).configure(keys, self.dispatch, prefetch)
+
+def consume_shard(module, worker, inqueue, results, generation):
+    """ Feeds messages from the dispatcher to a module's process_data
+        callback, as though they had been read directly from the rabbit
+        queue.
+
+        The module must also provide process_pending(), which commits any
+        messages that have been received but not yet committed,
+        check_pending(), which is called periodically to commit batches
+        that have been waiting too long, and drop_pending(), which discards
+        any uncommitted messages.
+    """
+
+    channel = ShardChannel(results, worker)
+    channel.generation = generation.value
+
+    while True:
+        try:
+            gen, tag, properties, body = inqueue.get(True, WORKER_IDLE_FLUSH)
+        except StdQueue.Empty:
+            gen = None
+
+        current = generation.value
+        if channel.generation != current:
+            # The channel has been reset, so the messages we are holding
+            # will be redelivered
+            module.drop_pending()
+            channel.generation = current
+
+        if gen is None:
+            # Queue has gone quiet, commit what we have rather than waiting
+            # for a full batch
+            module.check_pending(channel)
+            module.process_pending(channel, BATCH_FLUSH_IDLE)
+            continue
+
+        if gen != current:
+            continue
+
+        module.process_data(channel, ShardMethod(tag), properties, body)
+        module.check_pending(channel)
+
+# vim: set sw=4 tabstop=4 softtabstop=4 expandtab :
@@ -0,0 +1,212 @@
+#
+# This file is part of NNTSC.
+#
+# Copyright (C) 2013-2017 The University of Waikato, Hamilton, New Zealand.
+#
+# Authors: Shane Alcock
+#          Brendon Jones
+#
+# All rights reserved.
+#
+# This code has been developed by the WAND Network Research Group at the
+# University of Waikato. For further information please see
+# http://www.wand.net.nz/
+#
+# NNTSC is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# NNTSC is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with NNTSC; if not, write to the Free Software Foundation, Inc.
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+#
+# Please report any bugs, questions or comments to contact@wand.net.nz
+#
+
+
+import os
+import struct
+import cPickle
+
+import libnntscclient.logger as logger
+
+# Each record in the spool file is prefixed with its length
+RECORD_HEADER = struct.Struct("!I")
+
+class SpoolMethod(object):
+    """ Stands in for the delivery details of a message read back from the
+        spool, which has already been acknowledged.
+    """
+    def __init__(self):
+        self.delivery_tag = None
+
+class SpoolProperties(object):
+    """ The message properties that were saved in the spool """
+    def __init__(self, user_id, timestamp, headers):
+        self.user_id = user_id
+        self.timestamp = timestamp
+        self.headers = headers
+
+def spooled_messages(records):
+    """ Turns spool records back into (method, properties, body) tuples
+        that look like the messages the AMP module normally consumes.
+    """
+    return [(SpoolMethod(), SpoolProperties(source, timestamp,
+            {"x-amp-test-type": test}), body) \
+            for test, source, timestamp, body in records]
+
+def read_records(path):
+    """ Reads every complete record from a file written in the spool
+        format, without modifying it. An incomplete record at the end of
+        the file is ignored.
+    """
+    with open(path, "rb") as f:
+        while True:
+            header = f.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                break
+            length = RECORD_HEADER.unpack(header)[0]
+            data = f.read(length)
+            if len(data) < length:
+                logger.log("Ignoring incomplete record at the end of %s" % \
+                        (path))
+                break
+            yield cPickle.loads(data)
+
+class IngestSpool(object):
+    """ An append-only file of messages that could not be written to the
+        database when they arrived.
+
+        Messages are appended (and synced to disk) before they are
+        acknowledged, then read back in order once the database is
+        available again. The position of the first message that has not
+        yet been replayed is kept in a separate file, so that replaying
+        can pick up where it left off after a restart. Once everything has
+        been replayed the spool is emptied.
+    """
+
+    def __init__(self, path, maxsize):
+        self.path = path
+        self.offsetpath = path + ".offset"
+        self.maxsize = maxsize
+
+        self.spoolfile = open(self.path, "ab+")
+        self.readoffset = self._load_offset()
+        self.size = self._check_records()
+
+        if self.size > self.readoffset:
+            logger.log("Spool %s has %d bytes waiting to be replayed" % \
+                    (self.path, self.size - self.readoffset))
+
+    def close(self):
+        self.spoolfile.close()
+
+    def empty(self):
+        return self.readoffset >= self.size
+
+    def append(self, records):
+        """ Appends a list of records to the spool and waits for them to
+            reach the disk.
+
+            Returns False if the records would make the spool bigger than
+            its maximum size, in which case nothing is written.
+        """
+        data = []
+        length = 0
+        for r in records:
+            pickled = cPickle.dumps(r, cPickle.HIGHEST_PROTOCOL)
+            data.append(RECORD_HEADER.pack(len(pickled)))
+            data.append(pickled)
+            length += RECORD_HEADER.size + len(pickled)
+
+        if self.size + length > self.maxsize:
+            return False
+
+        self.spoolfile.seek(0, os.SEEK_END)
+        self.spoolfile.write("".join(data))
+        self.spoolfile.flush()
+        os.fsync(self.spoolfile.fileno())
+        self.size += length
+        return True
+
+    def read(self, count):
+        """ Reads up to count records, starting from the first record that
+            has not been replayed yet.
+
+            Returns a tuple containing the list of records and the offset
+            to pass to advance() once the records have been dealt with.
+        """
+        records = []
+        offset = self.readoffset
+
+        self.spoolfile.seek(offset)
+        while len(records) < count and offset < self.size:
+            length = RECORD_HEADER.unpack(
+                    self.spoolfile.read(RECORD_HEADER.size))[0]
+            records.append(cPickle.loads(self.spoolfile.read(length)))
+            offset += RECORD_HEADER.size + length
+
+        return records, offset
+
+    def advance(self, offset):
+        """ Marks everything before the given offset as replayed """
+        if offset >= self.size:
+            # All caught up, so we can start again with an empty spool
+            self.spoolfile.truncate(0)
+            self.size = 0
+            offset = 0
+
+        self.readoffset = offset
+        self._save_offset()
+
+    def _load_offset(self):
+        try:
+            with open(self.offsetpath, "r") as f:
+                return int(f.read().strip())
+        except IOError:
+            return 0
+        except ValueError:
+            logger.log("Invalid offset for spool %s, replaying from the start" % (self.path))
+            return 0
+
+    def _save_offset(self):
+        # Write to a temporary file and rename it into place so that we
+        # never end up with a partially written offset
+        tmppath = self.offsetpath + ".tmp"
+        with open(tmppath, "w") as f:
+            f.write("%d\n" % (self.readoffset))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmppath, self.offsetpath)
+
+    def _check_records(self):
+        # Find the end of the last complete record, in case we were
+        # stopped part way through appending to the spool
+        self.spoolfile.seek(0, os.SEEK_END)
+        filesize = self.spoolfile.tell()
+
+        if self.readoffset > filesize:
+            self.readoffset = 0
+        offset = self.readoffset
+
+        self.spoolfile.seek(offset)
+        while offset + RECORD_HEADER.size <= filesize:
+            length = RECORD_HEADER.unpack(
+                    self.spoolfile.read(RECORD_HEADER.size))[0]
+            if offset + RECORD_HEADER.size + length > filesize:
+                break
+            self.spoolfile.seek(length, os.SEEK_CUR)
+            offset += RECORD_HEADER.size + length
+
+        if offset < filesize:
+            logger.log("Discarding incomplete record at the end of spool %s" % (self.path))
+            self.spoolfile.truncate(offset)
+
+        return offset
+
+# vim: set sw=4 tabstop=4 softtabstop=4 expandtab :
@@ -28,29 +28,114 @@
 # Please report any bugs, questions or comments to contact@wand.net.nz
 #
 
+import os
 import time
-import cPickle
-import zlib
-import pylibmc
+import threading
 
-from libnntscclient.logger import *
+from libnntsc.lrucache import ExpiringLRUCache
+from libnntsc.cachebackends import create_cache_backend
+
+# How often (in seconds) to write the last timestamps for any streams that
+# have been updated back to the cache
+LAST_TIMESTAMP_FLUSH_FREQ = 60
+
+# Maximum number of timestamps to keep in the in-process cache that sits in
+# front of the cache backend
+LOCAL_CACHE_SIZE = 100000
+
+# How long (in seconds) a timestamp can be served from the in-process cache
+# before it must be fetched from the cache backend again
+LOCAL_CACHE_TTL = 30
+
+class LocalTimestampCache(object):
+    """ A bounded in-process cache of timestamps, keyed by their cache
+        keys. A single instance is shared by every StreamCache in the
+        process (e.g. all of the exporter's worker threads), so all access
+        is protected by a lock.
+    """
+    def __init__(self, maxsize, ttl):
+        self.cache = ExpiringLRUCache(maxsize, ttl)
+        self.lock = threading.Lock()
+
+    def get_multi(self, keys):
+        """ Looks up a list of keys, returning a dictionary of the values
+            that were found and a list of the keys that were not.
+        """
+        found = {}
+        missing = []
+        now = time.time()
+        with self.lock:
+            for k in keys:
+                value = self.cache.get(k, None, now)
+                if value is None:
+                    missing.append(k)
+                else:
+                    found[k] = value
+        return found, missing
+
+    def set_multi(self, values):
+        now = time.time()
+        with self.lock:
+            for k, v in values.iteritems():
+                self.cache.put(k, v, now)
+
+    def stats(self):
+        with self.lock:
+            return self.cache.stats()
+
+    def describe(self):
+        with self.lock:
+            return self.cache.describe()
+
+_localcache = None
+_localcache_lock = threading.Lock()
+
+def local_timestamp_cache():
+    """ Returns the in-process timestamp cache, creating it the first time
+        this is called.
+    """
+    global _localcache
+    with _localcache_lock:
+        if _localcache is None:
+            _localcache = LocalTimestampCache(LOCAL_CACHE_SIZE,
+                    LOCAL_CACHE_TTL)
+        return _localcache
 
 class StreamCache(object):
-    def __init__(self, nntscid, cachetime):
-        self.memcache = pylibmc.Client(
-            ["127.0.0.1"],
-            behaviors={
-                "tcp_nodelay": True,
-                "no_block": True,
-            })
-        self.mcpool = pylibmc.ThreadMappedPool(self.memcache)
+    """ Caches the first and last timestamps of each stream.
+
+        The timestamps can be stored in memcache, in a table in shared
+        memory that every NNTSC process on this machine can read, or not
+        at all -- see libnntsc.cachebackends.
+
+        Each stream has its own key for each style of timestamp, so looking
+        up (or updating) a handful of streams only ever touches those
+        streams, no matter how big the collection is. Use the *_timestamps
+        methods with a list of stream ids to fetch or store a whole label's
+        worth of streams in one round trip.
+
+        If the backend is remote, timestamps that have been recently
+        fetched or stored by anything in this process are served from an
+        in-process cache instead, see LocalTimestampCache.
+    """
+    def __init__(self, nntscid, cachetime, backend="memcache", path=None,
+            slots=None):
+        if path is None:
+            path = os.path.join("/dev/shm", "nntsc-%s-timestamps" % (nntscid))
+
+        self.backend = create_cache_backend(backend, path, slots)
         self.nntscid = nntscid
         self.cachetime = int(cachetime)
 
-        self.collections = {}
+        if self.backend.uselocal:
+            self.local = local_timestamp_cache()
+        else:
+            self.local = None
 
-    def __del__(self):
-        self.mcpool.relinquish()
+        # The last timestamps that have been reported by update_timestamps
+        # for each collection, and which of them still need to be written
+        # to the cache
+        self.collections = {}
 
     def update_timestamps(self, db, collection, streamids, last, first=None):
         if first is None and last is None:
@@ -62,83 +147,114 @@ class StreamCache(object):
         # Don't bother trying to update 'first' -- if anyone wants it
         # and it is uncached, it's probably less effort to do the query
         # than update the cache every time we create a new stream
-        #if first is not None:
-        #    self._update_first_timestamp(collection, streamid, first)
-
-    def _update_first_timestamp(self, db, collection, streamid, first):
-        # Always fetch first timestamps, because another process might
-        # set the first timestamp instead
-        coldict = self._fetch_dict(db, collection, "first")
-        coldict[streamid] = first
-        self.set_first_timestamps(db, collection, coldict)
 
     def _update_last_timestamp(self, db, collection, streamids, last):
-        if collection not in self.collections:
-            coldict = self._fetch_dict(db, collection, "last")
-            self.collections[collection] = {"streams":coldict}
-        else:
-            coldict = self.collections[collection]['streams']
+        key = (db, collection)
+        if key not in self.collections:
+            self.collections[key] = {"streams":{}, "dirty":set(),
+                    "laststore":0}
+        coldict = self.collections[key]
 
+        streams = coldict["streams"]
         for s in streamids:
-            if s not in coldict or last > coldict[s]:
-                coldict[s] = last
+            if s not in streams or last > streams[s]:
+                streams[s] = last
+                coldict["dirty"].add(s)
 
+        # Write timestamps back to the cache periodically rather than
+        # every time we update a stream, otherwise this gets very slow
         now = time.time()
-        if 'laststore' not in self.collections[collection]:
-            self.set_last_timestamps(db, collection, coldict)
-            self.collections[collection]['laststore'] = time.time()
+        if now - coldict["laststore"] >= LAST_TIMESTAMP_FLUSH_FREQ:
+            self._flush_last_timestamps(db, collection, coldict)
+            coldict["laststore"] = now
 
-        # Write timestamps back to the cache every 5 mins rather than
-        # every time we update a stream, otherwise this gets very slow
-        if now - self.collections[collection]['laststore'] >= 60:
-            self.set_last_timestamps(db, collection, coldict)
-            self.collections[collection]['laststore'] = now
+    def _flush_last_timestamps(self, db, collection, coldict):
+        if len(coldict["dirty"]) == 0:
+            return
 
-    def fetch_all_last_timestamps(self, db, collection):
-        fetched = self._fetch_dict(db, collection, "last")
-        return fetched
+        streams = coldict["streams"]
+        changed = dict([(s, streams[s]) for s in coldict["dirty"]])
+        if self._set_timestamps(db, collection, changed, "last"):
+            coldict["dirty"] = set()
+
+    def fetch_last_timestamps(self, db, collection, streamids):
+        """ Returns a dictionary mapping each of the given streams to its
+            last timestamp. Streams that aren't cached are left out.
+        """
+        fetched = self._fetch_timestamps(db, collection, streamids, "last")
 
-    def fetch_all_first_timestamps(self, db, collection):
-        fetched = self._fetch_dict(db, collection, "first")
+        # Anything reported to this process is at least as recent as the
+        # cached copy, which may not have been written yet
+        key = (db, collection)
+        if key in self.collections:
+            streams = self.collections[key]["streams"]
+            for s in streamids:
+                if s in streams and (s not in fetched or \
+                        streams[s] > fetched[s]):
+                    fetched[s] = streams[s]
         return fetched
 
-    def _fetch_dict(self, db, collection, style):
+    def fetch_first_timestamps(self, db, collection, streamids):
+        """ Returns a dictionary mapping each of the given streams to its
+            first timestamp. Streams that aren't cached are left out.
+        """
+        return self._fetch_timestamps(db, collection, streamids, "first")
 
-        key = self._dict_cache_key(db, collection, style)
+    def _fetch_timestamps(self, db, collection, streamids, style):
+        if len(streamids) == 0:
+            return {}
+
+        prefix = self._cache_key_prefix(db, collection, style)
+        keys = [prefix + str(s) for s in streamids]
+        if self.local is not None:
+            found, missing = self.local.get_multi(keys)
+        else:
+            found, missing = {}, keys
 
-        #print "Fetching using key", key, time.time()
-        coldict = {}
-        with self.mcpool.reserve() as mc:
-            try:
-                if key in mc:
-                    fetched = mc.get(key)
-                    coldict = cPickle.loads(zlib.decompress(fetched))
-            except pylibmc.SomeErrors as e:
-                log("Warning: pylibmc error while fetching collection timestamps")
-                log(e)
+        if len(missing) > 0:
+            remote = self.backend.get_multi(missing)
+            if self.local is not None:
+                self.local.set_multi(remote)
+            found.update(remote)
+
+        fetched = {}
+        for s in streamids:
+            ts = found.get(prefix + str(s))
+            if ts is not None:
+                fetched[s] = ts
+        return fetched
 
-        return coldict
+    def set_first_timestamps(self, db, collection, timestamps):
+        """ Stores the first timestamps for the streams in the given
+            dictionary, leaving all other streams alone.
+        """
+        self._set_timestamps(db, collection, timestamps, "first")
 
-    def set_first_timestamps(self, db, collection, coldict):
-        self._set_timestamps(db, collection, coldict, "first")
+    def set_last_timestamps(self, db, collection, timestamps):
+        """ Stores the last timestamps for the streams in the given
+            dictionary, leaving all other streams alone.
+        """
+        self._set_timestamps(db, collection, timestamps, "last")
 
-    def set_last_timestamps(self, db, collection, coldict):
-        self._set_timestamps(db, collection, coldict, "last")
+    def _set_timestamps(self, db, collection, timestamps, style):
+        if len(timestamps) == 0:
+            return True
 
-    def _set_timestamps(self, db, collection, coldict, style):
-        key = self._dict_cache_key(db, collection, style)
+        prefix = self._cache_key_prefix(db, collection, style)
+        tostore = dict([(prefix + str(s), int(ts)) \
+                for s, ts in timestamps.iteritems()])
 
-        tostore = zlib.compress(cPickle.dumps(coldict), 1)
-        #print "Storing using key", key, time.time()
-        with self.mcpool.reserve() as mc:
-            try:
-                mc.set(key, tostore, self.cachetime)
-            except pylibmc.SomeErrors as e:
-                log("Warning: pylibmc error while storing collection timestamps")
-                log(e)
+        if self.local is not None:
+            self.local.set_multi(tostore)
+        return self.backend.set_multi(tostore, self.cachetime)
 
+    def describe_local_cache(self):
+        if self.local is None:
+            return "not used with %s backend" % (self.backend.name)
+        return self.local.describe()
 
-    def _dict_cache_key(self, db, collection, style):
-        return "nntsc_%s_%s_%s_%s" % (self.nntscid, db, str(collection), style)
+    def _cache_key_prefix(self, db, collection, style):
+        return "nntsc_%s_%s_%s_%s_" % (self.nntscid, db, str(collection),
+                style)
 
 # vim: set smartindent shiftwidth=4 tabstop=4 softtabstop=4 expandtab :
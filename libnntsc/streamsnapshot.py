@@ -0,0 +1,176 @@
+#
+# This file is part of NNTSC.
+#
+# Copyright (C) 2013-2017 The University of Waikato, Hamilton, New Zealand.
+#
+# Authors: Shane Alcock
+#          Brendon Jones
+#
+# All rights reserved.
+#
+# This code has been developed by the WAND Network Research Group at the
+# University of Waikato. For further information please see
+# http://www.wand.net.nz/
+#
+# NNTSC is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# NNTSC is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with NNTSC; if not, write to the Free Software Foundation, Inc.
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+#
+# Please report any bugs, questions or comments to contact@wand.net.nz
+#
+
+
+import os
+import mmap
+import struct
+import marshal
+
+import libnntscclient.logger as logger
+
+# Identifies a stream snapshot file and the version of its format
+SNAPSHOT_MAGIC = "NNSS"
+SNAPSHOT_VERSION = 3
+
+# magic, format version, identity of the database the snapshot was taken
+# from, highest stream id included in the snapshot
+SNAPSHOT_HEADER = struct.Struct("!4sIQQ")
+
+class StreamSnapshot(object):
+    """ A copy of the stream key to stream id map for each streams table,
+        saved to disk so that they don't have to be rebuilt from the
+        streams tables every time NNTSC starts.
+
+        The snapshot records the value of the stream id sequence when it
+        was taken -- any streams with a larger id need to be fetched from
+        the database and added to the maps after the snapshot is loaded.
+        It also records the identity of the database (see
+        DatabaseCore.get_database_identity()), so that a snapshot is never
+        used with a database that has been rebuilt or restored since.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def highwater(self):
+        """ Returns the largest stream id covered by the snapshot, or None
+            if there is no usable snapshot.
+        """
+        try:
+            with open(self.path, "rb") as f:
+                header = f.read(SNAPSHOT_HEADER.size)
+        except IOError:
+            return None
+
+        checked = self._check_header(header)
+        if checked is None:
+            return None
+        return checked[1]
+
+    def load(self, identity=None):
+        """ Reads the snapshot, returning a tuple containing the largest
+            stream id that it covers and a dictionary mapping each streams
+            table to its stream map. Returns (None, {}) if there is no usable
+            snapshot, or if identity is given and the snapshot was taken
+            from a different database.
+        """
+        try:
+            f = open(self.path, "rb")
+        except IOError:
+            return None, {}
+
+        try:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (mmap.error, ValueError) as e:
+            logger.log("Unable to map stream snapshot %s: %s" % (self.path,
+                    e))
+            f.close()
+            return None, {}
+
+        try:
+            checked = self._check_header(mapped[:SNAPSHOT_HEADER.size])
+            if checked is None:
+                return None, {}
+
+            snapid, highwater = checked
+            if identity is not None and snapid != identity:
+                logger.log("Stream snapshot %s belongs to a different database, ignoring it" % (self.path))
+                return None, {}
+
+            try:
+                maps = marshal.loads(buffer(mapped, SNAPSHOT_HEADER.size))
+            except (EOFError, ValueError, TypeError):
+                logger.log("Stream snapshot %s is corrupt, ignoring it" % \
+                        (self.path))
+                return None, {}
+        finally:
+            mapped.close()
+            f.close()
+
+        return highwater, maps
+
+    def save(self, highwater, maps, identity=0):
+        """ Replaces the snapshot with the given stream maps, which must
+            include every stream with an id up to and including highwater
+            in the database with the given identity.
+        """
+        try:
+            data = marshal.dumps(maps)
+        except ValueError as e:
+            logger.log("Unable to save stream snapshot %s: %s" % (self.path,
+                    e))
+            return False
+
+        # Write to a temporary file and rename it into place so that a
+        # partially written snapshot is never loaded
+        tmppath = self.path + ".tmp"
+        try:
+            with open(tmppath, "wb") as f:
+                f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION,
+                        identity, highwater))
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmppath, self.path)
+        except (IOError, OSError) as e:
+            logger.log("Unable to save stream snapshot %s: %s" % (self.path,
+                    e))
+            return False
+        return True
+
+    def remove(self):
+        """ Deletes the snapshot, e.g. because the database it was taken
+            from has been wiped.
+        """
+        try:
+            os.remove(self.path)
+        except OSError as e:
+            if os.path.exists(self.path):
+                logger.log("Unable to remove stream snapshot %s: %s" % \
+                        (self.path, e))
+                return False
+        return True
+
+    def _check_header(self, header):
+        """ Returns the database identity and highwater from a snapshot
+            header, or None if the header is not valid.
+        """
+        if len(header) < SNAPSHOT_HEADER.size:
+            return None
+
+        magic, version, identity, highwater = SNAPSHOT_HEADER.unpack(header)
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+            logger.log("Ignoring stream snapshot %s with unknown format" % \
+                    (self.path))
+            return None
+        return identity, highwater
+
+# vim: set sw=4 tabstop=4 softtabstop=4 expandtab :
@@ -40,7 +40,7 @@ except ImportError:
 
 requires = [
         'python-rrdtool', 'psycopg2>=2.5', 'pika>=0.9.12,<0.11.0', 'python-daemon',
-	'libnntsc-client', 'pylibmc', 'influxdb>=2.12.0', 'requests'
+	'libnntsc-client', 'influxdb>=2.12.0', 'requests'
 ]
 
 if sys.version_info < (2, 7):
@@ -52,9 +52,12 @@ setup(name="nntsc",
         author='Shane Alcock, Brendon Jones',
         author_email='contact@wand.net.nz',
         url='http://www.wand.net.nz',
-	scripts=['build_nntsc_db', 'nntsc'],
+	scripts=['build_nntsc_db', 'nntsc', 'nntsc-import',
+		'nntsc-migrate-paths', 'nntsc-repack-arrays',
+		'nntsc-migrate-layout'],
 	packages=['libnntsc', 'libnntsc.parsers'],
 	install_requires = requires,
+	extras_require = {'memcache': ['pylibmc']},
         tests_require = ["mock"],
         test_suite="tests",
 	package_dir = {
@@ -0,0 +1,81 @@
+import unittest
+import mock
+from libnntsc import activityindex
+from libnntsc.activityindex import StreamActivityIndex, \
+        stream_activity_index, ACTIVITY_GRACE
+from libnntsc.dbselect import DBSelector
+
+class TestStreamActivityIndex(unittest.TestCase):
+
+    def setUp(self):
+        # each test gets a new process-wide index
+        patcher = mock.patch.object(activityindex, "_activityindex", None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def create_selector(self, name):
+        selector = DBSelector(name, "nntsc", cachebackend="none")
+        selector.streams_with_tables = mock.Mock(return_value=[1, 2])
+        selector.streamcache = mock.Mock()
+        selector.streamcache.fetch_first_timestamps.return_value = {1: 100}
+        selector.streamcache.fetch_last_timestamps.return_value = {1: 1000}
+        selector._query_stream_bounds = mock.Mock(
+                return_value=[(2, 5000, 6000)])
+        return selector
+
+    def test_shared_between_selectors(self):
+        self.assertIs(stream_activity_index(), stream_activity_index())
+
+        first = self.create_selector("first")
+        self.assertEqual(first._active_streams("data_amp_icmp", [1, 2, 3],
+                0, 2000), [1])
+        self.assertEqual(first.streams_with_tables.call_count, 1)
+
+        # a selector for the next request uses what the first one found
+        second = self.create_selector("second")
+        self.assertIs(second.activity, first.activity)
+        self.assertEqual(second._active_streams("data_amp_icmp", [1, 2, 3],
+                5500, 7000), [2])
+        self.assertFalse(second.streams_with_tables.called)
+        self.assertFalse(second._query_stream_bounds.called)
+
+    def test_stale(self):
+        index = StreamActivityIndex(refresh=60)
+        index.update("t", 1, True, 10, 20, now=1000)
+        self.assertEqual(index.stale("t", [1, 2], now=1059), [2])
+        self.assertEqual(index.stale("t", [1, 2], now=1061), [1, 2])
+        self.assertEqual(index.stale("other", [1], now=1000), [1])
+
+    def test_was_active(self):
+        index = StreamActivityIndex()
+        now = 100000
+        index.update("t", 1, True, 1000, 2000, now=now)
+        index.update("t", 2, False, 1000, 2000, now=now)
+        index.update("t", 3, True, None, None, now=now)
+        index.update("t", 4, True, 1000, now - 10, now=now)
+
+        self.assertTrue(index.was_active("t", 1, 1500, 3000, now))
+        self.assertFalse(index.was_active("t", 1, 0, 999, now))
+        self.assertFalse(index.was_active("t", 1, 2001, 3000, now))
+        self.assertFalse(index.was_active("t", 2, 1500, 3000, now))
+        self.assertFalse(index.was_active("t", 3, 1500, 3000, now))
+        self.assertFalse(index.was_active("t", 5, 1500, 3000, now))
+
+        # recently active streams may have new data that we don't know
+        # about yet
+        self.assertTrue(index.was_active("t", 4, now, now + 60, now))
+        self.assertFalse(index.was_active("t", 4, now, now + 60,
+                now + ACTIVITY_GRACE))
+
+    def test_forget(self):
+        index = StreamActivityIndex()
+        index.update("a", 1, True, 10, 20, now=1000)
+        index.update("b", 1, True, 10, 20, now=1000)
+        index.forget("a")
+        self.assertEqual(index.stale("a", [1], now=1000), [1])
+        self.assertEqual(index.stale("b", [1], now=1000), [])
+        index.forget()
+        self.assertEqual(index.stale("b", [1], now=1000), [1])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,20 @@
+import unittest
+
+try:
+    from libnntsc.parsers.amp import create_parsers
+except ImportError:
+    # the AMP module needs ampsave to decode messages
+    create_parsers = None
+
+@unittest.skipIf(create_parsers is None, "ampsave is not installed")
+class TestAmpParser(unittest.TestCase):
+    def test_decoder_parsers(self):
+        # the decode pool builds its parsers without a database
+        parsers = create_parsers(None, None)
+        self.assertTrue("traceroute" in parsers)
+        for plist in parsers.itervalues():
+            for p in plist:
+                self.assertIs(p.db, None)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,131 @@
+import unittest
+from libnntsc.batching import BatchController, BATCH_FLUSH_SIZE, \
+        BATCH_FLUSH_AGE, BATCH_FLUSH_IDLE
+
+class FakeClock(object):
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+class TestBatchController(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+
+    def run_batch(self, batcher, interval, commitlatency):
+        """ Feeds messages into the controller at a fixed interval until
+            it decides to flush, then commits the batch.
+        """
+        started = self.clock.time()
+        pending = 0
+        while True:
+            self.clock.advance(interval)
+            pending += 1
+            reason = batcher.should_flush(pending,
+                    self.clock.time() - started)
+            if reason is not None:
+                break
+
+        committed = self.clock.time()
+        self.clock.advance(commitlatency)
+        batcher.record_commit(pending, self.clock.time() - committed,
+                reason)
+        return pending, reason
+
+    def test_limits(self):
+        batcher = BatchController(1000, 0, 50, 5, 1.0)
+        self.assertEqual((batcher.minsize, batcher.maxsize), (1, 50))
+        self.assertEqual(batcher.batchsize, 50)
+
+        batcher = BatchController(1, 10, 5, 5, 1.0)
+        self.assertEqual((batcher.minsize, batcher.maxsize), (10, 10))
+        self.assertEqual(batcher.batchsize, 10)
+
+    def test_should_flush(self):
+        batcher = BatchController(10, 1, 100, 5, 1.0)
+        self.assertIs(batcher.should_flush(0, 60), None)
+        self.assertIs(batcher.should_flush(9, 4.9), None)
+        self.assertEqual(batcher.should_flush(10, 0), BATCH_FLUSH_SIZE)
+        self.assertEqual(batcher.should_flush(1, 5), BATCH_FLUSH_AGE)
+
+    def test_grow(self):
+        batcher = BatchController(20, 1, 30, 60, 1.0)
+
+        # fast commits of full batches grow the batch by a tenth each time
+        sizes = []
+        for i in range(0, 6):
+            pending, reason = self.run_batch(batcher, 0.01, 0.1)
+            self.assertEqual(reason, BATCH_FLUSH_SIZE)
+            sizes.append(batcher.batchsize)
+        self.assertEqual(sizes, [22, 24, 26, 28, 30, 30])
+
+    def test_grow_small(self):
+        batcher = BatchController(1, 1, 10, 60, 1.0)
+        self.run_batch(batcher, 0.01, 0.1)
+        self.assertEqual(batcher.batchsize, 2)
+
+    def test_no_grow_when_slow(self):
+        batcher = BatchController(20, 1, 100, 60, 1.0)
+
+        # commits within the target but more than half of it are left alone
+        self.run_batch(batcher, 0.01, 0.75)
+        self.assertEqual(batcher.batchsize, 20)
+
+    def test_shrink(self):
+        batcher = BatchController(100, 15, 100, 60, 1.0)
+
+        sizes = []
+        for i in range(0, 3):
+            self.run_batch(batcher, 0.01, 2.0)
+            sizes.append(batcher.batchsize)
+        self.assertEqual(sizes, [50, 25, 15])
+
+    def test_deadline(self):
+        batcher = BatchController(100, 1, 1000, 5, 1.0)
+
+        # light traffic never fills the batch, so the deadline flushes it
+        # and the batch size stays where it is
+        pending, reason = self.run_batch(batcher, 1.0, 0.1)
+        self.assertEqual((pending, reason), (5, BATCH_FLUSH_AGE))
+        self.assertEqual(batcher.batchsize, 100)
+
+        # but a slow commit still shrinks it
+        self.run_batch(batcher, 1.0, 3.0)
+        self.assertEqual(batcher.batchsize, 50)
+
+    def test_idle(self):
+        batcher = BatchController(100, 1, 1000, 5, 1.0)
+        batcher.record_commit(3, 0.1, BATCH_FLUSH_IDLE)
+        self.assertEqual(batcher.batchsize, 100)
+        self.assertEqual(batcher.reasons[BATCH_FLUSH_IDLE], 1)
+
+    def test_stats(self):
+        batcher = BatchController(10, 1, 100, 60, 1.0)
+        self.run_batch(batcher, 0.01, 0.5)
+        self.run_batch(batcher, 0.01, 0.25)
+        batcher.record_commit(4, 0.5, "replay")
+
+        stats = batcher.stats()
+        self.assertEqual(stats["commits"], 3)
+        self.assertEqual(stats["messages"], 24)
+        self.assertEqual(stats["reasons"], {BATCH_FLUSH_SIZE: 2,
+                BATCH_FLUSH_AGE: 0, BATCH_FLUSH_IDLE: 0, "replay": 1})
+        self.assertEqual(stats["lastlatency"], 0.5)
+
+        # the averages weight the newest commit by a fifth
+        avglatency = 0.5 + 0.2 * (0.25 - 0.5)
+        avglatency += 0.2 * (0.5 - avglatency)
+        self.assertAlmostEqual(stats["avglatency"], avglatency)
+        avgrate = 20 + 0.2 * (40 - 20)
+        avgrate += 0.2 * (8 - avgrate)
+        self.assertAlmostEqual(stats["avgrate"], avgrate)
+
+        self.assertTrue("commits=3" in batcher.describe())
+        self.assertTrue("replay=1" in batcher.describe())
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,167 @@
+import os
+import shutil
+import tempfile
+import unittest
+import mock
+from libnntsc import cachebackends
+from libnntsc.cachebackends import SharedMemoryBackend, NullBackend, \
+        create_cache_backend, SHARED_CACHE_PROBES, SHARED_HEADER, SHARED_SLOT
+
+SLOTS = 16
+
+class TestSharedMemoryBackend(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "timestamps")
+        self.opened = []
+
+    def tearDown(self):
+        for backend in self.opened:
+            backend.map.close()
+            os.close(backend.fd)
+        shutil.rmtree(self.tmpdir)
+
+    def open(self, slots=SLOTS):
+        backend = SharedMemoryBackend(self.path, slots)
+        self.opened.append(backend)
+        return backend
+
+    def close(self, backend):
+        self.opened.remove(backend)
+        backend.map.close()
+        os.close(backend.fd)
+
+    def collide(self, backend, keys):
+        # every key wants the same first slot
+        hashes = dict([(k, 3 + SLOTS * (i + 1)) for i, k in enumerate(keys)])
+        backend._hash = lambda key: hashes[key]
+
+    def test_round_trip(self):
+        backend = self.open()
+        self.assertEqual(backend.get_multi(["a", "b"]), {})
+        self.assertTrue(backend.set_multi({"a": 1, "b": -(2 ** 40)}, 0))
+        self.assertEqual(backend.get_multi(["a", "b", "c"]),
+                {"a": 1, "b": -(2 ** 40)})
+
+    def test_overwrite(self):
+        backend = self.open()
+        backend.set_multi({"a": 1}, 0)
+        backend.set_multi({"a": 2}, 0)
+        self.assertEqual(backend.get_multi(["a"]), {"a": 2})
+
+        # the key must not have been given a second slot
+        used = [o for o in range(SLOTS) if backend._read_slot(
+                SHARED_HEADER.size + o * SHARED_SLOT.size)[0] != 0]
+        self.assertEqual(len(used), 1)
+
+    def test_full_probe_chain(self):
+        backend = self.open()
+        keys = ["k%d" % (i) for i in range(SHARED_CACHE_PROBES + 1)]
+        self.collide(backend, keys)
+
+        for i, k in enumerate(keys[:-1]):
+            backend.set_multi({k: i}, 0)
+        self.assertEqual(backend.get_multi(keys),
+                dict([(k, i) for i, k in enumerate(keys[:-1])]))
+
+        # nowhere left for the last key, so it replaces the first
+        backend.set_multi({keys[-1]: 100}, 0)
+        found = backend.get_multi(keys)
+        self.assertNotIn(keys[0], found)
+        self.assertEqual(found[keys[-1]], 100)
+        self.assertEqual(len(found), SHARED_CACHE_PROBES)
+
+        # existing keys are still updated in place
+        backend.set_multi({keys[3]: 33}, 0)
+        self.assertEqual(backend.get_multi([keys[3], keys[-1]]),
+                {keys[3]: 33, keys[-1]: 100})
+
+    def test_probe_wraps_around(self):
+        backend = self.open()
+        hashes = {"a": SLOTS - 1, "b": 2 * SLOTS - 1}
+        backend._hash = lambda key: hashes[key]
+        backend.set_multi({"a": 1, "b": 2}, 0)
+        self.assertEqual(backend.get_multi(["a", "b"]), {"a": 1, "b": 2})
+
+    def test_expiry(self):
+        backend = self.open()
+        with mock.patch.object(cachebackends.time, "time",
+                return_value=1000.0):
+            backend.set_multi({"a": 1}, 10)
+            backend.set_multi({"b": 2}, 0)
+            self.assertEqual(backend.get_multi(["a", "b"]), {"a": 1, "b": 2})
+
+        with mock.patch.object(cachebackends.time, "time",
+                return_value=1010.0):
+            self.assertEqual(backend.get_multi(["a", "b"]), {"b": 2})
+
+    def test_expired_slots_are_reused(self):
+        backend = self.open()
+        keys = ["k%d" % (i) for i in range(SHARED_CACHE_PROBES + 1)]
+        self.collide(backend, keys)
+
+        with mock.patch.object(cachebackends.time, "time",
+                return_value=1000.0):
+            backend.set_multi({keys[0]: 0}, 0)
+            backend.set_multi({keys[1]: 1}, 10)
+            for i, k in enumerate(keys[2:-1]):
+                backend.set_multi({k: i + 2}, 0)
+
+        # the expired key gives up its slot, rather than the first key
+        with mock.patch.object(cachebackends.time, "time",
+                return_value=1020.0):
+            backend.set_multi({keys[-1]: 100}, 0)
+            found = backend.get_multi(keys)
+        self.assertNotIn(keys[1], found)
+        self.assertEqual(found[keys[0]], 0)
+        self.assertEqual(found[keys[-1]], 100)
+
+    def test_reopen(self):
+        backend = self.open()
+        backend.set_multi({"a": 1}, 0)
+        self.close(backend)
+
+        backend = self.open()
+        self.assertEqual(backend.get_multi(["a"]), {"a": 1})
+
+    def test_reopen_different_layout(self):
+        backend = self.open()
+        backend.set_multi({"a": 1}, 0)
+        self.close(backend)
+
+        backend = self.open(SLOTS * 2)
+        self.assertEqual(backend.get_multi(["a"]), {})
+        self.assertEqual(os.path.getsize(self.path),
+                SHARED_HEADER.size + SLOTS * 2 * SHARED_SLOT.size)
+        backend.set_multi({"b": 2}, 0)
+        self.assertEqual(backend.get_multi(["a", "b"]), {"b": 2})
+
+    def test_reopen_bad_header(self):
+        backend = self.open()
+        backend.set_multi({"a": 1}, 0)
+        self.close(backend)
+
+        with open(self.path, "r+b") as f:
+            f.write("NOTNNTSC")
+
+        backend = self.open()
+        self.assertEqual(backend.get_multi(["a"]), {})
+
+    def test_create_backend(self):
+        backend = create_cache_backend("sharedmem", self.path, SLOTS)
+        self.opened.append(backend)
+        self.assertEqual(backend.name, "sharedmem")
+        self.assertEqual(backend.slots, SLOTS)
+
+        # each process only opens the file once
+        self.assertIs(create_cache_backend("sharedmem", self.path, SLOTS),
+                backend)
+
+    def test_create_backend_fails(self):
+        path = os.path.join(self.tmpdir, "missing", "timestamps")
+        self.assertIsInstance(create_cache_backend("sharedmem", path, SLOTS),
+                NullBackend)
+
+if __name__ == "__main__":
+    unittest.main()
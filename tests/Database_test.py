@@ -0,0 +1,184 @@
+import unittest
+import mock
+import psycopg2
+from libnntsc.database import DBInsert, NNTSCCursor, copy_format_value
+
+class FakeCursor(object):
+    """ Behaves like a psycopg2 cursor: each query replaces the result of
+        the one before it.
+    """
+    def __init__(self, nextid):
+        self.nextid = nextid
+        self.queries = []
+        self.result = None
+
+    def execute(self, query, params=None):
+        self.queries.append(query)
+        if "RETURNING stream_id" in query:
+            self.result = [(self.nextid,)]
+        else:
+            self.result = None
+
+    def fetchone(self):
+        if self.result is None:
+            raise psycopg2.ProgrammingError("no results to fetch")
+        return self.result.pop(0)
+
+class TestDBInsert(unittest.TestCase):
+
+    def create_db(self, nextid):
+        db = DBInsert("nntsc", cachebackend="none")
+        db.streams = NNTSCCursor("dbname=nntsc")
+        db.streams.cursor = FakeCursor(nextid)
+        db.clone_table = mock.Mock()
+        return db
+
+    def test_insert_stream(self):
+        db = self.create_db(42)
+        streamid = db.insert_stream("streams_amp_icmp", "data_amp_icmp",
+                1500000000, {"source": "a", "destination": "b"})
+        self.assertEqual(streamid, 42)
+
+        # the new id is used for the data table as well
+        db.clone_table.assert_called_once_with("data_amp_icmp", 42,
+                indexes=True)
+
+        # and the savepoint is released afterwards
+        queries = db.streams.cursor.queries
+        self.assertEqual(queries[0], "SAVEPOINT nntsc_stream")
+        self.assertTrue(queries[1].startswith("INSERT INTO streams_amp_icmp"))
+        self.assertEqual(queries[2], "RELEASE SAVEPOINT nntsc_stream")
+        self.assertEqual(db.streams.savepoints, [])
+
+    def test_insert_stream_reserved_id(self):
+        db = self.create_db(7)
+        db.reservedids = [7, 8]
+        streamid = db.insert_stream("streams_amp_icmp", "data_amp_icmp", 0,
+                {"source": "a"}, createdatatable=False)
+        self.assertEqual(streamid, 7)
+        self.assertEqual(db.reservedids, [8])
+        self.assertFalse(db.clone_table.called)
+
+    def test_copy_rows(self):
+        db = DBInsert("nntsc", insertmode="copy", cachebackend="none")
+        db._get_copy_coltypes = mock.Mock(return_value={"median": "int4",
+                "rtts": "_int4"})
+
+        fmt = db.row_format("data_amp_icmp", ("median", "rtts"))
+        db.insert_row(fmt, 1, 60, (5.4, [1, None, 3]))
+        db.insert_row(fmt, 1, 120, (None, None))
+        db.insert_row(fmt, 2, 60, (7, [4]))
+
+        # the column types are only looked up once
+        self.assertEqual(db._get_copy_coltypes.call_count, 1)
+
+        copycols = ("stream_id", "timestamp", '"median"', '"rtts"')
+        buffers = db.take_pending()
+        self.assertEqual(sorted(buffers.keys()), [
+                ("data_amp_icmp_1", copycols), ("data_amp_icmp_2", copycols)])
+        self.assertEqual([r[1] for r in buffers[("data_amp_icmp_1",
+                copycols)]], ["1\t60\t5\t{1,NULL,3}", "1\t120\t\\N\t\\N"])
+        self.assertEqual([r[1] for r in buffers[("data_amp_icmp_2",
+                copycols)]], ["2\t60\t7\t{4}"])
+
+    def test_batched_inserts(self):
+        db = DBInsert("nntsc", cachebackend="none")
+        db._messagequery = mock.Mock()
+
+        fmt = db.row_format("data_amp_icmp", ("median", "rtts"),
+                {"rtts": "integer[]"})
+        db.begin_batch()
+        db.insert_row(fmt, 1, 60, (5, [1, 2]))
+        db.insert_row(fmt, 2, 60, (6, [3]))
+        db.insert_row(fmt, 1, 120, (7, None))
+        self.assertFalse(db._messagequery.called)
+        db.end_batch()
+
+        queries = dict([(c[0][0].split()[2], c[0]) \
+                for c in db._messagequery.call_args_list])
+        self.assertEqual(sorted(queries.keys()), ["data_amp_icmp_1",
+                "data_amp_icmp_2"])
+
+        sql, params = queries["data_amp_icmp_1"]
+        self.assertEqual(sql, 'INSERT INTO data_amp_icmp_1 (stream_id, '
+                'timestamp, "median", "rtts") VALUES '
+                '(%s, %s, %s, CAST(%s AS integer[])), '
+                '(%s, %s, %s, CAST(%s AS integer[]))')
+        self.assertEqual(params, (1, 60, 5, [1, 2], 1, 120, 7, None))
+        self.assertEqual(queries["data_amp_icmp_2"][1], (2, 60, 6, [3]))
+
+    def test_partitioned_batch(self):
+        db = DBInsert("nntsc", datalayout="partitioned", cachebackend="none")
+        db._messagequery = mock.Mock()
+
+        # every stream shares the same INSERT
+        fmt = db.row_format("data_amp_icmp", ("median",))
+        db.begin_batch()
+        db.insert_row(fmt, 1, 60, (5,))
+        db.insert_row(fmt, 2, 60, (6,))
+        db.end_batch()
+        db._messagequery.assert_called_once_with('INSERT INTO data_amp_icmp '
+                '(stream_id, timestamp, "median") VALUES (%s, %s, %s), '
+                '(%s, %s, %s)', (1, 60, 5, 2, 60, 6))
+
+    def test_insert_data(self):
+        db = DBInsert("nntsc", cachebackend="none")
+        db._messagequery = mock.Mock()
+
+        db.insert_data("data_amp_http", "amp-http", 3, 60,
+                {"bytes": 100, "duration": None})
+        db.insert_data("data_amp_http", "amp-http", 3, 120,
+                {"bytes": 200, "duration": 5})
+        self.assertEqual(len(db.rowformats), 1)
+
+        fmt, getter = db.rowformats.values()[0]
+        self.assertEqual(db._messagequery.call_args_list[1][0][1],
+                (3, 120) + getter({"bytes": 200, "duration": 5}))
+
+class TestCopyFormat(unittest.TestCase):
+    def test_null(self):
+        self.assertEqual(copy_format_value(None), "\\N")
+        self.assertEqual(copy_format_value(None, "int4"), "\\N")
+        self.assertEqual(copy_format_value(None, "_int4"), "\\N")
+
+    def test_scalars(self):
+        self.assertEqual(copy_format_value(12), "12")
+        self.assertEqual(copy_format_value(1.5), "1.5")
+        self.assertEqual(copy_format_value(True), "t")
+        self.assertEqual(copy_format_value(False), "f")
+        self.assertEqual(copy_format_value(float("nan")), "NaN")
+        self.assertEqual(copy_format_value(float("inf")), "Infinity")
+        self.assertEqual(copy_format_value(float("-inf")), "-Infinity")
+        self.assertEqual(copy_format_value(u"caf\xe9"), "caf\xc3\xa9")
+
+        # integer columns won't accept a float in COPY
+        self.assertEqual(copy_format_value(12.6, "int4"), "13")
+        self.assertEqual(copy_format_value(12.6, "float8"), "12.6")
+
+    def test_escaping(self):
+        self.assertEqual(copy_format_value("a\tb"), "a\\tb")
+        self.assertEqual(copy_format_value("a\nb\rc"), "a\\nb\\rc")
+        self.assertEqual(copy_format_value("a\\b"), "a\\\\b")
+        self.assertEqual(copy_format_value("\\N"), "\\\\N")
+
+    def test_arrays(self):
+        self.assertEqual(copy_format_value([1, None, 3]), "{1,NULL,3}")
+        self.assertEqual(copy_format_value([]), "{}")
+        self.assertEqual(copy_format_value((1.4, 2.6), "_int4"), "{1,3}")
+        self.assertEqual(copy_format_value([1.5], "_float8"), "{1.5}")
+        self.assertEqual(copy_format_value([[1, 2], [3, None]]),
+                "{{1,2},{3,NULL}}")
+
+    def test_array_quoting(self):
+        # elements that would confuse the array parser are quoted, and
+        # the whole literal is then escaped for COPY
+        self.assertEqual(copy_format_value(["a b", "", "null", "x"]),
+                '{"a b","","null",x}')
+        self.assertEqual(copy_format_value(['a"b', "a,b", "{a}"]),
+                '{"a\\\\"b","a,b","{a}"}')
+        self.assertEqual(copy_format_value(["a\\b"]), '{"a\\\\\\\\b"}')
+        self.assertEqual(copy_format_value(["a\tb", "a\nb"]),
+                '{"a\\tb","a\\nb"}')
+
+if __name__ == "__main__":
+    unittest.main()
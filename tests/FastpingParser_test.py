@@ -1,6 +1,7 @@
 import unittest
 import mock
 from libnntsc.parsers.amp_fastping import AmpFastpingParser
+from libnntsc.packedarray import pack_array
 
 class TestFastpingParser(unittest.TestCase):
     testdata = [{
@@ -89,7 +90,7 @@ class TestFastpingParser(unittest.TestCase):
 
         # check what was written to the database
         calls = [mock.call("data_amp_fastping", mock.ANY, 0, x,
-                           {"percentiles": str})
+                           {"percentiles": pack_array})
                  for x in self.expected]
         influx.insert_data.assert_has_calls(calls, any_order=True)
 
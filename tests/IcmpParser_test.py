@@ -1,6 +1,8 @@
 import unittest
 import mock
 from libnntsc.parsers.amp_icmp import AmpIcmpParser
+from libnntsc.dberrorcodes import DBQueryException, DB_STREAM_PENDING
+from libnntsc.packedarray import pack_array
 
 class TestIcmpParser(unittest.TestCase):
     testdata = [{
@@ -104,9 +106,69 @@ class TestIcmpParser(unittest.TestCase):
         parser.process_data(0, self.testdata, "source")
 
         # check what was written to the database
-        calls = [mock.call("data_amp_icmp", mock.ANY, 0, x, {"rtts": str})
+        calls = [mock.call("data_amp_icmp", mock.ANY, 0, x, {"rtts": pack_array})
                  for x in self.expected]
         influx.insert_data.assert_has_calls(calls, any_order=True)
 
+    def test_process_batch(self):
+        influx = mock.Mock()
+        database = mock.Mock()
+        database.insert_stream.side_effect = range(0, len(self.testdata))
+
+        parser = AmpIcmpParser(database, influx)
+
+        # the same results arriving in two messages should only update the
+        # stream timestamps once, to the most recent timestamp
+        parser.process_batch([(0, 0, self.testdata, "source"),
+                (1, 60, self.testdata, "source")])
+
+        self.assertEqual(influx.insert_data.call_count,
+                2 * len(self.expected))
+        database.update_timestamp.assert_called_once_with("data_amp_icmp",
+                mock.ANY, 60, True)
+        self.assertEqual(database.end_batch.call_count, 1)
+
+    def test_queued_streams(self):
+        influx = mock.Mock()
+        database = mock.Mock()
+        database.insert_stream.side_effect = range(0, len(self.testdata))
+
+        parser = AmpIcmpParser(database, influx)
+        parser.queue_new_streams()
+
+        # each attempt should stop at the next stream that doesn't exist
+        # yet, which is only created when the caller asks for it
+        created = []
+        while True:
+            try:
+                parser.process_data(0, self.testdata, "source")
+                break
+            except DBQueryException as e:
+                self.assertEqual(e.code, DB_STREAM_PENDING)
+            self.assertEqual(parser.queued_stream_count(), 1)
+            created += parser.create_queued_streams()
+
+        self.assertEqual(len(created), len(self.expected))
+        self.assertFalse(database.commit_streams.called)
+        self.assertEqual(influx.insert_data.call_count, len(self.expected))
+
+    def test_process_data_postgres(self):
+        database = mock.Mock()
+        database.insert_stream.side_effect = range(0, len(self.testdata))
+
+        parser = AmpIcmpParser(database, None)
+        parser.process_data(0, self.testdata, "source")
+
+        # the row format is compiled once and every row is written as a
+        # positional tuple in that column order
+        database.row_format.assert_called_once_with("data_amp_icmp",
+                mock.ANY, {"rtts": "integer[]"})
+        names = database.row_format.call_args[0][1]
+        fmt = database.row_format.return_value
+        calls = [mock.call(fmt, mock.ANY, 0, tuple(map(x.get, names)))
+                 for x in self.expected]
+        database.insert_row.assert_has_calls(calls, any_order=True)
+        self.assertEqual(database.insert_row.call_count, len(self.expected))
+
 if __name__ == "__main__":
     unittest.main()
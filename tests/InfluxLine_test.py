@@ -0,0 +1,43 @@
+import unittest
+from libnntsc.influx import make_line
+
+class TestInfluxLine(unittest.TestCase):
+
+    def test_field_types(self):
+        line = make_line("data_amp_icmp", 12, 1500000000.7, {
+                "median": 2500, "loss": 0.25, "lossrate": 1.0, "ok": True,
+                "failed": False, "error": "none"})
+        self.assertEqual(line, 'data_amp_icmp,stream=12 error="none",'
+                'failed=false,loss=0.25,lossrate=1.0,median=2500i,ok=true '
+                '1500000000')
+
+    def test_long_integers(self):
+        self.assertEqual(make_line("m", 1, 10, {"bytes": 2 ** 62}),
+                "m,stream=1 bytes=%di 10" % (2 ** 62))
+
+    def test_missing_values(self):
+        # None, NaN, infinity and empty strings are all left out
+        line = make_line("m", 1, 10, {"a": None, "b": float('nan'),
+                "c": float('inf'), "d": "", "e": 1})
+        self.assertEqual(line, "m,stream=1 e=1i 10")
+
+    def test_no_fields(self):
+        self.assertIsNone(make_line("m", 1, 10, {}))
+        self.assertIsNone(make_line("m", 1, 10, {"a": None}))
+
+    def test_escape_names(self):
+        line = make_line("my table,x=y", "a b", 10, {"my field=1,2": 1})
+        self.assertEqual(line,
+                "my\\ table\\,x\\=y,stream=a\\ b my\\ field\\=1\\,2=1i 10")
+
+    def test_escape_strings(self):
+        line = make_line("m", 1, 10, {"s": 'say "hi" \\ bye, ok=1'})
+        self.assertEqual(line,
+                'm,stream=1 s="say \\"hi\\" \\\\ bye, ok=1" 10')
+
+    def test_unicode_strings(self):
+        line = make_line("m", 1, 10, {"s": u"caf\xe9"})
+        self.assertEqual(line, 'm,stream=1 s="caf\xc3\xa9" 10')
+
+if __name__ == "__main__":
+    unittest.main()
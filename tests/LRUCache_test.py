@@ -0,0 +1,87 @@
+import unittest
+from libnntsc.lrucache import LRUCache, ExpiringLRUCache
+
+class TestLRUCache(unittest.TestCase):
+    def test_eviction_order(self):
+        cache = LRUCache(3)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        cache.put("c", 3)
+
+        # the least recently added item goes first
+        cache.put("d", 4)
+        self.assertEqual(cache.items.keys(), ["b", "c", "d"])
+        self.assertFalse("a" in cache)
+        self.assertEqual(len(cache), 3)
+
+        # looking an item up makes it the most recently used
+        self.assertEqual(cache.get("b"), 2)
+        cache.put("e", 5)
+        self.assertEqual(cache.items.keys(), ["d", "b", "e"])
+
+        # as does replacing it, without evicting anything
+        cache.put("d", 6)
+        self.assertEqual(cache.items.keys(), ["b", "e", "d"])
+        self.assertEqual(cache.get("d"), 6)
+        self.assertEqual(cache.evictions, 2)
+
+    def test_contains(self):
+        # checking for a key doesn't count as using it
+        cache = LRUCache(2)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        self.assertTrue("a" in cache)
+        cache.put("c", 3)
+        self.assertFalse("a" in cache)
+
+    def test_update(self):
+        cache = LRUCache(2)
+        cache.update({"a": 1})
+        cache.update({"b": 2})
+        cache.update({"c": 3})
+        self.assertEqual(cache.items.keys(), ["b", "c"])
+
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+
+    def test_stats(self):
+        cache = LRUCache(1)
+        cache.put("a", 1)
+        cache.get("a")
+        self.assertIs(cache.get("b"), None)
+        self.assertEqual(cache.get("b", 7), 7)
+        cache.put("b", 2)
+
+        self.assertEqual(cache.stats(), {"size": 1, "maxsize": 1,
+                "hits": 1, "misses": 2, "evictions": 1})
+        self.assertEqual(cache.describe(), "1/1 entries, 1 hits, "
+                "2 misses (33.3% hit rate), 1 evictions")
+
+class TestExpiringLRUCache(unittest.TestCase):
+    def test_expiry(self):
+        cache = ExpiringLRUCache(10, 60)
+        cache.put("a", 1, now=1000)
+        cache.put("b", 2, now=1030)
+
+        self.assertEqual(cache.get("a", now=1059), 1)
+        self.assertIs(cache.get("a", now=1060), None)
+        self.assertFalse("a" in cache)
+        self.assertEqual(cache.get("b", now=1060), 2)
+
+        # looking an item up doesn't extend its lifetime
+        self.assertIs(cache.get("b", now=1090), None)
+
+        stats = cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"],
+                stats["expirations"]), (2, 2, 2))
+
+    def test_eviction_order(self):
+        cache = ExpiringLRUCache(2, 60)
+        cache.put("a", 1, now=1000)
+        cache.put("b", 2, now=1000)
+        cache.get("a", now=1000)
+        cache.put("c", 3, now=1000)
+        self.assertEqual(cache.items.keys(), ["a", "c"])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,133 @@
+import unittest
+import mock
+import psycopg2
+from libnntsc import metadatacache
+from libnntsc.metadatacache import CollectionMetadataCache, COLLECTION_CHANNEL
+from libnntsc.dbselect import DBSelector
+
+class FakeConnection(object):
+    def __init__(self):
+        self.notifies = []
+        self.queries = []
+        self.closed = False
+        self.broken = False
+
+    def cursor(self):
+        cursor = mock.Mock()
+        cursor.execute.side_effect = self.queries.append
+        return cursor
+
+    def poll(self):
+        if self.broken:
+            raise psycopg2.OperationalError("server closed the connection")
+
+    def close(self):
+        self.closed = True
+
+class TestCollectionMetadataCache(unittest.TestCase):
+
+    def setUp(self):
+        self.connections = []
+        patcher = mock.patch.object(metadatacache.psycopg2, "connect",
+                side_effect=self.connect)
+        self.connectmock = patcher.start()
+        self.addCleanup(patcher.stop)
+
+        # each test gets a new process-wide cache
+        patcher = mock.patch.object(metadatacache, "_metadatacache", None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def connect(self, connstr):
+        conn = FakeConnection()
+        self.connections.append(conn)
+        return conn
+
+    def create_selector(self, name):
+        selector = DBSelector(name, "nntsc", cachebackend="none")
+        selector.basic = mock.Mock()
+        selector.basic.cursor.rowcount = 1
+        selector.basic.cursor.fetchone.return_value = {
+            "datatable": "data_amp_icmp",
+            "streamtable": "streams_amp_icmp",
+            "module": "amp",
+            "modsubtype": "icmp",
+        }
+        selector.basic.cursor.fetchall.return_value = [
+            {"relname": "data_amp_icmp", "attname": "median"},
+            {"relname": "streams_amp_icmp", "attname": "source"},
+        ]
+        selector._basicquery = mock.Mock()
+        selector._releasebasic = mock.Mock()
+        return selector
+
+    def test_shared_between_selectors(self):
+        first = self.create_selector("first")
+        self.assertEqual(first._get_data_table(3),
+                ("data_amp_icmp", ["median"], "streams_amp_icmp"))
+        self.assertEqual(first._basicquery.call_count, 2)
+
+        # a selector for the next request uses what the first one found,
+        # without listening all over again
+        second = self.create_selector("second")
+        self.assertEqual(second._get_data_table(3),
+                ("data_amp_icmp", ["median"], "streams_amp_icmp"))
+        self.assertFalse(second._basicquery.called)
+        self.assertEqual(len(self.connections), 1)
+        self.assertEqual(self.connections[0].queries,
+                ["LISTEN %s" % (COLLECTION_CHANNEL)])
+
+    def test_notification(self):
+        cache = CollectionMetadataCache()
+        cache.check_changes("dbname=nntsc")
+        cache.put(3, {"datatable": "a"}, cache.generation)
+
+        cache.check_changes("dbname=nntsc")
+        self.assertEqual(cache.get(3), {"datatable": "a"})
+
+        self.connections[0].notifies.append(mock.Mock())
+        cache.check_changes("dbname=nntsc")
+        self.assertIsNone(cache.get(3))
+        self.assertEqual(self.connections[0].notifies, [])
+        self.assertEqual(len(self.connections), 1)
+
+    def test_stale_put(self):
+        cache = CollectionMetadataCache()
+        generation = cache.generation
+        cache.invalidate()
+        cache.put(3, {"datatable": "a"}, generation)
+        self.assertIsNone(cache.get(3))
+
+    def test_expiry(self):
+        cache = CollectionMetadataCache(ttl=10)
+        cache.put(3, {"datatable": "a"}, cache.generation, now=100)
+        self.assertEqual(cache.get(3, now=109), {"datatable": "a"})
+        self.assertIsNone(cache.get(3, now=110))
+
+    def test_lost_connection(self):
+        cache = CollectionMetadataCache()
+        cache.check_changes("dbname=nntsc")
+        cache.put(3, {"datatable": "a"}, cache.generation)
+
+        # notifications may have been missed, so nothing can be trusted
+        self.connections[0].broken = True
+        cache.check_changes("dbname=nntsc")
+        self.assertIsNone(cache.get(3))
+        self.assertTrue(self.connections[0].closed)
+
+        cache.check_changes("dbname=nntsc")
+        self.assertEqual(len(self.connections), 2)
+        cache.put(3, {"datatable": "a"}, cache.generation)
+        cache.check_changes("dbname=nntsc")
+        self.assertEqual(cache.get(3), {"datatable": "a"})
+
+    def test_cannot_listen(self):
+        cache = CollectionMetadataCache()
+        self.connectmock.side_effect = psycopg2.OperationalError("no database")
+        cache.check_changes("dbname=nntsc")
+        cache.put(3, {"datatable": "a"}, cache.generation)
+        cache.check_changes("dbname=nntsc")
+        self.assertIsNone(cache.get(3))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,81 @@
+import math
+import unittest
+from libnntsc.packedarray import pack_array, unpack_array, is_packed, \
+        INT_ARRAY, FLOAT_ARRAY
+
+class TestPackedArray(unittest.TestCase):
+
+    def check_round_trip(self, values, encoding):
+        packed = pack_array(values)
+        self.assertEqual(packed[0], encoding)
+        self.assertTrue(is_packed(packed))
+        self.assertEqual(unpack_array(packed), values)
+
+    def test_sorted_integers(self):
+        self.check_round_trip([1, 2, 3, 500, 501, 100000], INT_ARRAY)
+
+    def test_negative_deltas(self):
+        # unsorted values and negative numbers both need negative deltas
+        self.check_round_trip([100, 5, 5, 0, -1, -300, 20, -20], INT_ARRAY)
+
+    def test_zero_deltas(self):
+        self.check_round_trip([0, 0, 7, 7, 7], INT_ARRAY)
+
+    def test_missing_integers(self):
+        self.check_round_trip([None, 10, None, None, 4, None], INT_ARRAY)
+        self.check_round_trip([None, None], INT_ARRAY)
+
+    def test_big_integers(self):
+        self.check_round_trip([2 ** 40, -(2 ** 40), 2 ** 63 + 1, 0,
+                -(2 ** 70)], INT_ARRAY)
+
+    def test_empty(self):
+        self.check_round_trip([], INT_ARRAY)
+
+    def test_none(self):
+        self.assertIsNone(pack_array(None))
+        self.assertIsNone(unpack_array(None))
+
+    def test_floats(self):
+        self.check_round_trip([0.5, -1.25, 3.0, 1e300, -1e-300], FLOAT_ARRAY)
+
+    def test_mixed_floats_and_integers(self):
+        packed = pack_array([1, 2.5, None, 4])
+        self.assertEqual(packed[0], FLOAT_ARRAY)
+        self.assertEqual(unpack_array(packed), [1.0, 2.5, None, 4.0])
+
+    def test_nan(self):
+        # NaN is how missing values are stored, so it comes back as None
+        packed = pack_array([1.5, float('nan'), None])
+        self.assertEqual(unpack_array(packed), [1.5, None, None])
+
+    def test_infinity(self):
+        values = unpack_array(pack_array([float('inf'), -float('inf'), 0.5]))
+        self.assertTrue(math.isinf(values[0]) and values[0] > 0)
+        self.assertTrue(math.isinf(values[1]) and values[1] < 0)
+        self.assertEqual(values[2], 0.5)
+
+    def test_booleans_are_not_integers(self):
+        packed = pack_array([True, False])
+        self.assertEqual(packed[0], FLOAT_ARRAY)
+        self.assertEqual(unpack_array(packed), [1.0, 0.0])
+
+    def test_old_str_arrays(self):
+        self.assertEqual(unpack_array(str([1, 2, 3])), [1, 2, 3])
+        self.assertEqual(unpack_array(str([None, 5, None])), [None, 5, None])
+        self.assertEqual(unpack_array(str([1.5, 2.25])), [1.5, 2.25])
+        self.assertEqual(unpack_array(str([])), [])
+        self.assertEqual(unpack_array(u"[10, 20]"), [10, 20])
+        self.assertIsNone(unpack_array(str(None)))
+        self.assertFalse(is_packed(str([1, 2, 3])))
+
+    def test_other_values_unchanged(self):
+        self.assertEqual(unpack_array(""), "")
+        self.assertEqual(unpack_array(42), 42)
+        self.assertEqual(unpack_array("[not, valid"), "[not, valid")
+        self.assertEqual(unpack_array("hello"), "hello")
+        self.assertFalse(is_packed(""))
+        self.assertFalse(is_packed(42))
+
+if __name__ == "__main__":
+    unittest.main()
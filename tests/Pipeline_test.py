@@ -0,0 +1,123 @@
+import unittest
+import time
+import threading
+from libnntsc.pipeline import Pipeline, PIPELINE_DONE, PIPELINE_FAILED, \
+        PIPELINE_DROPPED
+
+class StageError(Exception):
+    pass
+
+class TestPipeline(unittest.TestCase):
+    def setUp(self):
+        self.pipeline = None
+        self.release = threading.Event()
+
+    def tearDown(self):
+        self.release.set()
+        if self.pipeline is not None and self.pipeline.threads[0].is_alive():
+            self.pipeline.stop()
+
+    def create_pipeline(self, stages, depth=2):
+        self.pipeline = Pipeline(stages, depth)
+        self.pipeline.start()
+        return self.pipeline
+
+    def submit(self, generation, item):
+        # keep retrying, as the IO loop would
+        while not self.pipeline.submit(generation, item):
+            time.sleep(0.001)
+
+    def test_ordering(self):
+        pipeline = self.create_pipeline([("add", lambda x: x + 1),
+                ("double", lambda x: x * 2)])
+
+        for i in range(0, 20):
+            self.submit(0, i)
+        pipeline.stop()
+
+        self.assertEqual(pipeline.completed(),
+                [(PIPELINE_DONE, 0, (i + 1) * 2, None) for i in range(0, 20)])
+        self.assertEqual(pipeline.completed(), [])
+
+    def test_backpressure(self):
+        started = threading.Event()
+
+        def blocked(x):
+            started.set()
+            self.release.wait()
+            return x
+
+        pipeline = self.create_pipeline([("blocked", blocked)], depth=1)
+
+        self.assertTrue(pipeline.submit(0, 1))
+        started.wait()
+
+        # the stage is busy, so only one more item fits in its queue
+        self.assertFalse(pipeline.full())
+        self.assertTrue(pipeline.submit(0, 2))
+        self.assertTrue(pipeline.full())
+        self.assertFalse(pipeline.submit(0, 3))
+
+        self.release.set()
+        pipeline.stop()
+        self.assertEqual([r[2] for r in pipeline.completed()], [1, 2])
+
+    def test_stop(self):
+        pipeline = self.create_pipeline([("a", lambda x: x),
+                ("b", lambda x: x), ("c", lambda x: x)])
+        self.submit(0, "x")
+        pipeline.stop()
+
+        # everything submitted before stopping makes it through, and then
+        # every stage exits
+        self.assertEqual(pipeline.completed(),
+                [(PIPELINE_DONE, 0, "x", None)])
+        for t in pipeline.threads:
+            self.assertFalse(t.is_alive())
+
+    def test_failure(self):
+        error = StageError("bad item")
+
+        def check(x):
+            if x == "bad":
+                raise error
+            return x.upper()
+
+        pipeline = self.create_pipeline([("lower", lambda x: x.lower()),
+                ("check", check)])
+
+        self.submit(1, "A")
+        self.submit(1, "BAD")
+        self.submit(1, "C")
+        self.submit(2, "D")
+        pipeline.stop()
+
+        # the failed item is reported with the input to the failing stage,
+        # and the rest of its generation is dropped
+        results = pipeline.completed()
+        self.assertEqual(results[0], (PIPELINE_DONE, 1, "A", None))
+        self.assertEqual(results[1], (PIPELINE_FAILED, 1, "bad", error))
+        self.assertEqual(results[2][:2], (PIPELINE_DROPPED, 1))
+        self.assertTrue(results[2][2] in ["C", "c"])
+        self.assertIs(results[2][3], None)
+        self.assertEqual(results[3], (PIPELINE_DONE, 2, "D", None))
+        self.assertEqual(len(results), 4)
+
+    def test_old_generation(self):
+        def fail(x):
+            raise StageError(x)
+
+        pipeline = self.create_pipeline([("fail", fail)])
+        self.submit(5, "x")
+
+        while not pipeline.completed():
+            time.sleep(0.001)
+
+        # items from older generations are dropped too
+        self.submit(3, "y")
+        pipeline.stop()
+        self.assertEqual(pipeline.completed(),
+                [(PIPELINE_DROPPED, 3, "y", None)])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,195 @@
+import math
+import unittest
+from libnntsc.rollups import MatrixRollups, ROLLUP_FLUSH_FREQ
+
+BINS = [
+    (60, 15 * 60, "_matrix_short", "short"),
+    (60 * 60, 3 * 60 * 60, "_matrix_day", "long"),
+]
+
+# the start of an hour, so also the start of a minute
+START = 1500001200
+
+class TestMatrixRollups(unittest.TestCase):
+
+    def setUp(self):
+        self.rollups = MatrixRollups(BINS)
+        self.rollups.add_definitions("data_amp_icmp", [
+            ("median", "mean", "median_avg"),
+            ("median", "stddev", "median_stddev"),
+            ("median", "count", "median_count"),
+            ("loss", "sum", "loss_sum"),
+        ])
+        self.rollups.add_definitions("data_amp_http", [
+            ('"code"', "mode", '"code_mode"'),
+        ])
+
+    def add(self, table, stream, offsets, rows, now=None, dirty=True):
+        if now is None:
+            now = START + max(offsets)
+        self.rollups.add([(table, stream, START + off, row) \
+                for off, row in zip(offsets, rows)], now, dirty)
+
+    def rows(self, now, rp="short"):
+        rows, keys = self.rollups.take_rows(now)
+        return dict([((m, s, b), f) for m, s, b, f in rows.get(rp, [])])
+
+    def test_aggregates(self):
+        self.add("data_amp_icmp", 1, [5, 10, 20, 50], [
+            {"median": 10, "loss": 0},
+            {"median": 20, "loss": 1},
+            {"median": 30, "loss": 0},
+            {"median": 40, "loss": 1},
+        ])
+
+        rows = self.rows(START + 60)
+        fields = rows[("data_amp_icmp_matrix_short", 1, START)]
+        self.assertEqual(fields["median_avg"], 25.0)
+        # influx uses the sample standard deviation
+        self.assertAlmostEqual(fields["median_stddev"], math.sqrt(500 / 3.0))
+        self.assertEqual(fields["median_count"], 4)
+        self.assertEqual(fields["loss_sum"], 2)
+        self.assertEqual(fields["magiccount_median"], 4)
+        self.assertEqual(fields["magiccount_loss"], 4)
+
+    def test_bins(self):
+        self.add("data_amp_icmp", 1, [0, 59, 60, 125], [{"median": 1},
+                {"median": 2}, {"median": 3}, {"median": 4}])
+
+        rows, keys = self.rollups.take_rows(START + 125)
+        short = sorted([(b, f["median_count"]) \
+                for m, s, b, f in rows["short"]])
+        self.assertEqual(short, [(START, 2), (START + 60, 1),
+                (START + 120, 1)])
+
+        self.assertEqual(len(rows["long"]), 1)
+        measurement, stream, binstart, fields = rows["long"][0]
+        self.assertEqual(measurement, "data_amp_icmp_matrix_day")
+        self.assertEqual(binstart, START)
+        self.assertEqual(fields["median_avg"], 2.5)
+
+    def test_missing_values(self):
+        # influx ignores missing values, but the count is still 0
+        self.add("data_amp_icmp", 1, [0, 1], [{"median": 7, "loss": None},
+                {"loss": None}])
+        fields = self.rows(START + 1)[("data_amp_icmp_matrix_short", 1,
+                START)]
+        self.assertEqual(fields["median_avg"], 7.0)
+        self.assertIsNone(fields["median_stddev"])
+        self.assertEqual(fields["median_count"], 1)
+        self.assertIsNone(fields["loss_sum"])
+        self.assertEqual(fields["magiccount_loss"], 0)
+
+    def test_stddev_large_values(self):
+        self.add("data_amp_icmp", 1, [0, 1, 2, 3], [{"median": 10 ** 12 + v} \
+                for v in [4, 7, 13, 16]])
+        fields = self.rows(START + 3)[("data_amp_icmp_matrix_short", 1,
+                START)]
+        self.assertAlmostEqual(fields["median_stddev"], math.sqrt(30))
+        self.assertEqual(fields["median_avg"], 10 ** 12 + 10)
+
+    def test_mode(self):
+        # ties go to the value that was seen first, like influx
+        self.add("data_amp_http", 3, [0, 1, 2, 3, 4], [{"code": c} \
+                for c in [404, 200, 200, 404, 500]])
+        fields = self.rows(START + 4)[("data_amp_http_matrix_short", 3,
+                START)]
+        self.assertEqual(fields["code_mode"], 404)
+        self.assertEqual(fields["magiccount_code"], 5)
+
+    def test_unknown_table(self):
+        self.assertFalse(self.rollups.wants("data_amp_dns"))
+        self.add("data_amp_dns", 1, [0], [{"rtt": 5}])
+        rows, keys = self.rollups.take_rows(START)
+        self.assertEqual(rows, {})
+
+    def test_only_changed_bins(self):
+        self.add("data_amp_icmp", 1, [0], [{"median": 1}])
+        self.assertEqual(len(self.rows(START)), 1)
+        self.assertEqual(self.rows(START + 1), {})
+
+        # the new row is added to what was already in the bin
+        self.add("data_amp_icmp", 1, [2], [{"median": 3}])
+        fields = self.rows(START + 2)[("data_amp_icmp_matrix_short", 1,
+                START)]
+        self.assertEqual(fields["median_count"], 2)
+        self.assertEqual(fields["median_avg"], 2.0)
+
+    def test_window_expiry(self):
+        self.add("data_amp_icmp", 1, [0], [{"median": 1}])
+
+        # the short bin closes after 15 minutes but the hour is still open
+        now = START + 15 * 60 + 1
+        self.rollups.take_rows(now)
+        self.add("data_amp_icmp", 1, [30], [{"median": 5}], now=now)
+        rows, keys = self.rollups.take_rows(now)
+        self.assertNotIn("short", rows)
+        self.assertEqual(rows["long"][0][3]["median_count"], 2)
+
+        # data for a bin that is too old to be open never opens it again
+        now = START + 3 * 60 * 60 + 1
+        self.rollups.take_rows(now)
+        self.add("data_amp_icmp", 1, [40], [{"median": 5}], now=now)
+        rows, keys = self.rollups.take_rows(now)
+        self.assertEqual(rows, {})
+        self.assertEqual(self.rollups.open, {})
+
+    def test_mark_dirty(self):
+        self.add("data_amp_icmp", 1, [0], [{"median": 1}])
+        rows, keys = self.rollups.take_rows(START)
+        self.assertEqual(len(keys), 2)
+
+        # e.g. because writing the rows failed
+        self.rollups.mark_dirty(keys)
+        again, keys = self.rollups.take_rows(START + 1)
+        self.assertEqual(again, rows)
+
+        # closed bins are forgotten rather than written again
+        now = START + 15 * 60 + 1
+        self.rollups.take_rows(now)
+        self.rollups.mark_dirty(keys)
+        rows, keys = self.rollups.take_rows(now)
+        self.assertNotIn("short", rows)
+        self.assertEqual(len(rows["long"]), 1)
+
+    def test_seeded_bins(self):
+        # seeded data counts towards the bin, but isn't written by itself
+        self.add("data_amp_icmp", 1, [0], [{"median": 1}], dirty=False)
+        rows, keys = self.rollups.take_rows(START)
+        self.assertEqual(rows, {})
+
+        self.add("data_amp_icmp", 1, [1], [{"median": 3}])
+        fields = self.rows(START + 1)[("data_amp_icmp_matrix_short", 1,
+                START)]
+        self.assertEqual(fields["median_count"], 2)
+
+    def test_discard_before(self):
+        self.add("data_amp_icmp", 1, [0, 60], [{"median": 1}, {"median": 2}],
+                dirty=False)
+        self.add("data_amp_http", 1, [0], [{"code": 200}], dirty=False)
+        self.rollups.discard_before("data_amp_icmp", START + 60)
+
+        # data for the discarded bins is ignored from now on, so the
+        # partial aggregates are never written
+        self.add("data_amp_icmp", 1, [1, 61], [{"median": 3}, {"median": 4}])
+        self.add("data_amp_http", 1, [1], [{"code": 404}])
+        rows, keys = self.rollups.take_rows(START + 61)
+
+        short = dict([((m, b), f) for m, s, b, f in rows["short"]])
+        self.assertEqual(sorted(short.keys()), [
+                ("data_amp_http_matrix_short", START),
+                ("data_amp_icmp_matrix_short", START + 60)])
+        self.assertEqual(short[("data_amp_icmp_matrix_short",
+                START + 60)]["median_count"], 2)
+        self.assertEqual(short[("data_amp_http_matrix_short",
+                START)]["magiccount_code"], 2)
+        self.assertEqual([m for m, s, b, f in rows["long"]],
+                ["data_amp_http_matrix_day"])
+
+    def test_flush_due(self):
+        self.rollups.take_rows(START)
+        self.assertFalse(self.rollups.flush_due(START + 1))
+        self.assertTrue(self.rollups.flush_due(START + ROLLUP_FLUSH_FREQ))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,240 @@
+import unittest
+import mock
+import Queue as StdQueue
+from multiprocessing import Value
+from libnntsc.sharding import ShardDispatcher, consume_shard
+from libnntsc.batching import BATCH_FLUSH_IDLE
+
+try:
+    from libnntsc.parsers.amp import AmpShardRouter, monitor_shard, \
+            assign_tests, SHARD_TEST_ORDER
+except ImportError:
+    # the AMP module needs ampsave to decode messages
+    AmpShardRouter = None
+
+class StopWorker(Exception):
+    pass
+
+class FakeQueue(object):
+    """ Hands out the given items, then stops the worker """
+    def __init__(self, items):
+        self.items = list(items)
+
+    def get(self, block=True, timeout=None):
+        if not self.items:
+            raise StopWorker()
+        item = self.items.pop(0)
+        if item is None:
+            raise StdQueue.Empty()
+        if callable(item):
+            return item()
+        return item
+
+class FakeProperties(object):
+    def __init__(self, user_id, test):
+        self.user_id = user_id
+        self.timestamp = 1500000000
+        if test is None:
+            self.headers = None
+        else:
+            self.headers = {"x-amp-test-type": test}
+
+@unittest.skipIf(AmpShardRouter is None, "ampsave is not installed")
+class TestAmpShardRouter(unittest.TestCase):
+    def test_monitor_shard(self):
+        # a monitor always maps to the same worker, regardless of how the
+        # name was decoded
+        shard = monitor_shard("amplet.example.com", 4)
+        self.assertTrue(0 <= shard < 4)
+        self.assertEqual(monitor_shard("amplet.example.com", 4), shard)
+        self.assertEqual(monitor_shard(u"amplet.example.com", 4), shard)
+
+        # and the mapping is spread across all of the workers
+        shards = set([monitor_shard("amplet%d" % (i), 4)
+                for i in range(0, 100)])
+        self.assertEqual(shards, set([0, 1, 2, 3]))
+
+    def test_assign_tests(self):
+        testmap = assign_tests(3)
+        self.assertEqual(sorted(testmap.keys()), sorted(SHARD_TEST_ORDER))
+        self.assertEqual(testmap["traceroute"], 0)
+        self.assertEqual(testmap["icmp"], 1)
+        self.assertEqual(testmap["dns"], 2)
+        self.assertEqual(testmap["http"], 0)
+
+        # restarting with the same number of workers gives the same map
+        self.assertEqual(assign_tests(3), testmap)
+
+        # a single worker gets everything
+        self.assertEqual(set(assign_tests(1).values()), set([0]))
+
+    def test_route_by_test(self):
+        router = AmpShardRouter("test", 3)
+        self.assertEqual(router(FakeProperties("a", "traceroute")), 0)
+        self.assertEqual(router(FakeProperties("b", "icmp")), 1)
+        self.assertEqual(router(FakeProperties("c", "icmp")), 1)
+        self.assertEqual(router(FakeProperties("a", "dns")), 2)
+
+        # unknown tests all go to the first worker
+        self.assertEqual(router(FakeProperties("a", "unknown")), 0)
+
+    def test_route_by_monitor(self):
+        router = AmpShardRouter("monitor", 4)
+        shard = monitor_shard("amplet.example.com", 4)
+        for test in SHARD_TEST_ORDER:
+            self.assertEqual(router(FakeProperties("amplet.example.com",
+                    test)), shard)
+
+    def test_route_unusable(self):
+        router = AmpShardRouter("monitor", 4)
+        self.assertIs(router(FakeProperties(None, "icmp")), None)
+        self.assertIs(router(FakeProperties("a", None)), None)
+        props = FakeProperties("a", "icmp")
+        props.headers = {}
+        self.assertIs(router(props), None)
+
+class TestShardDispatcher(unittest.TestCase):
+    def setUp(self):
+        self.route = mock.Mock(return_value=0)
+        self.workerqueues = [StdQueue.Queue(), StdQueue.Queue()]
+        self.results = StdQueue.Queue()
+        self.generation = Value('i', 0)
+        self.dispatcher = ShardDispatcher("amp", "localhost", 5672, False,
+                "guest", "guest", self.route, self.workerqueues,
+                self.results, self.generation)
+        self.channel = mock.Mock()
+        self.dispatcher._channel = self.channel
+
+    def dispatch(self, worker, tag):
+        self.route.return_value = worker
+        self.dispatcher.dispatch(self.channel, mock.Mock(delivery_tag=tag),
+                FakeProperties("a", "icmp"), "body%d" % (tag))
+
+    def test_dispatch(self):
+        self.dispatch(0, 1)
+        self.dispatch(1, 2)
+        self.dispatch(0, 3)
+
+        gen, tag, props, body = self.workerqueues[0].get(False)
+        self.assertEqual((gen, tag, body), (0, 1, "body1"))
+        self.assertEqual((props.user_id, props.headers),
+                ("a", {"x-amp-test-type": "icmp"}))
+        self.assertEqual(self.workerqueues[0].get(False)[1], 3)
+        self.assertEqual(self.workerqueues[1].get(False)[1], 2)
+        self.assertEqual(self.dispatcher._outstanding, [[1, 3], [2]])
+
+        # nothing is acknowledged until the worker has committed it
+        self.assertFalse(self.channel.basic_ack.called)
+
+    def test_unrouted(self):
+        self.dispatch(None, 1)
+        self.channel.basic_ack.assert_called_once_with(1)
+        self.assertTrue(self.workerqueues[0].empty())
+        self.assertTrue(self.workerqueues[1].empty())
+
+    def test_ack(self):
+        for tag in range(1, 5):
+            self.dispatch(tag % 2, tag)
+
+        self.dispatcher._handle_result(("ack", 1, 0, 3, False))
+        self.channel.basic_ack.assert_called_once_with(3)
+        self.assertEqual(self.dispatcher._outstanding, [[2, 4], [1]])
+
+        # acknowledging everything up to a tag only covers that worker
+        self.channel.reset_mock()
+        self.dispatcher._handle_result(("ack", 0, 0, 4, True))
+        self.assertEqual(self.channel.basic_ack.call_args_list,
+                [mock.call(2), mock.call(4)])
+        self.assertEqual(self.dispatcher._outstanding, [[], [1]])
+
+    def test_poll_results(self):
+        self.dispatch(0, 1)
+        self.dispatch(1, 2)
+        self.dispatcher._connection = mock.Mock()
+        self.results.put(("ack", 0, 0, 1, False))
+        self.results.put(("ack", 1, 0, 2, False))
+
+        self.dispatcher._poll_results()
+        self.assertEqual(self.channel.basic_ack.call_args_list,
+                [mock.call(1), mock.call(2)])
+        self.assertTrue(self.results.empty())
+        self.assertTrue(self.dispatcher._connection.add_timeout.called)
+
+    def test_channel_reset(self):
+        self.dispatch(0, 1)
+        self.dispatch(1, 2)
+
+        # redelivered messages start again on a new generation
+        with mock.patch("libnntsc.pikaqueue.PikaConsumer._pikaChannelClosed"):
+            self.dispatcher._pikaChannelClosed(self.channel, 320, "reset")
+        self.assertEqual(self.generation.value, 1)
+        self.assertEqual(self.dispatcher._outstanding, [[], []])
+
+        # so acknowledgements from before the reset are ignored
+        self.dispatcher._handle_result(("ack", 0, 0, 1, False))
+        self.dispatcher._handle_result(("close", 1, 0, 0, False))
+        self.assertFalse(self.channel.basic_ack.called)
+        self.assertFalse(self.channel.close.called)
+
+        self.dispatch(0, 1)
+        self.assertEqual(self.workerqueues[0].get(False)[0], 0)
+        self.assertEqual(self.workerqueues[0].get(False)[0], 1)
+        self.dispatcher._handle_result(("ack", 0, 1, 1, False))
+        self.channel.basic_ack.assert_called_once_with(1)
+
+    def test_close(self):
+        self.dispatcher._handle_result(("close", 1, 0, 0, False))
+        self.channel.close.assert_called_once_with()
+
+class TestConsumeShard(unittest.TestCase):
+    def setUp(self):
+        self.module = mock.Mock()
+        self.results = StdQueue.Queue()
+        self.generation = Value('i', 0)
+
+    def consume(self, items):
+        self.assertRaises(StopWorker, consume_shard, self.module, 1,
+                FakeQueue(items), self.results, self.generation)
+
+    def test_process(self):
+        self.consume([(0, 1, "props1", "body1"), (0, 2, "props2", "body2")])
+
+        calls = self.module.process_data.call_args_list
+        self.assertEqual(len(calls), 2)
+        channel, method, props, body = calls[0][0]
+        self.assertEqual((method.delivery_tag, props, body),
+                (1, "props1", "body1"))
+        self.assertEqual(calls[1][0][1].delivery_tag, 2)
+        self.assertEqual(self.module.check_pending.call_count, 2)
+        self.assertFalse(self.module.drop_pending.called)
+
+        # acknowledgements are passed back to the dispatcher
+        channel.basic_ack(2, True)
+        self.assertEqual(self.results.get(False), ("ack", 1, 0, 2, True))
+
+    def test_idle_flush(self):
+        self.consume([(0, 1, "props", "body"), None])
+        channel = self.module.process_data.call_args[0][0]
+        self.module.process_pending.assert_called_once_with(channel,
+                BATCH_FLUSH_IDLE)
+
+    def test_reset(self):
+        def reset():
+            self.generation.value = 1
+            return (0, 2, "props", "body")
+
+        # the message from the old channel will be redelivered, so it is
+        # skipped along with anything uncommitted
+        self.consume([(0, 1, "props", "body"), reset,
+                (1, 2, "props", "body")])
+        self.module.drop_pending.assert_called_once_with()
+        calls = self.module.process_data.call_args_list
+        self.assertEqual([c[0][1].delivery_tag for c in calls], [1, 2])
+
+        channel = calls[1][0][0]
+        self.assertEqual(channel.generation, 1)
+        channel.close()
+        self.assertEqual(self.results.get(False), ("close", 1, 1, 0, False))
+
+if __name__ == "__main__":
+    unittest.main()
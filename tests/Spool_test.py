@@ -0,0 +1,246 @@
+import unittest
+import mock
+import os
+import types
+import shutil
+import tempfile
+from libnntsc.spool import IngestSpool, read_records, spooled_messages, \
+        RECORD_HEADER
+from libnntsc.dberrorcodes import DBQueryException, DB_DATA_ERROR, \
+        DB_OPERATIONAL_ERROR
+
+try:
+    from libnntsc.parsers import amp
+except ImportError:
+    # the AMP module needs ampsave to decode messages
+    amp = None
+
+RECORDS = [("icmp", "amplet1", 1500000000, "body1"),
+        ("dns", "amplet2", 1500000060, "body2"),
+        ("http", "amplet1", 1500000120, "body3")]
+
+class TestIngestSpool(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "amp.spool")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_append_read(self):
+        spool = IngestSpool(self.path, 1024 * 1024)
+        self.assertTrue(spool.empty())
+        self.assertTrue(spool.append(RECORDS))
+        self.assertFalse(spool.empty())
+
+        records, offset = spool.read(2)
+        self.assertEqual(records, RECORDS[:2])
+
+        # nothing is consumed until the caller advances past it
+        self.assertEqual(spool.read(2)[0], RECORDS[:2])
+        spool.advance(offset)
+        records, offset = spool.read(2)
+        self.assertEqual(records, RECORDS[2:])
+        spool.close()
+
+        # the read position survives a restart
+        spool = IngestSpool(self.path, 1024 * 1024)
+        self.assertEqual(spool.read(10), (records, offset))
+        spool.close()
+
+    def test_caught_up(self):
+        spool = IngestSpool(self.path, 1024 * 1024)
+        spool.append(RECORDS)
+        records, offset = spool.read(10)
+        spool.advance(offset)
+
+        # the spool starts again from empty once everything is replayed
+        self.assertTrue(spool.empty())
+        self.assertEqual(spool.size, 0)
+        self.assertEqual(os.path.getsize(self.path), 0)
+        with open(self.path + ".offset") as f:
+            self.assertEqual(f.read(), "0\n")
+
+        spool.append(RECORDS[:1])
+        self.assertEqual(spool.read(10)[0], RECORDS[:1])
+        spool.close()
+
+    def test_max_size(self):
+        spool = IngestSpool(self.path, 100)
+        self.assertTrue(spool.append(RECORDS[:1]))
+        size = spool.size
+        self.assertFalse(spool.append(RECORDS))
+        self.assertEqual(spool.size, size)
+        self.assertEqual(os.path.getsize(self.path), size)
+        spool.close()
+
+    def test_truncated(self):
+        spool = IngestSpool(self.path, 1024 * 1024)
+        spool.append(RECORDS[:2])
+        size = spool.size
+        spool.close()
+
+        # stopped part way through writing the last record
+        with open(self.path, "ab") as f:
+            f.write(RECORD_HEADER.pack(100) + "partial")
+
+        self.assertEqual(list(read_records(self.path)), RECORDS[:2])
+
+        spool = IngestSpool(self.path, 1024 * 1024)
+        self.assertEqual(spool.size, size)
+        self.assertEqual(os.path.getsize(self.path), size)
+        self.assertEqual(spool.read(10)[0], RECORDS[:2])
+
+        spool.append(RECORDS[2:])
+        self.assertEqual(spool.read(10)[0], RECORDS)
+        spool.close()
+
+    def test_truncated_header(self):
+        spool = IngestSpool(self.path, 1024 * 1024)
+        spool.append(RECORDS[:1])
+        size = spool.size
+        spool.close()
+
+        with open(self.path, "ab") as f:
+            f.write("\0\0")
+
+        self.assertEqual(list(read_records(self.path)), RECORDS[:1])
+        spool = IngestSpool(self.path, 1024 * 1024)
+        self.assertEqual(spool.size, size)
+        spool.close()
+
+    def test_bad_offset(self):
+        spool = IngestSpool(self.path, 1024 * 1024)
+        spool.append(RECORDS)
+        spool.close()
+
+        with open(self.path + ".offset", "w") as f:
+            f.write("garbage")
+        spool = IngestSpool(self.path, 1024 * 1024)
+        self.assertEqual(spool.read(10)[0], RECORDS)
+        spool.close()
+
+        # an offset beyond the end of the spool means it was lost
+        with open(self.path + ".offset", "w") as f:
+            f.write("100000\n")
+        spool = IngestSpool(self.path, 1024 * 1024)
+        self.assertEqual(spool.read(10)[0], RECORDS)
+        spool.close()
+
+    def test_spooled_messages(self):
+        messages = spooled_messages(RECORDS[:1])
+        self.assertEqual(len(messages), 1)
+        method, properties, body = messages[0]
+        self.assertIs(method.delivery_tag, None)
+        self.assertEqual((properties.user_id, properties.timestamp),
+                ("amplet1", 1500000000))
+        self.assertEqual(properties.headers, {"x-amp-test-type": "icmp"})
+        self.assertEqual(body, "body1")
+
+@unittest.skipIf(amp is None, "ampsave is not installed")
+class TestSpoolReplay(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.spool = IngestSpool(os.path.join(self.tmpdir, "amp.spool"),
+                1024 * 1024)
+
+        # only the parts of the module that deal with the spool
+        self.module = types.InstanceType(amp.AmpModule)
+        self.module.db = mock.Mock()
+        self.module.spool = self.spool
+        self.module.spooling = True
+        self.module.replaying = None
+        self.module.quarantine = None
+        self.module.nextreplay = 0
+        self.module.pipeline = None
+        self.module.pending = []
+        self.module.batchconf = {"maxcommitfreq": 2}
+        self.module._commit_batch = mock.Mock()
+
+    def tearDown(self):
+        self.spool.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_replay(self):
+        self.spool.append(RECORDS)
+
+        self.module._replay_spool()
+        self.assertFalse(self.module.spooling)
+        pending = self.module._commit_batch.call_args[0][0]
+        self.assertEqual([m[2] for m in pending], ["body1", "body2"])
+
+        self.module._replay_spool()
+        self.assertTrue(self.spool.empty())
+        self.assertEqual(self.module._commit_batch.call_count, 2)
+
+    def test_unavailable(self):
+        self.spool.append(RECORDS)
+        self.module._commit_batch.side_effect = \
+                DBQueryException(DB_OPERATIONAL_ERROR)
+
+        # the same messages are tried again later
+        self.module._replay_spool()
+        self.assertTrue(self.module.spooling)
+        self.assertTrue(self.module.nextreplay > 0)
+        self.assertEqual(self.spool.read(10)[0], RECORDS)
+        self.assertFalse(self.module.db.quarantine_message.called)
+
+    def test_quarantine(self):
+        self.spool.append(RECORDS)
+        error = DBQueryException(DB_DATA_ERROR)
+        self.module._commit_batch.side_effect = error
+
+        # a batch the database will never accept is moved to the dead
+        # letter table and the spool carries on past it
+        self.module._replay_spool()
+        self.assertEqual(self.module.db.quarantine_message.call_args_list,
+                [mock.call("amp", "icmp", "amplet1", "body1", error),
+                 mock.call("amp", "dns", "amplet2", "body2", error)])
+        self.module.db.commit_data.assert_called_once_with()
+        self.assertFalse(self.module.spooling)
+        self.assertEqual(self.spool.read(10)[0], RECORDS[2:])
+
+    def test_quarantine_failed(self):
+        self.spool.append(RECORDS)
+        self.module._commit_batch.side_effect = DBQueryException(DB_DATA_ERROR)
+        self.module.db.quarantine_message.side_effect = \
+                DBQueryException(DB_OPERATIONAL_ERROR)
+
+        self.module._replay_spool()
+        self.module.db.rollback_data.assert_called_once_with()
+        self.assertFalse(self.module.db.commit_data.called)
+        self.assertTrue(self.module.spooling)
+        self.assertEqual(self.spool.read(10)[0], RECORDS)
+
+    def test_spool_on_connection_error(self):
+        channel = mock.Mock()
+        messages = spooled_messages(RECORDS)
+        for tag, (method, properties, body) in enumerate(messages):
+            method.delivery_tag = tag
+        self.module.spooling = False
+        self.module.pending = list(messages)
+        self.module._commit_batch.side_effect = \
+                DBQueryException(DB_OPERATIONAL_ERROR)
+
+        self.module.process_pending(channel)
+        self.assertTrue(self.module.spooling)
+        self.assertEqual(self.spool.read(10)[0], RECORDS)
+        self.assertEqual(channel.basic_ack.call_args_list,
+                [mock.call(0), mock.call(1), mock.call(2)])
+        self.assertFalse(channel.close.called)
+
+    def test_no_spool_on_data_error(self):
+        channel = mock.Mock()
+        self.module.spooling = False
+        self.module.pending = spooled_messages(RECORDS)
+        self.module._commit_batch.side_effect = DBQueryException(DB_DATA_ERROR)
+
+        # the messages are redelivered instead
+        self.module.process_pending(channel)
+        channel.close.assert_called_once_with()
+        self.assertFalse(channel.basic_ack.called)
+        self.assertTrue(self.spool.empty())
+        self.assertFalse(self.module.spooling)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,124 @@
+import unittest
+import mock
+from libnntsc import streamcache
+from libnntsc.streamcache import StreamCache, LocalTimestampCache, \
+        LAST_TIMESTAMP_FLUSH_FREQ
+
+class FakeBackend(object):
+    def __init__(self, name="memcache", uselocal=True):
+        self.name = name
+        self.uselocal = uselocal
+        self.values = {}
+        self.gets = []
+
+    def get_multi(self, keys):
+        self.gets.append(sorted(keys))
+        return dict([(k, self.values[k]) for k in keys if k in self.values])
+
+    def set_multi(self, values, ttl):
+        self.values.update(values)
+        return True
+
+class TestStreamCache(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        self.backend = FakeBackend()
+
+        patches = [mock.patch.object(streamcache, "create_cache_backend",
+                        side_effect=lambda *args: self.backend),
+                mock.patch.object(streamcache, "_localcache",
+                        LocalTimestampCache(100, 30)),
+                mock.patch.object(streamcache.time, "time",
+                        side_effect=lambda: self.now)]
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+
+    def test_round_trip(self):
+        cache = StreamCache("nntsc", 300)
+        cache.set_last_timestamps("amp", 5, {1: 100, 2: 200.7})
+        cache.set_first_timestamps("amp", 5, {1: 50})
+
+        # every stream has its own key
+        self.assertEqual(self.backend.values, {"nntsc_nntsc_amp_5_last_1": 100,
+                "nntsc_nntsc_amp_5_last_2": 200,
+                "nntsc_nntsc_amp_5_first_1": 50})
+
+        self.assertEqual(cache.fetch_last_timestamps("amp", 5, [1, 2, 3]),
+                {1: 100, 2: 200})
+        self.assertEqual(cache.fetch_first_timestamps("amp", 5, [1, 2]),
+                {1: 50})
+        self.assertEqual(cache.fetch_last_timestamps("amp", 6, [1]), {})
+        self.assertEqual(cache.fetch_last_timestamps("amp", 5, []), {})
+
+    def test_local_tier(self):
+        cache = StreamCache("nntsc", 300)
+        cache.set_last_timestamps("amp", 5, {1: 100})
+        self.backend.values["nntsc_nntsc_amp_5_last_2"] = 200
+
+        # only the streams that weren't stored locally go to the backend
+        self.assertEqual(cache.fetch_last_timestamps("amp", 5, [1, 2, 3]),
+                {1: 100, 2: 200})
+        self.assertEqual(self.backend.gets, [["nntsc_nntsc_amp_5_last_2",
+                "nntsc_nntsc_amp_5_last_3"]])
+
+        # and anything found there is kept locally too
+        self.backend.gets = []
+        self.assertEqual(cache.fetch_last_timestamps("amp", 5, [1, 2]),
+                {1: 100, 2: 200})
+        self.assertEqual(self.backend.gets, [])
+
+        # until it has been there too long
+        self.now += 30
+        self.backend.values["nntsc_nntsc_amp_5_last_1"] = 160
+        self.assertEqual(cache.fetch_last_timestamps("amp", 5, [1, 2]),
+                {1: 160, 2: 200})
+        self.assertEqual(self.backend.gets, [["nntsc_nntsc_amp_5_last_1",
+                "nntsc_nntsc_amp_5_last_2"]])
+
+    def test_local_tier_shared(self):
+        first = StreamCache("nntsc", 300)
+        second = StreamCache("nntsc", 300)
+        self.assertIs(first.local, second.local)
+
+        first.set_last_timestamps("amp", 5, {1: 100})
+        self.assertEqual(second.fetch_last_timestamps("amp", 5, [1]),
+                {1: 100})
+        self.assertEqual(self.backend.gets, [])
+
+    def test_no_local_tier(self):
+        self.backend = FakeBackend("sharedmem", False)
+        cache = StreamCache("nntsc", 300)
+        self.assertIs(cache.local, None)
+        self.assertEqual(cache.describe_local_cache(),
+                "not used with sharedmem backend")
+
+        cache.set_last_timestamps("amp", 5, {1: 100})
+        self.assertEqual(cache.fetch_last_timestamps("amp", 5, [1]),
+                {1: 100})
+        self.assertEqual(self.backend.gets, [["nntsc_nntsc_amp_5_last_1"]])
+
+    def test_update_timestamps(self):
+        cache = StreamCache("nntsc", 300)
+        cache.update_timestamps("amp", 5, [1, 2], 100)
+        self.assertEqual(self.backend.values, {"nntsc_nntsc_amp_5_last_1": 100,
+                "nntsc_nntsc_amp_5_last_2": 100})
+
+        # later updates are only written back periodically, but are
+        # still visible to this process straight away
+        cache.update_timestamps("amp", 5, [2], 160)
+        cache.update_timestamps("amp", 5, [1], 50)
+        self.assertEqual(self.backend.values["nntsc_nntsc_amp_5_last_2"],
+                100)
+        self.assertEqual(cache.fetch_last_timestamps("amp", 5, [1, 2]),
+                {1: 100, 2: 160})
+
+        # only the streams that changed are written
+        self.backend.values = {}
+        self.now += LAST_TIMESTAMP_FLUSH_FREQ
+        cache.update_timestamps("amp", 5, [3], 220)
+        self.assertEqual(self.backend.values, {"nntsc_nntsc_amp_5_last_2": 160,
+                "nntsc_nntsc_amp_5_last_3": 220})
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,74 @@
+import unittest
+import os
+import shutil
+import tempfile
+from libnntsc.streamsnapshot import StreamSnapshot, SNAPSHOT_HEADER, \
+        SNAPSHOT_MAGIC, SNAPSHOT_VERSION
+
+MAPS = {"streams_amp_icmp": {("amplet1", "example.com", "84"): 1,
+                ("amplet2", "example.com", "random"): 5},
+        "streams_amp_dns": {("amplet1", "8.8.8.8", "example.com"): 3}}
+
+class TestStreamSnapshot(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "streams.snapshot")
+        self.snapshot = StreamSnapshot(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_round_trip(self):
+        self.assertTrue(self.snapshot.save(5, MAPS, 1234))
+        self.assertFalse(os.path.exists(self.path + ".tmp"))
+
+        self.assertEqual(self.snapshot.highwater(), 5)
+        self.assertEqual(self.snapshot.load(1234), (5, MAPS))
+        self.assertEqual(self.snapshot.load(), (5, MAPS))
+
+        # saving again replaces the old snapshot entirely
+        self.assertTrue(self.snapshot.save(7, {}, 1234))
+        self.assertEqual(self.snapshot.load(1234), (7, {}))
+
+    def test_missing(self):
+        self.assertIs(self.snapshot.highwater(), None)
+        self.assertEqual(self.snapshot.load(), (None, {}))
+
+        open(self.path, "wb").close()
+        self.assertIs(self.snapshot.highwater(), None)
+        self.assertEqual(self.snapshot.load(), (None, {}))
+
+    def test_other_database(self):
+        # a snapshot from a rebuilt or restored database must not be used
+        self.snapshot.save(5, MAPS, 1234)
+        self.assertEqual(self.snapshot.load(4321), (None, {}))
+
+    def write_header(self, magic, version):
+        with open(self.path, "wb") as f:
+            f.write(SNAPSHOT_HEADER.pack(magic, version, 1234, 5))
+
+    def test_stale_version(self):
+        self.write_header(SNAPSHOT_MAGIC, SNAPSHOT_VERSION - 1)
+        self.assertIs(self.snapshot.highwater(), None)
+        self.assertEqual(self.snapshot.load(1234), (None, {}))
+
+        self.write_header("XXXX", SNAPSHOT_VERSION)
+        self.assertIs(self.snapshot.highwater(), None)
+        self.assertEqual(self.snapshot.load(1234), (None, {}))
+
+    def test_corrupt(self):
+        self.snapshot.save(5, MAPS, 1234)
+        size = os.path.getsize(self.path)
+        with open(self.path, "r+b") as f:
+            f.truncate(size - 10)
+
+        self.assertEqual(self.snapshot.load(1234), (None, {}))
+
+    def test_remove(self):
+        self.snapshot.save(5, MAPS, 1234)
+        self.assertTrue(self.snapshot.remove())
+        self.assertFalse(os.path.exists(self.path))
+        self.assertTrue(self.snapshot.remove())
+
+if __name__ == "__main__":
+    unittest.main()
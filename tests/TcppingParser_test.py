@@ -1,6 +1,7 @@
 import unittest
 import mock
 from libnntsc.parsers.amp_tcpping import AmpTcppingParser
+from libnntsc.packedarray import pack_array
 
 class TestTcppingParser(unittest.TestCase):
     testdata = [{
@@ -112,7 +113,7 @@ class TestTcppingParser(unittest.TestCase):
         parser.process_data(0, self.testdata, "source")
 
         # check what was written to the database
-        calls = [mock.call("data_amp_tcpping", mock.ANY, 0, x, {"rtts": str})
+        calls = [mock.call("data_amp_tcpping", mock.ANY, 0, x, {"rtts": pack_array})
                  for x in self.expected]
         influx.insert_data.assert_has_calls(calls, any_order=True)
 
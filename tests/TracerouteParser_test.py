@@ -1,6 +1,8 @@
 import unittest
 import mock
 from libnntsc.parsers.amp_traceroute import AmpTracerouteParser
+from libnntsc.parsers.amp_traceroute_pathlen import AmpTraceroutePathlenParser
+from libnntsc.parsers.common import DerivedDataCache, share_stream_registries
 
 class TestTracerouteParser(unittest.TestCase):
     testdata = {
@@ -166,7 +168,7 @@ class TestTracerouteParser(unittest.TestCase):
             # set up required postgresql database mock
             database = mock.Mock()
             database.insert_stream.side_effect = range(0, len(testdata["data"]))
-            database.custom_insert.side_effect = [(0, 0)] * len(testdata["data"])
+            database.custom_insert_rows.return_value = [(0, 0)]
 
             # create the parser under test
             parser = AmpTracerouteParser(database)
@@ -181,5 +183,223 @@ class TestTracerouteParser(unittest.TestCase):
                      for x in testdata["expected"]]
             database.insert_data.assert_has_calls(calls, any_order=True)
 
+    def test_shared_hop_walk(self):
+        data = self.testdata["asn"]["data"]
+        derived = DerivedDataCache()
+
+        # both traceroute parsers should share the same walk over the hops
+        traceroute = AmpTracerouteParser(mock.Mock())
+        pathlen = AmpTraceroutePathlenParser(mock.Mock(), mock.Mock())
+        first = traceroute.prepare_data(data, "source", derived)
+        second = pathlen.prepare_data(data, "source", derived)
+
+        for a, b in zip(first, second):
+            self.assertIs(a[3], b[3])
+        self.assertEqual(first[1][3]["aspath"], ["1.64496", "1.64497"])
+        self.assertEqual(first[1][3]["uniqueas"], 2)
+
+    def test_shared_stream_registry(self):
+        data = self.testdata["asn"]["data"]
+        database = mock.Mock()
+        database.insert_stream.side_effect = range(0, len(data))
+        database.custom_insert_rows.return_value = [(0, 0)]
+
+        traceroute = AmpTracerouteParser(database)
+        pathlen = AmpTraceroutePathlenParser(database, mock.Mock())
+        share_stream_registries([traceroute, pathlen])
+
+        # the pathlen parser should find the streams that the traceroute
+        # parser created rather than trying to create them again
+        traceroute.process_data(0, data, "source")
+        pathlen.process_data(0, data, "source")
+
+        self.assertIs(traceroute.streams, pathlen.streams)
+        self.assertEqual(database.insert_stream.call_count,
+                len(traceroute.streams))
+
+    def test_batched_paths(self):
+        data = self.testdata["ip"]["data"]
+        database = mock.Mock()
+        database.insert_stream.side_effect = range(0, len(data))
+
+        # give every path in each query its own id
+        def paths_query(sql, params):
+            if "inet[]" in sql:
+                count = len(params) // 3
+            else:
+                count = len(params) // 5
+            return [(n, n) for n in range(count)]
+        database.custom_insert_rows.side_effect = paths_query
+
+        # create the streams first, then forget about their paths
+        parser = AmpTracerouteParser(database)
+        prepared = parser.prepare_data(data, "source")
+        parser.process_data(0, data, "source")
+        parser.post_commit()
+        database.custom_insert_rows.reset_mock()
+        parser.paths.clear()
+        parser.aspaths.clear()
+
+        # the same paths seen in several messages should all be looked up
+        # together, with one query for each paths table
+        parser.process_batch([(0, 60, prepared, "source"),
+                (1, 120, prepared, "source")])
+        tables = set([c[0][0].split("INSERT INTO ")[1].split()[0] \
+                for c in database.custom_insert_rows.call_args_list])
+        self.assertEqual(database.custom_insert_rows.call_count, len(tables))
+
+        # and once they are committed, they should come from the cache
+        parser.post_commit()
+        database.custom_insert_rows.reset_mock()
+        parser.process_batch([(2, 180, prepared, "source")])
+        self.assertFalse(database.custom_insert_rows.called)
+        self.assertTrue(parser.path_cache_stats()["ip"]["hits"] > 0)
+
+    def test_global_paths(self):
+        data = self.testdata["ip"]["data"]
+        database = mock.Mock()
+        database.pathstorage = "global"
+        database.insert_stream.side_effect = range(0, len(data))
+
+        def paths_query(sql, params):
+            if "inet[]" in sql:
+                count = len(params) // 3
+            else:
+                count = len(params) // 5
+            return [(n, n) for n in range(count)]
+        database.custom_insert_rows.side_effect = paths_query
+
+        parser = AmpTracerouteParser(database)
+        prepared = parser.prepare_data(data, "source")
+        parser.process_data(0, data, "source")
+
+        # new streams shouldn't get their own paths tables
+        self.assertFalse(database.clone_table.call_args_list.count(
+                mock.call("data_amp_traceroute_paths", mock.ANY)))
+        parser.post_commit()
+        database.custom_insert_rows.reset_mock()
+        parser.paths.clear()
+        parser.aspaths.clear()
+
+        # paths from every stream should be found in the same dictionaries,
+        # matched on the hash of each path
+        parser.process_batch([(0, 60, prepared, "source")])
+        tables = [c[0][0].split("INSERT INTO ")[1].split()[0] \
+                for c in database.custom_insert_rows.call_args_list]
+        self.assertTrue(len(tables) > 0)
+        self.assertEqual(len(tables), len(set(tables)))
+        self.assertTrue(set(tables) <= set(["traceroute_path_dictionary",
+                "traceroute_aspath_dictionary"]))
+        self.assertTrue(all("path_hash" in c[0][0]
+                for c in database.custom_insert_rows.call_args_list))
+
+    def test_partitioned_data(self):
+        data = self.testdata["ip"]["data"]
+        database = mock.Mock()
+        database.datalayout = "partitioned"
+        database.insert_stream.side_effect = range(0, len(data))
+        database.custom_insert_rows.return_value = [(0, 0)]
+
+        parser = AmpTracerouteParser(database)
+        parser.process_data(0, data, "source")
+
+        # new streams shouldn't get their own AS data table or any foreign
+        # keys pointing from the shared data tables to their paths tables
+        self.assertFalse(database.clone_table.call_args_list.count(
+                mock.call("data_amp_astraceroute", mock.ANY)))
+        self.assertFalse(database.add_foreign_key.called)
+        self.assertEqual(database.clone_table.call_count, 2 * len(data))
+
+    def test_global_path_conflicts(self):
+        data = self.testdata["ip"]["data"]
+        database = mock.Mock()
+        database.pathstorage = "global"
+        database.insert_stream.side_effect = range(0, len(data))
+
+        # the first query for each table skips its first path, as if
+        # someone else added it at the same time
+        queries = []
+        def paths_query(sql, params):
+            queries.append(sql)
+            self.assertTrue("ON CONFLICT DO NOTHING" in sql)
+            if "inet[]" in sql:
+                count = len(params) // 3
+            else:
+                count = len(params) // 5
+            if len(queries) % 2 == 1:
+                return [(n, 100 + n) for n in range(1, count)]
+            return [(n, 200 + n) for n in range(count)]
+        database.custom_insert_rows.side_effect = paths_query
+
+        parser = AmpTracerouteParser(database)
+        prepared = parser.prepare_data(data, "source")
+        parser.process_data(0, data, "source")
+        parser.post_commit()
+        database.custom_insert_rows.reset_mock()
+        del queries[:]
+        parser.paths.clear()
+        parser.aspaths.clear()
+
+        # the skipped path should be looked up again on its own
+        parser.process_batch([(0, 60, prepared, "source")])
+        self.assertEqual(len(queries), 2)
+        self.assertEqual(sorted(parser.pending_paths.values()),
+                [101, 102, 200])
+
+    def test_migrate_paths(self):
+        def migrate(datalayout, oldtables):
+            database = mock.Mock()
+            database.pathstorage = "global"
+            database.datalayout = datalayout
+            database.table_exists.side_effect = \
+                    lambda table: table.startswith("data_amp_traceroute_paths") \
+                    or table in oldtables
+
+            parser = AmpTracerouteParser(database)
+            self.assertTrue(parser.migrate_paths(7))
+            updates = [c[0][0] for c in database.custom_query.call_args_list
+                    if c[0][0].startswith("UPDATE")]
+            fkeys = [c[0][0] for c in database.add_foreign_key.call_args_list]
+            return updates, fkeys
+
+        # every stream has its own data tables
+        updates, fkeys = migrate("stream", [])
+        self.assertEqual(len(updates), 3)
+        self.assertTrue(all(u.startswith("UPDATE data_amp_traceroute_7 ") or
+                u.startswith("UPDATE data_amp_astraceroute_7 ")
+                for u in updates))
+        self.assertEqual(sorted(fkeys), ["data_amp_astraceroute_7",
+                "data_amp_traceroute_7", "data_amp_traceroute_7"])
+
+        # the stream's data has already been moved to the partitioned tables
+        updates, fkeys = migrate("partitioned", [])
+        self.assertEqual(len(updates), 3)
+        self.assertTrue(all(u.startswith("UPDATE data_amp_traceroute t") or
+                u.startswith("UPDATE data_amp_astraceroute t")
+                for u in updates))
+        self.assertTrue(all("stream_id = 7" in u for u in updates))
+        self.assertEqual(fkeys, [])
+
+        # some of the stream's data is still in its old data table
+        updates, fkeys = migrate("partitioned", ["data_amp_traceroute_7"])
+        self.assertEqual(len([u for u in updates
+                if u.startswith("UPDATE data_amp_traceroute_7 ")]), 2)
+        self.assertEqual(fkeys, ["data_amp_traceroute_7"] * 2)
+
+    def test_no_database(self):
+        # parsers in the decode pool have no database, but must still be
+        # able to prepare data
+        traceroute = AmpTracerouteParser(None)
+        pathlen = AmpTraceroutePathlenParser(None, None)
+        self.assertFalse(traceroute.globalpaths)
+        self.assertFalse(traceroute.partitioned)
+
+        data = self.testdata["asn"]["data"]
+        derived = DerivedDataCache()
+        prepared = traceroute.prepare_data(data, "source", derived)
+        self.assertEqual(len(prepared), len(data))
+        self.assertEqual(len(pathlen.prepare_data(data, "source", derived)),
+                len(data))
+
 if __name__ == "__main__":
     unittest.main()